@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# Benchmark do tempo de aplicacao: start()/stop() do motor contra confs sinteticos (N interfaces x M servicos), com tc/ip/modprobe
+# substituidos por stand-ins que so gravam os comandos e um /sys/class/net falso. Mede por fase (parse, cleanup, shaping, filters...)
+# tempo, processos lancados, comandos emitidos e pico de memoria; compara com um resultado anterior para apanhar regressoes.
+import argparse
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+APPLY_MODES = ('exec', 'batch') # netlink fala com o kernel: sem stand-in possivel
+# Fase -> metodos do motor cujo tempo (exclusivo: fases aninhadas descontam-se da fase exterior) lhe e atribuido
+PHASES = (('parse', ('_parse_macros_from_foomuuri_conf', '_validate_hierarchy')), ('cleanup', ('_full_cleanup_attempt',)), ('modules', ('_load_modules',)),
+		  ('ifb', ('_setup_ifb',)), ('shaping', ('_setup_shaping',)), ('filters', ('_apply_classes_and_filters',)), ('flush', ('_flush_batch',)))
+STEPS = ('start', 'stop')
+
+# Stand-in de tc/ip/modprobe: regista o processo (spawns) e cada comando (as linhas de -batch incluidas); o ip cria/remove as
+# interfaces na arvore sysfs falsa para o motor ver as IFBs que criou. 'tc -j ... show' devolve uma lista vazia (sem estado tc)
+STAND_IN = """#!/bin/sh
+tool=${0##*/}; sys=$QOS_BENCH_DIR/sys
+echo "$tool $*" >> "$QOS_BENCH_DIR/spawns"
+link() {
+	[ "$1" = link ] || return 0
+	case "$2" in
+	add) dev=$3; queues=1; shift 3
+		while [ $# -gt 1 ]; do [ "$1" = numtxqueues ] && queues=$2; shift; done
+		i=0; while [ $i -lt $queues ]; do mkdir -p "$sys/$dev/queues/tx-$i"; i=$((i + 1)); done
+		echo 1500 > "$sys/$dev/mtu"; echo 0x1003 > "$sys/$dev/flags";;
+	del) eval "dev=\\${$#}"; rm -rf "$sys/$dev";;
+	esac
+}
+if [ "$1" = -force ] && [ "$2" = -batch ]; then
+	while IFS= read -r line; do echo "$tool $line" >> "$QOS_BENCH_DIR/commands"; [ "$tool" = ip ] && link $line; done
+else
+	echo "$tool $*" >> "$QOS_BENCH_DIR/commands"; [ "$tool" = ip ] && link "$@"
+	[ "$tool" = tc ] && [ "$1" = -j ] && echo '[]'
+fi
+exit 0
+"""
+
+
+def digit_suffixes():
+	# Sufixos manuais tem de ser decimais (o tc le-os em hex): minors a partir de 0x100 cuja representacao hex so tem digitos
+	return (s for s in (f"{minor:x}" for minor in itertools.count(0x100)) if s.isdigit())
+
+
+def synthetic_conf(interfaces, services, classifier):
+	lines = ["macro {"]
+	for i in range(interfaces):
+		key = f"ETH{i}"
+		lines += [f'\tQOS_IF_{key}_NAME\t"eth{i}"', f'\tQOS_IF_{key}_IFB\t"ifb{i}"', f'\tQOS_IF_{key}_CLASSIFIER\t"{classifier}"',
+				  f'\tQOS_IF_{key}_TOTAL_UPLOAD_BW\t"10Gbit"', f'\tQOS_IF_{key}_TOTAL_DOWNLOAD_BW\t"10Gbit"']
+		for direction in ('UPLOAD', 'DOWNLOAD'):
+			lines += [f'\tQOS_IF_{key}_DEFAULT_{direction}_ID\t"1:30"', f'\tQOS_IF_{key}_DEFAULT_{direction}_RATE\t"1Mbit"', f'\tQOS_IF_{key}_DEFAULT_{direction}_CEIL\t"100Mbit"']
+	lines.append('\tQOS_SERVICE_LIST\t"' + ' '.join(f"srv{i}" for i in range(services)) + '"')
+	for i, suffix in zip(range(services), digit_suffixes()):
+		prefix = f"\tQOS_SRV_srv{i}_"
+		lines += [f'{prefix}MARK\t"{0x1000 + i:#x}"', f'{prefix}PRIORITY\t"{i % 8}"']
+		for direction in ('UPLOAD', 'DOWNLOAD'):
+			lines += [f'{prefix}{direction}_SUFFIX\t"{suffix}"', f'{prefix}{direction}_RATE_DEFAULT\t"1kbit"', f'{prefix}{direction}_CEIL_DEFAULT\t"100Mbit"']
+		# Um servico em cada dez com override na primeira interface (upload e download)
+		if i % 10 == 0: lines += [f'{prefix}OVERRIDE_ETH0_UPLOAD_RATE\t"2kbit"', f'{prefix}OVERRIDE_ETH0_UPLOAD_CEIL\t"200Mbit"', f'{prefix}OVERRIDE_IFB0_DOWNLOAD_RATE\t"2kbit"', f'{prefix}OVERRIDE_IFB0_DOWNLOAD_CEIL\t"200Mbit"']
+	lines.append("}")
+	return '\n'.join(lines) + '\n', sum(1 for line in lines if line.startswith('\t'))
+
+
+def load_engine(path):
+	# O motor configura o log ao importar (ficheiro em /var/log e stdout): o benchmark so mostra avisos e erros, em stderr
+	spec = importlib.util.spec_from_file_location('qos_engine_bench', path)
+	module = importlib.util.module_from_spec(spec); spec.loader.exec_module(module)
+	module.logger.setLevel(logging.WARNING)
+	for handler in logging.getLogger().handlers:
+		if type(handler) is logging.StreamHandler: handler.setStream(sys.stderr)
+	return module
+
+
+class PhaseProfiler:
+	# Pilha de fases: o tempo, os processos e os comandos contam so para a fase mais interior; o pico de memoria (tracemalloc)
+	# de uma fase inclui o das fases aninhadas
+	def __init__(self, memory):
+		self.memory = memory; self.stack = []; self.totals = {}
+
+	def _metrics(self, phase):
+		return self.totals.setdefault(phase, {'wall_ms': 0.0, 'spawns': 0, 'commands': 0, 'peak_kib': 0.0})
+
+	def _charge_time(self):
+		now = time.perf_counter()
+		if self.stack: self._metrics(self.stack[-1][0])['wall_ms'] += (now - self.stack[-1][1]) * 1000; self.stack[-1][1] = now
+		return now
+
+	def _charge_peak(self, phase):
+		if not self.memory: return 0.0
+		peak = tracemalloc.get_traced_memory()[1] / 1024; tracemalloc.reset_peak()
+		metrics = self._metrics(phase); metrics['peak_kib'] = max(metrics['peak_kib'], peak)
+		return peak
+
+	def enter(self, phase):
+		if self.stack: self._charge_peak(self.stack[-1][0])
+		elif self.memory: tracemalloc.reset_peak()
+		self.stack.append([phase, self._charge_time()]); self._metrics(phase)
+
+	def leave(self):
+		self._charge_time(); phase = self.stack.pop()[0]; peak = self._charge_peak(phase)
+		if self.stack: metrics = self._metrics(self.stack[-1][0]); metrics['peak_kib'] = max(metrics['peak_kib'], peak)
+		if self.stack: self.stack[-1][1] = time.perf_counter()
+
+	def count(self, field):
+		if self.stack: self._metrics(self.stack[-1][0])[field] += 1
+
+	def wrap(self, phase, func):
+		def wrapper(*args, **kwargs):
+			self.enter(phase)
+			try: return func(*args, **kwargs)
+			finally: self.leave()
+		return wrapper
+
+
+class CountingSubprocess:
+	# Substitui o modulo subprocess dentro do motor: cada run/Popen conta um processo para a fase corrente
+	def __init__(self, profiler):
+		self._profiler = profiler
+
+	def __getattr__(self, name):
+		return getattr(subprocess, name)
+
+	def run(self, *args, **kwargs):
+		self._profiler.count('spawns'); return subprocess.run(*args, **kwargs)
+
+	def Popen(self, *args, **kwargs):
+		self._profiler.count('spawns'); return subprocess.Popen(*args, **kwargs)
+
+
+def reset_sysfs(work, interfaces):
+	sys_dir = Path(work) / 'sys'; shutil.rmtree(sys_dir, ignore_errors=True)
+	for i in range(interfaces):
+		(sys_dir / f"eth{i}" / 'queues' / 'tx-0').mkdir(parents=True); (sys_dir / f"eth{i}" / 'mtu').write_text("1500\n"); (sys_dir / f"eth{i}" / 'flags').write_text("0x1003\n")
+	for log in ('spawns', 'commands'): (Path(work) / log).write_text('')
+	return str(sys_dir)
+
+
+def run_once(module, conf_path, work, interfaces, apply_mode, memory):
+	sys_dir = reset_sysfs(work, interfaces); profiler = PhaseProfiler(memory)
+	module.subprocess = CountingSubprocess(profiler)
+	engine = module.QoSEngineMacroParserValidated(conf_path, apply_mode=apply_mode, plan_cache=None, live_plan=None)
+	engine.SYS_CLASS_NET = sys_dir
+	for phase, methods in PHASES:
+		for name in methods: setattr(engine, name, profiler.wrap(phase, getattr(engine, name)))
+	run_command = engine._run_command
+	engine._run_command = lambda *args, **kwargs: (profiler.count('commands'), run_command(*args, **kwargs))[1]
+	if memory: tracemalloc.start()
+	result = {}
+	try:
+		for step in STEPS:
+			executed = sum(1 for _ in open(Path(work) / 'commands'))
+			profiler.totals = {}; profiler.enter('other'); ok = engine.start() if step == 'start' else engine.stop(); profiler.leave()
+			phases = profiler.totals
+			result[step] = {'ok': bool(ok), 'wall_ms': sum(p['wall_ms'] for p in phases.values()), 'spawns': sum(p['spawns'] for p in phases.values()),
+							'commands': sum(p['commands'] for p in phases.values()), 'executed': sum(1 for _ in open(Path(work) / 'commands')) - executed,
+							'peak_kib': max(p['peak_kib'] for p in phases.values()), 'phases': phases}
+	finally:
+		if memory: tracemalloc.stop()
+		module.subprocess = subprocess
+	return result
+
+
+def summarize(runs, memory_run):
+	# Mediana do tempo; contagens (deterministicas) e memoria da execucao com tracemalloc
+	summary = {}
+	for step in STEPS:
+		phases = sorted({phase for run in runs for phase in run[step]['phases']})
+		summary[step] = {'ok': all(run[step]['ok'] for run in runs), 'wall_ms': statistics.median(run[step]['wall_ms'] for run in runs),
+						 'spawns': runs[0][step]['spawns'], 'commands': runs[0][step]['commands'], 'executed': runs[0][step]['executed'],
+						 'peak_kib': memory_run[step]['peak_kib'] if memory_run else None, 'phases': {}}
+		for phase in phases:
+			entries = [run[step]['phases'].get(phase, {'wall_ms': 0.0, 'spawns': 0, 'commands': 0}) for run in runs]
+			summary[step]['phases'][phase] = {'wall_ms': statistics.median(e['wall_ms'] for e in entries), 'spawns': entries[0]['spawns'], 'commands': entries[0]['commands'],
+											  'peak_kib': memory_run[step]['phases'].get(phase, {}).get('peak_kib') if memory_run else None}
+	return summary
+
+
+def regressions(report, baseline, threshold, min_delta_ms):
+	# Regressao: fase (ou passo) mais lenta que a base em mais de threshold e min_delta_ms, ou com mais processos/comandos
+	found = []
+	for key, scenario in report['scenarios'].items():
+		base = baseline.get('scenarios', {}).get(key)
+		if not base: continue
+		for step in STEPS:
+			items = [(step, scenario[step], base.get(step, {}))] + [(f"{step}.{phase}", metrics, base.get(step, {}).get('phases', {}).get(phase, {})) for phase, metrics in scenario[step]['phases'].items()]
+			for name, current, previous in items:
+				if 'wall_ms' in previous and current['wall_ms'] > previous['wall_ms'] * (1 + threshold) and current['wall_ms'] - previous['wall_ms'] > min_delta_ms:
+					found.append(f"{key} {name}: {previous['wall_ms']:.1f} -> {current['wall_ms']:.1f} ms")
+				for field in ('spawns', 'commands'):
+					if field in previous and current[field] > previous[field]: found.append(f"{key} {name}: {field} {previous[field]} -> {current[field]}")
+	return found
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark do tempo de aplicacao (start/stop) com tc/ip/modprobe e /sys/class/net falsos")
+	parser.add_argument('--engine', default=str(Path(__file__).resolve().parent.parent / 'qos_engine_macro.py'), help="Ficheiro do motor a medir")
+	parser.add_argument('--interfaces', default='1,4', help="Numeros de interfaces WAN (cada uma com IFB), separados por virgula")
+	parser.add_argument('--services', default='10,200', help="Numeros de servicos, separados por virgula")
+	parser.add_argument('--apply-modes', default=','.join(APPLY_MODES), help="Modos de aplicacao a medir, separados por virgula")
+	parser.add_argument('--classifier', choices=('u32', 'fw'), default='u32', help="Classificador das interfaces sinteticas")
+	parser.add_argument('--runs', type=int, default=3, help="Execucoes por cenario (reporta a mediana do tempo)")
+	parser.add_argument('--no-memory', action='store_true', help="Sem a execucao extra com tracemalloc (pico de memoria por fase)")
+	parser.add_argument('--baseline', help="JSON de uma execucao anterior: falha (codigo 1) se alguma fase regredir")
+	parser.add_argument('--threshold', type=float, default=0.25, help="Com --baseline: aumento relativo de tempo tolerado")
+	parser.add_argument('--min-delta-ms', type=float, default=5.0, help="Com --baseline: aumentos absolutos abaixo disto sao ruido")
+	parser.add_argument('--output', default='-', help="Ficheiro JSON de saida (por omissao stdout)")
+	args = parser.parse_args()
+	modes = [m for m in args.apply_modes.split(',') if m]
+	if any(m not in APPLY_MODES for m in modes): parser.error(f"modos validos: {', '.join(APPLY_MODES)}")
+	if args.runs < 1: parser.error("--runs deve ser >= 1")
+	try: grid = [(int(i), int(s)) for i in args.interfaces.split(',') for s in args.services.split(',')]
+	except ValueError: parser.error("--interfaces e --services sao listas de inteiros")
+	baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+	module = load_engine(args.engine)
+	report = {'params': {'engine': args.engine, 'classifier': args.classifier, 'runs': args.runs, 'python': sys.version.split()[0]}, 'scenarios': {}}
+	with tempfile.TemporaryDirectory(prefix='qos-apply-bench-') as work:
+		bin_dir = Path(work) / 'bin'; bin_dir.mkdir()
+		for tool in ('tc', 'ip', 'modprobe'): (bin_dir / tool).write_text(STAND_IN); (bin_dir / tool).chmod(0o755)
+		os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"; os.environ['QOS_BENCH_DIR'] = work
+		for (interfaces, services), mode in itertools.product(grid, modes):
+			key = f"{mode}/{interfaces}x{services}"
+			conf_text, macros = synthetic_conf(interfaces, services, args.classifier)
+			conf_path = Path(work) / f"{interfaces}x{services}.conf"; conf_path.write_text(conf_text)
+			run_once(module, str(conf_path), work, interfaces, mode, False) # aquecimento (caches do SO e do interpretador), descartado
+			runs = [run_once(module, str(conf_path), work, interfaces, mode, False) for _ in range(args.runs)]
+			memory_run = None if args.no_memory else run_once(module, str(conf_path), work, interfaces, mode, True)
+			report['scenarios'][key] = dict(interfaces=interfaces, services=services, apply_mode=mode, macros=macros, **summarize(runs, memory_run))
+			start = report['scenarios'][key]['start']
+			print(f"{key}: start {start['wall_ms']:.0f} ms ({start['spawns']} processos, {start['commands']} comandos), stop {report['scenarios'][key]['stop']['wall_ms']:.0f} ms" +
+				  ("" if start['ok'] else " [FALHOU]"), file=sys.stderr)
+	report['maxrss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if baseline is not None:
+		report['regressions'] = regressions(report, baseline, args.threshold, args.min_delta_ms)
+		for line in report['regressions']: print(f"REGRESSAO {line}", file=sys.stderr)
+	text = json.dumps(report, indent=1, sort_keys=True) + '\n'
+	if args.output == '-': sys.stdout.write(text)
+	else: Path(args.output).write_text(text)
+	if report.get('regressions') or not all(s[step]['ok'] for s in report['scenarios'].values() for step in STEPS): sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
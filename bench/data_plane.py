@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# Benchmark do plano de dados da hierarquia gerada: o motor aplica um conf sintetico na saida de wan0 (namespace rtr) e um gerador
+# local envia UDP marcado (SO_MARK) por servico para o namespace sink. Mede o debito obtido face a rate/ceil de cada classe, a latencia
+# de fila por classe (carimbo monotonic no payload, relogio comum aos namespaces) e o CPU por pacote a medida que os servicos/filtros
+# crescem, por classificador e topologia.
+import argparse
+import json
+import os
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from download_path import cpu_jiffies, run
+
+NETNS = {'rtr': 'qdp-rtr', 'sink': 'qdp-sink'}
+RTR_ADDR, SINK_ADDR = '10.250.9.1', '10.250.9.2'
+BASE_PORT = 9100
+BASE_MARK = 0x1000 # marcas dos servicos medidos; o enchimento (template) segue-se-lhes
+TOPOLOGIES = ('htb', 'mq')
+CLASSIFIERS = ('u32', 'fw')
+MQ_QUEUES = 4
+
+CONF_TEMPLATE = """macro {{
+	QOS_IF_WAN0_NAME			"wan0"
+	QOS_IF_WAN0_IFB				"ifb_qdp"
+	QOS_IF_WAN0_CLASSIFIER			"{classifier}"
+	QOS_IF_WAN0_TOPOLOGY			"{topology}"
+{leaf}	QOS_IF_WAN0_TOTAL_UPLOAD_BW		"{total}"
+	QOS_IF_WAN0_TOTAL_DOWNLOAD_BW		"{total}"
+	QOS_IF_WAN0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_WAN0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_WAN0_DEFAULT_UPLOAD_CEIL		"{total}"
+	QOS_IF_WAN0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_WAN0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_WAN0_DEFAULT_DOWNLOAD_CEIL	"{total}"
+
+{services}}}
+"""
+
+# Recetor no namespace sink: uma porta por classe; conta pacotes/bytes e o atraso de cada pacote (agora - carimbo do emissor)
+# ate ficar 1s sem receber nada (30s a espera do primeiro). Devolve JSON por porta
+RECEIVER = """import json, select, socket, struct, sys, time
+ports = [int(p) for p in sys.argv[1].split(',')]; poller = select.epoll(); socks = {}; stats = {}
+for port in ports:
+	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22); s.bind(('', port)); s.setblocking(False)
+	socks[s.fileno()] = (s, port); poller.register(s.fileno(), select.EPOLLIN); stats[port] = {'packets': 0, 'bytes': 0, 'first': None, 'last': None, 'delays': []}
+print('ready', flush=True); buf = bytearray(65536); timeout = 30.0
+while True:
+	events = poller.poll(timeout)
+	if not events: break
+	timeout = 1.0
+	for fd, _mask in events:
+		s, port = socks[fd]; st = stats[port]
+		while True:
+			try: n = s.recv_into(buf)
+			except BlockingIOError: break
+			now = time.monotonic_ns(); st['packets'] += 1; st['bytes'] += n; st['last'] = now
+			if st['first'] is None: st['first'] = now
+			if n >= 8: st['delays'].append(now - struct.unpack_from('!Q', buf)[0])
+out = {}
+for port, st in stats.items():
+	delays = sorted(st['delays']); pct = lambda q: delays[min(len(delays) - 1, int(q * len(delays)))] / 1000 if delays else None
+	out[port] = {'packets': st['packets'], 'bytes': st['bytes'], 'seconds': (st['last'] - st['first']) / 1e9 if st['packets'] > 1 else 0,
+				 'delay_us': {'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99), 'max': pct(1.0)}}
+print(json.dumps(out), flush=True)
+"""
+
+# Emissor no namespace rtr: um socket por fluxo com SO_MARK = marca do servico, em round-robin durante N segundos. Nao bloqueante
+# (fila da classe cheia: passa ao fluxo seguinte, todas as classes ficam saturadas) ou bloqueante (um fluxo, mede o custo por pacote)
+SENDER = """import json, socket, struct, sys, time
+dst = sys.argv[1]; size = int(sys.argv[2]); duration = float(sys.argv[3]); blocking = sys.argv[4] == '1'
+flows = [(int(port), int(mark, 0)) for port, mark in (f.split(':') for f in sys.argv[5].split(','))]
+socks = []
+for port, mark in flows:
+	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_MARK', 36), mark); s.setblocking(blocking)
+	socks.append((s, (dst, port)))
+payload = bytearray(max(size, 8)); sent = [0] * len(socks); end = time.monotonic() + duration
+while time.monotonic() < end:
+	for i, (s, addr) in enumerate(socks):
+		for _ in range(16):
+			struct.pack_into('!Q', payload, 0, time.monotonic_ns())
+			try: s.sendto(payload, addr); sent[i] += 1
+			except OSError: break
+print(json.dumps(sent), flush=True)
+"""
+
+
+def netns(name, cmd, check=True):
+	return run(['ip', 'netns', 'exec', NETNS[name]] + cmd, check=check)
+
+
+def setup_topology(queues):
+	teardown_topology()
+	for name in NETNS.values(): run(['ip', 'netns', 'add', name])
+	queue_args = ['numtxqueues', str(queues), 'numrxqueues', str(queues)]
+	run(['ip', 'link', 'add', 'wan0'] + queue_args + ['netns', NETNS['rtr'], 'type', 'veth', 'peer', 'name', 'eth0'] + queue_args + ['netns', NETNS['sink']])
+	for name, dev, address in (('rtr', 'wan0', f"{RTR_ADDR}/24"), ('sink', 'eth0', f"{SINK_ADDR}/24")):
+		netns(name, ['ip', 'addr', 'add', address, 'dev', dev]); netns(name, ['ip', 'link', 'set', dev, 'up']); netns(name, ['ip', 'link', 'set', 'lo', 'up'])
+
+
+def teardown_topology():
+	for name in NETNS.values(): run(['ip', 'netns', 'del', name], check=False)
+
+
+def parse_rate(value):
+	# '100Mbit' -> bit/s (unidades SI do tc)
+	units = {'bit': 1, 'kbit': 10**3, 'mbit': 10**6, 'gbit': 10**9}
+	number = value.lower().rstrip('bit').rstrip('kmg'); return int(float(number) * units[value.lower()[len(number):]])
+
+
+def make_conf(classifier, topology, total, leaf, classes, filler):
+	# classes: [(rate, ceil)] medidas (servico cN, marca BASE_MARK + N, sufixo decimal); filler: servicos extra por template (so filtros/classes)
+	services = [f'\tQOS_SERVICE_LIST\t\t\t"{" ".join(f"c{i}" for i in range(len(classes)))}"\n']
+	for i, (rate, ceil) in enumerate(classes):
+		prefix = f"\tQOS_SRV_c{i}_"
+		services.append(f'{prefix}MARK\t\t\t"{BASE_MARK + i:#x}"\n{prefix}UPLOAD_SUFFIX\t\t"{100 + i}"\n{prefix}UPLOAD_RATE_DEFAULT\t"{rate}"\n{prefix}UPLOAD_CEIL_DEFAULT\t"{ceil}"\n')
+	if filler:
+		first = BASE_MARK + len(classes)
+		services.append(f'\tQOS_TEMPLATE_LIST\t\t"fill"\n\tQOS_TPL_fill_MARKS\t\t"{first:#x}-{first + filler - 1:#x}"\n\tQOS_TPL_fill_UPLOAD_RATE_DEFAULT\t"1kbit"\n\tQOS_TPL_fill_UPLOAD_CEIL_DEFAULT\t"{total}"\n')
+	leaf_macro = f'\tQOS_IF_WAN0_DEFAULT_LEAF_QDISC\t\t"{leaf}"\n' if leaf else ''
+	return CONF_TEMPLATE.format(classifier=classifier, topology=topology, leaf=leaf_macro, total=total, services=''.join(services))
+
+
+def apply_conf(engine, conf_dir, name, text):
+	conf = Path(conf_dir) / f"{name}.conf"; conf.write_text(text)
+	netns('rtr', engine + ['--start', '--no-plan-cache', '--config-file', str(conf)])
+
+
+def clear_conf():
+	# --stop nao le o conf: remover diretamente o estado tc e a IFB do namespace
+	netns('rtr', ['tc', 'qdisc', 'del', 'dev', 'wan0', 'root'], check=False); netns('rtr', ['tc', 'qdisc', 'del', 'dev', 'wan0', 'ingress'], check=False)
+	netns('rtr', ['ip', 'link', 'del', 'ifb_qdp'], check=False)
+
+
+def filter_count():
+	# Filtros instalados em todos os HTB de wan0 (um por fila com mq)
+	handles = [line.split()[2] for line in netns('rtr', ['tc', 'qdisc', 'show', 'dev', 'wan0']).splitlines() if line.startswith('qdisc htb')]
+	return sum(len(re.findall(r'\b(?:flowid|classid) ', netns('rtr', ['tc', 'filter', 'show', 'dev', 'wan0', 'parent', handle]))) for handle in handles)
+
+
+def class_bytes():
+	# Bytes enviados por minor de classe, somados entre HTBs (mq: uma arvore por fila com os mesmos minors)
+	totals = {}
+	for minor, sent in re.findall(r'^class htb [0-9a-f]+:([0-9a-f]+) .*\n Sent (\d+) bytes', netns('rtr', ['tc', '-s', 'class', 'show', 'dev', 'wan0']), re.M):
+		totals[minor] = totals.get(minor, 0) + int(sent)
+	return totals
+
+
+def drive(flows, duration, size, blocking):
+	# flows: [(porta, marca)]; devolve as contagens do emissor, do recetor e o CPU (system+irq+softirq) gasto
+	receiver = subprocess.Popen(['ip', 'netns', 'exec', NETNS['sink'], sys.executable, '-c', RECEIVER, ','.join(str(port) for port, _mark in flows)], stdout=subprocess.PIPE, text=True)
+	try:
+		if receiver.stdout.readline().strip() != 'ready': raise RuntimeError("recetor nao arrancou")
+		jiffies = cpu_jiffies(); started = time.monotonic()
+		sent = json.loads(netns('rtr', [sys.executable, '-c', SENDER, SINK_ADDR, str(size), str(duration), '1' if blocking else '0', ','.join(f"{port}:{mark:#x}" for port, mark in flows)]))
+		elapsed = time.monotonic() - started; cpu_seconds = (cpu_jiffies() - jiffies) / os.sysconf('SC_CLK_TCK')
+		received = {int(port): stats for port, stats in json.loads(receiver.communicate(timeout=duration + 10)[0]).items()}
+	finally:
+		if receiver.poll() is None: receiver.kill()
+	return sent, received, elapsed, cpu_seconds
+
+
+def classify_point(engine, conf_dir, args, topology, classifier, services):
+	# Custo de classificacao: taxas muito acima do debito (o HTB nunca limita), trafego com a marca do ultimo servico (fim da cadeia u32)
+	label = 'none' if services is None else f"{topology}-{classifier}-{services}"
+	if services is not None: apply_conf(engine, conf_dir, label, make_conf(classifier, topology, args.classify_rate, None, [('1Mbit', args.classify_rate)], services - 1))
+	try:
+		flows = [(BASE_PORT, BASE_MARK + (services - 1 if services else 0))]; runs = []
+		for _ in range(args.runs):
+			_sent, received, elapsed, cpu_seconds = drive(flows, args.duration, args.size, True); packets = received[BASE_PORT]['packets']
+			runs.append({'packets': packets, 'pps': packets / elapsed if elapsed else 0, 'cpu_ns_per_pkt': cpu_seconds * 1e9 / packets if packets else None})
+		filters = filter_count() if services is not None else 0
+	finally:
+		if services is not None: clear_conf()
+	median = lambda key: statistics.median(r[key] for r in runs if r[key] is not None) if any(r[key] is not None for r in runs) else None
+	point = {'topology': topology, 'classifier': classifier, 'services': services or 0, 'filters': filters, 'pps': median('pps'), 'cpu_ns_per_pkt': median('cpu_ns_per_pkt'), 'runs': runs}
+	print(f"classify {label}: {point['pps'] or 0:.0f} pps, {point['cpu_ns_per_pkt'] or 0:.0f} ns CPU/pacote, {filters} filtros", file=sys.stderr)
+	return point
+
+
+def class_result(index, rate, ceil, stats, classified):
+	achieved = stats['bytes'] * 8 / stats['seconds'] if stats['seconds'] else 0
+	return {'classified_bytes': classified, 'service': f"c{index}", 'mark': BASE_MARK + index, 'rate_bps': parse_rate(rate), 'ceil_bps': parse_rate(ceil), 'achieved_bps': achieved,
+			'of_rate': achieved / parse_rate(rate), 'of_ceil': achieved / parse_rate(ceil), 'packets': stats['packets'], 'delay_us': stats['delay_us']}
+
+
+def shaping_point(engine, conf_dir, args, topology, classifier, classes):
+	# Cada classe sozinha (deve chegar ao ceil) e todas em simultaneo (cada uma pelo menos a sua rate, soma ate a banda total)
+	apply_conf(engine, conf_dir, f"shape-{topology}-{classifier}", make_conf(classifier, topology, args.total, args.leaf, classes, args.filler))
+	results = []
+	try:
+		flows = [(BASE_PORT + i, BASE_MARK + i) for i in range(len(classes))]
+		for scenario, active in [(f"solo-c{i}", [i]) for i in range(len(classes))] + [('all', list(range(len(classes))))]:
+			before = class_bytes(); _sent, received, _elapsed, _cpu = drive([flows[i] for i in active], args.duration, args.size, False); after = class_bytes()
+			classified = {i: after.get(str(100 + i), 0) - before.get(str(100 + i), 0) for i in active}
+			entry = {'topology': topology, 'classifier': classifier, 'leaf': args.leaf, 'filler': args.filler, 'scenario': scenario,
+					 'classes': [class_result(i, *classes[i], received[BASE_PORT + i], classified[i]) for i in active]}
+			entry['total_bps'] = sum(c['achieved_bps'] for c in entry['classes']); results.append(entry)
+			# Trafego fora da classe esperada (kernel sem cls_fw/CLS_U32_MARK, marca errada): os debitos nao medem a classe
+			misclassified = [c['service'] for c in entry['classes'] if c['classified_bytes'] < c['packets'] * args.size]
+			if misclassified: print(f"AVISO: trafego de {', '.join(misclassified)} nao passou pela classe do servico ({topology}-{classifier} {scenario})", file=sys.stderr)
+			print(f"shaping {topology}-{classifier} {scenario}: " + ', '.join(f"{c['service']} {c['achieved_bps'] / 1e6:.1f}Mbit ({c['of_ceil'] * 100:.0f}% ceil, p99 {c['delay_us']['p99'] or 0:.0f}us)" for c in entry['classes']), file=sys.stderr)
+	finally: clear_conf()
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark do plano de dados (debito por classe, latencia de fila, CPU por pacote) em network namespaces")
+	parser.add_argument('--engine', default=f"{sys.executable} {Path(__file__).resolve().parent.parent / 'qos_engine_macro.py'}", help="Comando do motor (executado no namespace do router)")
+	parser.add_argument('--topologies', default='htb', help=f"Topologias, separadas por virgula ({', '.join(TOPOLOGIES)}; mq usa {MQ_QUEUES} filas no veth)")
+	parser.add_argument('--classifiers', default=','.join(CLASSIFIERS), help="Classificadores, separados por virgula")
+	parser.add_argument('--services', default='1,100,1000', help="Numeros de servicos (filtros) para o teste de custo de classificacao")
+	parser.add_argument('--classify-rate', default="10Gbit", help="Banda configurada no teste de classificacao (acima do debito real)")
+	parser.add_argument('--classes', default="10Mbit:40Mbit,20Mbit:60Mbit,30Mbit:100Mbit", help="Classes medidas no teste de shaping, rate:ceil separadas por virgula")
+	parser.add_argument('--total', default="100Mbit", help="Banda total no teste de shaping")
+	parser.add_argument('--filler', type=int, default=0, help="Servicos extra (sem trafego) no teste de shaping")
+	parser.add_argument('--leaf', choices=('fq_codel', 'cake', 'sfq', 'pfifo'), help="Qdisc folha das classes no teste de shaping (por omissao a do kernel)")
+	parser.add_argument('--tests', default='classify,shaping', help="Testes a executar, separados por virgula")
+	parser.add_argument('--duration', type=float, default=3.0, help="Segundos de trafego por medicao")
+	parser.add_argument('--runs', type=int, default=3, help="Execucoes por ponto do teste de classificacao (reporta a mediana)")
+	parser.add_argument('--size', type=int, default=1200, help="Tamanho do payload UDP em bytes")
+	parser.add_argument('--output', default='-', help="Ficheiro JSON de saida (por omissao stdout)")
+	args = parser.parse_args()
+	topologies = [t for t in args.topologies.split(',') if t]; classifiers = [c for c in args.classifiers.split(',') if c]; tests = [t for t in args.tests.split(',') if t]
+	if any(t not in TOPOLOGIES for t in topologies): parser.error(f"topologias validas: {', '.join(TOPOLOGIES)}")
+	if any(c not in CLASSIFIERS for c in classifiers): parser.error(f"classificadores validos: {', '.join(CLASSIFIERS)}")
+	if any(t not in ('classify', 'shaping') for t in tests): parser.error("testes validos: classify, shaping")
+	try: services = [int(s) for s in args.services.split(',') if s]; classes = [tuple(c.split(':')) for c in args.classes.split(',') if c]; [parse_rate(v) for c in classes for v in c]
+	except (ValueError, KeyError): parser.error("--services e uma lista de inteiros e --classes uma lista rate:ceil (ex: 10Mbit:40Mbit)")
+	if any(s < 1 for s in services) or any(len(c) != 2 for c in classes): parser.error("--services >= 1 e --classes no formato rate:ceil")
+	if os.geteuid() != 0: parser.error("executar como root")
+	engine = shlex.split(args.engine)
+	report = {'params': {k: getattr(args, k) for k in ('duration', 'runs', 'size', 'total', 'classify_rate', 'leaf', 'filler')} | {'classes': args.classes, 'cpus': os.cpu_count(), 'mq_queues': MQ_QUEUES},
+			  'classify': [], 'shaping': []}
+	with tempfile.TemporaryDirectory(prefix='qos-dp-bench-') as conf_dir:
+		try:
+			setup_topology(MQ_QUEUES if 'mq' in topologies else 1)
+			if 'classify' in tests:
+				report['classify'].append(classify_point(engine, conf_dir, args, None, None, None))
+				for topology in topologies:
+					for classifier in classifiers:
+						for count in services: report['classify'].append(classify_point(engine, conf_dir, args, topology, classifier, count))
+			if 'shaping' in tests:
+				for topology in topologies:
+					for classifier in classifiers: report['shaping'] += shaping_point(engine, conf_dir, args, topology, classifier, classes)
+		finally: teardown_topology()
+	text = json.dumps(report, indent=1, sort_keys=True) + '\n'
+	if args.output == '-': sys.stdout.write(text)
+	else: Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Benchmark do caminho de download: pacotes/s e CPU por pacote no router, sem QoS, com IFB (redirect no ingress da WAN)
+# e com o modo lan (shaping na saida da interface LAN). Topologia em network namespaces: wan -> rtr -> lan.
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MODES = ('none', 'ifb', 'lan')
+NETNS = {'wan': 'qbench-wan', 'rtr': 'qbench-rtr', 'lan': 'qbench-lan'}
+WAN_NET, LAN_NET = '10.250.1', '10.250.2'
+PORT = 9000
+
+# Conf minimo: uma WAN, um servico e a classe default com ceil = banda toda (o shaping nunca e o gargalo, mede-se o custo do caminho)
+CONF_TEMPLATE = """zone {{
+	localhost
+	public		wan0
+	internal	lan0
+}}
+
+macro {{
+{mode_macros}	QOS_IF_WAN0_NAME			"wan0"
+	QOS_IF_WAN0_TOTAL_UPLOAD_BW		"{rate}"
+	QOS_IF_WAN0_TOTAL_DOWNLOAD_BW		"{rate}"
+	QOS_IF_WAN0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_WAN0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_WAN0_DEFAULT_UPLOAD_CEIL		"{rate}"
+	QOS_IF_WAN0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_WAN0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_WAN0_DEFAULT_DOWNLOAD_CEIL	"{rate}"
+
+	QOS_SERVICE_LIST	"bench"
+	QOS_SRV_bench_MARK			"0x10"
+	QOS_SRV_bench_DOWNLOAD_SUFFIX		"10"
+	QOS_SRV_bench_DOWNLOAD_RATE_DEFAULT	"1Mbit"
+	QOS_SRV_bench_DOWNLOAD_CEIL_DEFAULT	"{rate}"
+}}
+"""
+MODE_MACROS = {
+	'ifb': '\tQOS_IF_WAN0_IFB			"ifb_bench"\n',
+	# Uma so WAN: mascara 0, todo o trafego e despachado para a subarvore da wan0 sem precisar de bits de WAN no conntrack
+	'lan': '\tQOS_DOWNLOAD_MODE		"lan"\n\tQOS_LAN_IFACE			"lan0"\n\tQOS_LAN_WAN_MARK_MASK		"0x0"\n\tQOS_IF_WAN0_LAN_MARK		"0x0"\n',
+}
+
+# Recetor no namespace lan: conta datagramas ate ficar 1s sem receber nada (30s a espera do primeiro)
+RECEIVER = """import socket, sys
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+s.bind(('', int(sys.argv[1]))); print('ready', flush=True); n = 0; buf = bytearray(2048); s.settimeout(30.0)
+try:
+	while True: s.recv_into(buf); n += 1; s.settimeout(1.0)
+except socket.timeout: pass
+print(n, flush=True)
+"""
+
+# Emissor no namespace wan: rajada UDP durante N segundos
+SENDER = """import socket, sys, time
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); payload = b'x' * int(sys.argv[3]); dst = (sys.argv[1], int(sys.argv[2]))
+end = time.monotonic() + float(sys.argv[4]); n = 0
+while time.monotonic() < end:
+	for _ in range(64):
+		try: s.sendto(payload, dst); n += 1
+		except OSError: pass
+print(n, flush=True)
+"""
+
+
+def run(cmd, check=True):
+	result = subprocess.run(cmd, capture_output=True, text=True)
+	if check and result.returncode != 0: raise RuntimeError(f"{' '.join(cmd)}: {(result.stderr.strip() or result.stdout.strip())[-2000:]}")
+	return result.stdout
+
+
+def netns(name, cmd, check=True):
+	return run(['ip', 'netns', 'exec', NETNS[name]] + cmd, check=check)
+
+
+def setup_topology():
+	teardown_topology()
+	for name in NETNS.values(): run(['ip', 'netns', 'add', name])
+	run(['ip', 'link', 'add', 'wan0', 'netns', NETNS['rtr'], 'type', 'veth', 'peer', 'name', 'eth0', 'netns', NETNS['wan']])
+	run(['ip', 'link', 'add', 'lan0', 'netns', NETNS['rtr'], 'type', 'veth', 'peer', 'name', 'eth0', 'netns', NETNS['lan']])
+	for name, dev, address in (('wan', 'eth0', f"{WAN_NET}.2/24"), ('rtr', 'wan0', f"{WAN_NET}.1/24"), ('rtr', 'lan0', f"{LAN_NET}.1/24"), ('lan', 'eth0', f"{LAN_NET}.2/24")):
+		netns(name, ['ip', 'addr', 'add', address, 'dev', dev]); netns(name, ['ip', 'link', 'set', dev, 'up'])
+	for name in NETNS: netns(name, ['ip', 'link', 'set', 'lo', 'up'])
+	netns('wan', ['ip', 'route', 'add', 'default', 'via', f"{WAN_NET}.1"])
+	netns('lan', ['ip', 'route', 'add', 'default', 'via', f"{LAN_NET}.1"])
+	netns('rtr', ['sysctl', '-qw', 'net.ipv4.ip_forward=1'])
+
+
+def teardown_topology():
+	for name in NETNS.values(): run(['ip', 'netns', 'del', name], check=False)
+
+
+def cpu_jiffies():
+	# system + irq + softirq de todos os CPUs: o forwarding e o shaping correm em softirq (e em system no emissor/recetor)
+	fields = Path('/proc/stat').read_text().splitlines()[0].split()[1:]
+	return int(fields[2]) + int(fields[5]) + int(fields[6])
+
+
+def apply_mode(engine, mode, conf_dir, rate):
+	if mode == 'none': return
+	conf = Path(conf_dir) / f"{mode}.conf"
+	conf.write_text(CONF_TEMPLATE.format(mode_macros=MODE_MACROS[mode], rate=rate))
+	netns('rtr', engine + ['--start', '--no-plan-cache', '--config-file', str(conf)])
+
+
+def clear_mode(engine, mode, conf_dir):
+	if mode == 'none': return
+	netns('rtr', engine + ['--stop', '--config-file', str(Path(conf_dir) / f"{mode}.conf")], check=False)
+	# --stop nao le o conf: garantir um router limpo para o modo seguinte
+	for dev in ('wan0', 'lan0'):
+		netns('rtr', ['tc', 'qdisc', 'del', 'dev', dev, 'root'], check=False); netns('rtr', ['tc', 'qdisc', 'del', 'dev', dev, 'ingress'], check=False)
+	netns('rtr', ['ip', 'link', 'del', 'ifb_bench'], check=False)
+
+
+def measure(duration, size):
+	receiver = subprocess.Popen(['ip', 'netns', 'exec', NETNS['lan'], sys.executable, '-c', RECEIVER, str(PORT)], stdout=subprocess.PIPE, text=True)
+	try:
+		if receiver.stdout.readline().strip() != 'ready': raise RuntimeError("recetor nao arrancou")
+		jiffies = cpu_jiffies(); started = time.monotonic()
+		sent = int(netns('wan', [sys.executable, '-c', SENDER, f"{LAN_NET}.2", str(PORT), str(size), str(duration)]).strip() or 0)
+		elapsed = time.monotonic() - started; cpu_seconds = (cpu_jiffies() - jiffies) / os.sysconf('SC_CLK_TCK')
+		received = int(receiver.communicate(timeout=duration + 10)[0].strip() or 0)
+	finally:
+		if receiver.poll() is None: receiver.kill()
+	return {'sent': sent, 'received': received, 'seconds': elapsed, 'pps': received / elapsed if elapsed else 0,
+			'cpu_ns_per_pkt': cpu_seconds * 1e9 / received if received else None}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark do caminho de download (sem QoS, IFB, modo lan) em network namespaces")
+	parser.add_argument('--engine', default=f"{sys.executable} {Path(__file__).resolve().parent.parent / 'qos_engine_macro.py'}", help="Comando do motor (executado no namespace do router)")
+	parser.add_argument('--modes', default=','.join(MODES), help="Modos a medir, separados por virgula")
+	parser.add_argument('--duration', type=float, default=5.0, help="Segundos de trafego por execucao")
+	parser.add_argument('--runs', type=int, default=3, help="Execucoes por modo (reporta a mediana)")
+	parser.add_argument('--size', type=int, default=64, help="Tamanho do payload UDP em bytes")
+	parser.add_argument('--rate', default="10Gbit", help="Banda configurada (acima do debito real, para o HTB nao limitar)")
+	parser.add_argument('--output', default='-', help="Ficheiro JSON de saida (por omissao stdout)")
+	args = parser.parse_args()
+	modes = [m for m in args.modes.split(',') if m]
+	if any(m not in MODES for m in modes): parser.error(f"modos validos: {', '.join(MODES)}")
+	if os.geteuid() != 0: parser.error("executar como root")
+	engine = shlex.split(args.engine); report = {'params': {'duration': args.duration, 'runs': args.runs, 'size': args.size, 'rate': args.rate, 'cpus': os.cpu_count()}, 'modes': {}}
+	with tempfile.TemporaryDirectory(prefix='qos-bench-') as conf_dir:
+		try:
+			setup_topology()
+			for mode in modes:
+				apply_mode(engine, mode, conf_dir, args.rate)
+				try: runs = [measure(args.duration, args.size) for _ in range(args.runs)]
+				finally: clear_mode(engine, mode, conf_dir)
+				median = lambda key: statistics.median(r[key] for r in runs if r[key] is not None) if any(r[key] is not None for r in runs) else None
+				report['modes'][mode] = {'pps': median('pps'), 'cpu_ns_per_pkt': median('cpu_ns_per_pkt'), 'runs': runs}
+				print(f"{mode}: {report['modes'][mode]['pps']:.0f} pps, {report['modes'][mode]['cpu_ns_per_pkt'] or 0:.0f} ns CPU/pacote", file=sys.stderr)
+		finally: teardown_topology()
+	text = json.dumps(report, indent=1, sort_keys=True) + '\n'
+	if args.output == '-': sys.stdout.write(text)
+	else: Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+	main()
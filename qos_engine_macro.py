@@ -7,13 +7,26 @@ import sys
 import os
 from pathlib import Path
 import shlex
+import json
 import time
 import re
+import socket
+import struct
+import errno
+import copy
+import contextlib
+import hashlib
+import threading
+import select
+import signal
+import ctypes
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuração de Logging
 LOG_FILE = "/var/log/foomuuri-qos-macro.log"
 logging.basicConfig(
-	level=logging.INFO, # Mudar para logging.DEBUG para ver todos os detalhes de parsing
+	level=logging.INFO, # --log-level DEBUG para ver todos os detalhes de parsing (mensagens DEBUG formatadas so quando emitidas)
 	format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
 	handlers=[
 		logging.FileHandler(LOG_FILE),
@@ -22,36 +35,1069 @@ logging.basicConfig(
 )
 logger = logging.getLogger("QoSMacroParserValidated")
 
+_log_buffer = threading.local()
+
+class _WorkerLogBuffer(logging.Filter):
+	# Nos workers paralelos os registos ficam retidos e sao emitidos em bloco (por interface) pela thread principal
+	def filter(self, record):
+		records = getattr(_log_buffer, 'records', None)
+		if records is None: return True
+		records.append(record); return False
+
+logger.addFilter(_WorkerLogBuffer())
+
+class Tracer:
+	# Spans temporizados (fase, interface, batch, comando) no formato Chrome trace event ('X': evento completo, tempos em us),
+	# legivel no Perfetto / chrome://tracing. Partilhado pelos workers paralelos (list.append e atomico); tid = thread do worker
+	MAX_EVENTS = 200000 # o daemon acumula spans ate sair: acima disto so se contam os descartados
+
+	def __init__(self):
+		self.events = []; self.dropped = 0; self.origin = time.perf_counter_ns(); self.pid = os.getpid()
+
+	@contextlib.contextmanager
+	def span(self, name, cat, **args):
+		# O dicionario args e devolvido ao bloco, que pode acrescentar resultados (codigo de saida, contagens) antes de o span fechar
+		started = time.perf_counter_ns()
+		try: yield args
+		except BaseException as e: args['error'] = repr(e); raise
+		finally:
+			if len(self.events) < self.MAX_EVENTS: self.events.append({'name': name, 'cat': cat, 'ph': 'X', 'ts': (started - self.origin) / 1000, 'dur': (time.perf_counter_ns() - started) / 1000, 'pid': self.pid, 'tid': threading.get_native_id(), 'args': args})
+			else: self.dropped += 1
+
+	def totals(self, cat):
+		# Tempo total (ms) por nome de span de uma categoria, por ordem decrescente
+		totals = {}
+		for event in self.events:
+			if event['cat'] == cat: totals[event['name']] = totals.get(event['name'], 0) + event['dur'] / 1000
+		return {name: round(ms, 3) for name, ms in sorted(totals.items(), key=lambda item: -item[1])}
+
+	def write(self, path):
+		data = {'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': {'dropped': self.dropped, 'phases_ms': self.totals('phase'), 'commands_ms': self.totals('cmd')}}
+		Path(path).write_text(json.dumps(data) + '\n')
+
+class RtnlError(Exception):
+	pass
+
+class RtnlTransportError(RtnlError):
+	# Socket sem resposta do kernel (timeout) ou com respostas perdidas (ENOBUFS): o estado do pedido e desconhecido
+	pass
+
+class RtnlBackend:
+	# Backend rtnetlink nativo: traduz o subconjunto de comandos tc/ip gerado pelo motor em mensagens netlink
+	# enviadas por um unico socket AF_NETLINK, em pipeline e com ACK por mensagem.
+	RTM_NEWLINK, RTM_DELLINK, RTM_GETLINK = 16, 17, 18
+	RTM_NEWQDISC, RTM_DELQDISC = 36, 37
+	RTM_NEWTCLASS, RTM_DELTCLASS = 40, 41
+	RTM_NEWTFILTER, RTM_DELTFILTER, RTM_GETTFILTER = 44, 45, 46
+	RTM_GETQDISC, RTM_GETTCLASS = 38, 42
+	NLM_F_REQUEST, NLM_F_ACK, NLM_F_REPLACE, NLM_F_EXCL, NLM_F_CREATE = 0x1, 0x4, 0x100, 0x200, 0x400
+	NLM_F_DUMP = 0x300
+	NLM_F_ACK_TLVS = 0x200
+	NLMSG_ERROR, NLMSG_DONE = 2, 3
+	NLA_TYPE_MASK = 0x3fff
+	RTMGRP_LINK = 0x1
+	NLA_F_NESTED = 0x8000
+	NETLINK_CAP_ACK, NETLINK_EXT_ACK = 10, 11
+	IFLA_IFNAME, IFLA_LINKINFO, IFLA_INFO_KIND = 3, 18, 1
+	IFF_UP = 0x1
+	TCA_KIND, TCA_OPTIONS, TCA_XSTATS, TCA_STATS2, TCA_CHAIN = 1, 2, 4, 7, 11
+	TCA_STATS_BASIC, TCA_STATS_QUEUE, TCA_STATS_APP, TCA_STATS_PKT64 = 1, 3, 4, 8
+	TCA_HTB_PARMS, TCA_HTB_INIT, TCA_HTB_RATE64, TCA_HTB_CEIL64 = 1, 2, 6, 7
+	TCA_U32_CLASSID, TCA_U32_HASH, TCA_U32_LINK, TCA_U32_DIVISOR, TCA_U32_SEL, TCA_U32_ACT, TCA_U32_PCNT, TCA_U32_MARK, TCA_U32_FLAGS = 1, 2, 3, 4, 5, 7, 9, 10, 11
+	TCA_FW_CLASSID = 1
+	TCA_CLS_FLAGS_SKIP = 0x3 # TCA_CLS_FLAGS_SKIP_HW | TCA_CLS_FLAGS_SKIP_SW
+	IFLA_NUM_TX_QUEUES, IFLA_NUM_RX_QUEUES = 31, 32
+	TCA_FQ_CODEL_TARGET, TCA_FQ_CODEL_INTERVAL, TCA_FQ_CODEL_FLOWS, TCA_FQ_CODEL_MEMORY_LIMIT = 1, 3, 5, 9
+	TCA_CAKE_RTT, TCA_CAKE_MEMORY = 7, 10
+	TCA_ACT_KIND, TCA_ACT_OPTIONS = 1, 2
+	TCA_MIRRED_PARMS = 2
+	TCA_CTINFO_ACT, TCA_CTINFO_PARMS_CPMARK_MASK = 3, 7
+	TC_H_ROOT, TC_H_INGRESS = 0xFFFFFFFF, 0xFFFFFFF1
+	TC_U32_TERMINAL = 0x1
+	TC_ACT_UNSPEC, TC_ACT_PIPE, TC_ACT_STOLEN = -1, 3, 4
+	TC_ACT_CONTROLS = {'continue': TC_ACT_UNSPEC, 'pipe': TC_ACT_PIPE} # 'continue': o filtro nao decide, a classificacao segue para a prio seguinte
+	TCA_EGRESS_REDIR = 1
+	TC_LINKLAYER_ETHERNET = 1
+	HTB_MTU = 1600
+	PIPELINE_DEPTH = 64
+	# Segundos sem resposta do kernel ate o pedido ser dado como perdido (RtnlTransportError) em vez de bloquear
+	RECV_TIMEOUT = 5.0
+	# Verbos tc -> flags netlink (iguais aos do iproute2)
+	TC_VERB_FLAGS = {'add': NLM_F_EXCL | NLM_F_CREATE, 'change': 0, 'replace': NLM_F_CREATE | NLM_F_REPLACE}
+
+	def __init__(self):
+		self._sock = None
+		self._seq = 0
+		self._tick_in_usec, self._hz = self._read_psched()
+
+	def _read_psched(self):
+		# Mesmo calculo que o tc_core_init()/get_hz() do iproute2, para que buffer/cbuffer coincidam com o tc
+		try:
+			t2us, us2t, clock_res, hz = (int(x, 16) for x in Path("/proc/net/psched").read_text().split()[:4])
+		except (OSError, ValueError):
+			return 1.0, 100
+		if clock_res == 1000000000: t2us = us2t
+		return (t2us / us2t) * (clock_res / 1000000), (hz if clock_res == 1000000 else 100)
+
+	def _socket(self):
+		if self._sock is None:
+			sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE)
+			for opt in (self.NETLINK_CAP_ACK, self.NETLINK_EXT_ACK):
+				try: sock.setsockopt(270, opt, 1) # SOL_NETLINK
+				except OSError: pass
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+			sock.settimeout(self.RECV_TIMEOUT)
+			sock.bind((0, 0))
+			self._sock = sock
+		return self._sock
+
+	def open(self):
+		# Abre ja o socket (workers paralelos): sem socket e como sem resposta do kernel, o chamador passa a tc/ip
+		try: self._socket()
+		except OSError as e: self.close(); raise RtnlTransportError(f"socket netlink: {e}") from e
+
+	def close(self):
+		if self._sock is not None: self._sock.close(); self._sock = None
+
+	# --- Codificacao ---
+	def _attr(self, attr_type, payload):
+		length = 4 + len(payload)
+		return struct.pack('=HH', length, attr_type) + payload + b'\0' * ((4 - length % 4) % 4)
+
+	def _nest(self, attr_type, *attrs):
+		return self._attr(attr_type | self.NLA_F_NESTED, b''.join(attrs))
+
+	def message(self, msg_type, flags, body):
+		self._seq += 1
+		return self._seq, struct.pack('=IHHII', 16 + len(body), msg_type, flags | self.NLM_F_REQUEST | self.NLM_F_ACK, self._seq, 0) + body
+
+	def _tcmsg(self, ifindex, handle, parent, info=0):
+		return struct.pack('=BxxxiIII', socket.AF_UNSPEC, ifindex, handle, parent, info)
+
+	def _ifinfomsg(self, ifindex=0, flags=0, change=0):
+		return struct.pack('=BxHiII', socket.AF_UNSPEC, 0, ifindex, flags, change)
+
+	# --- Envio/receção ---
+	def _send(self, data):
+		try: self._socket().sendall(data)
+		except OSError as e: self.close(); raise RtnlTransportError(f"envio netlink: {e}") from e
+
+	def _recv(self):
+		# Timeout ou ENOBUFS (buffer de rececao cheio, respostas perdidas): os ACKs em falta ja nao sao fiaveis e o socket e descartado
+		try: return self._socket().recv(1 << 16)
+		except socket.timeout as e: self.close(); raise RtnlTransportError(f"sem resposta do kernel em {self.RECV_TIMEOUT:g}s") from e
+		except OSError as e: self.close(); raise RtnlTransportError(f"rececao netlink: {e}", e.errno) from e
+
+	def _recv_acks(self, pending):
+		# Recolhe (errno, mensagem extack) de cada NLMSG_ERROR/ACK das sequencias pendentes
+		replies = {}
+		while len(replies) < len(pending):
+			data = self._recv(); offset = 0
+			while offset + 16 <= len(data):
+				length, msg_type, flags, seq, _pid = struct.unpack_from('=IHHII', data, offset)
+				if length < 16: break
+				if seq in pending and seq not in replies and msg_type == self.NLMSG_ERROR:
+					error = -struct.unpack_from('=i', data, offset + 16)[0]
+					replies[seq] = (error, self._ext_ack_message(data, offset, length, flags) if error else '')
+				offset += (length + 3) & ~3
+		return replies
+
+	def _ext_ack_message(self, data, offset, length, flags):
+		if not flags & self.NLM_F_ACK_TLVS: return ''
+		pos = offset + 16 + 4 + 16 # nlmsgerr com a mensagem original truncada (NETLINK_CAP_ACK)
+		while pos + 4 <= offset + length:
+			attr_len, attr_type = struct.unpack_from('=HH', data, pos)
+			if attr_len < 4: break
+			if attr_type == 1: return data[pos + 4:pos + attr_len].rstrip(b'\0').decode(errors='replace')
+			pos += (attr_len + 3) & ~3
+		return ''
+
+	def request(self, messages):
+		# Envia as mensagens em pipeline (PIPELINE_DEPTH por sendmsg) e devolve [(errno, texto)] na mesma ordem
+		results = []
+		for start in range(0, len(messages), self.PIPELINE_DEPTH):
+			chunk = messages[start:start + self.PIPELINE_DEPTH]
+			self._send(b''.join(raw for _seq, raw in chunk))
+			replies = self._recv_acks({seq: None for seq, _raw in chunk})
+			for seq, _raw in chunk:
+				results.append(replies[seq])
+		return results
+
+	def link_index(self, name):
+		seq, raw = self.message(self.RTM_GETLINK, 0, self._ifinfomsg() + self._attr(self.IFLA_IFNAME, name.encode() + b'\0'))
+		self._send(raw)
+		while True:
+			data = self._recv(); offset = 0
+			while offset + 16 <= len(data):
+				length, msg_type, _flags, reply_seq, _pid = struct.unpack_from('=IHHII', data, offset)
+				if length < 16: return None
+				if reply_seq == seq:
+					if msg_type == self.RTM_NEWLINK: index = struct.unpack_from('=BxHiII', data, offset + 16)[2]; self._drain_ack(seq); return index
+					if msg_type == self.NLMSG_ERROR:
+						error = -struct.unpack_from('=i', data, offset + 16)[0]
+						if error in (errno.ENODEV, errno.ENOENT): return None
+						if error: raise RtnlError(f"RTM_GETLINK {name}: {os.strerror(error)}")
+						# ACK sem RTM_NEWLINK antes: resposta fora de ordem, o socket ja nao e fiavel
+						self.close(); raise RtnlTransportError(f"RTM_GETLINK {name}: ACK sem dados do dispositivo")
+				offset += (length + 3) & ~3
+
+	def _drain_ack(self, seq):
+		# RTM_GETLINK com NLM_F_ACK responde com os dados seguidos de um ACK; consumi-lo para nao o confundir com o seguinte
+		self._recv_acks({seq: None})
+
+	# --- Estatisticas (dump) ---
+	def dump(self, msg_type, body):
+		# Pedido NLM_F_DUMP (sem ACK): devolve o corpo de cada mensagem da resposta ate NLMSG_DONE
+		self._seq += 1; seq = self._seq
+		self._send(struct.pack('=IHHII', 16 + len(body), msg_type, self.NLM_F_REQUEST | self.NLM_F_DUMP, seq, 0) + body)
+		replies = []
+		while True:
+			data = self._recv(); offset = 0
+			while offset + 16 <= len(data):
+				length, reply_type, _flags, reply_seq, _pid = struct.unpack_from('=IHHII', data, offset)
+				if length < 16: return replies
+				if reply_seq == seq:
+					if reply_type == self.NLMSG_DONE: return replies
+					if reply_type == self.NLMSG_ERROR:
+						error = -struct.unpack_from('=i', data, offset + 16)[0]
+						if error: raise RtnlError(f"dump {msg_type}: {os.strerror(error)}")
+						return replies
+					replies.append(data[offset + 16:offset + length])
+				offset += (length + 3) & ~3
+
+	def _parse_attrs(self, data, pos, end):
+		attrs = {}
+		while pos + 4 <= end:
+			attr_len, attr_type = struct.unpack_from('=HH', data, pos)
+			if attr_len < 4: break
+			attrs[attr_type & self.NLA_TYPE_MASK] = data[pos + 4:pos + attr_len]
+			pos += (attr_len + 3) & ~3
+		return attrs
+
+	def _format_handle(self, value):
+		if value == self.TC_H_ROOT: return 'root'
+		if value == self.TC_H_INGRESS: return 'ingress'
+		return f"{value >> 16:x}:{value & 0xffff:x}" if value & 0xffff else f"{value >> 16:x}:"
+
+	def _parse_tc_stats(self, payload):
+		# tcmsg + TCA_KIND + TCA_STATS2 (basic/queue/pkt64) + xstats HTB (lends, borrows, giants, tokens, ctokens)
+		_family, ifindex, handle, parent, _info = struct.unpack_from('=BxxxiIII', payload, 0)
+		attrs = self._parse_attrs(payload, 20, len(payload))
+		entry = {'ifindex': ifindex, 'handle': self._format_handle(handle), 'parent': self._format_handle(parent),
+				 'kind': attrs.get(self.TCA_KIND, b'').rstrip(b'\0').decode(errors='replace')}
+		stats = self._parse_attrs(attrs.get(self.TCA_STATS2, b''), 0, len(attrs.get(self.TCA_STATS2, b'')))
+		if len(stats.get(self.TCA_STATS_BASIC, b'')) >= 12: entry['bytes'], entry['packets'] = struct.unpack_from('=QI', stats[self.TCA_STATS_BASIC])
+		if len(stats.get(self.TCA_STATS_PKT64, b'')) >= 8: entry['packets'] = struct.unpack_from('=Q', stats[self.TCA_STATS_PKT64])[0]
+		if len(stats.get(self.TCA_STATS_QUEUE, b'')) >= 20:
+			entry['qlen'], entry['backlog'], entry['drops'], entry['requeues'], entry['overlimits'] = struct.unpack_from('=IIIII', stats[self.TCA_STATS_QUEUE])
+		xstats = stats.get(self.TCA_STATS_APP, attrs.get(self.TCA_XSTATS, b''))
+		if entry['kind'] == 'htb' and handle & 0xffff and len(xstats) >= 20:
+			entry['lends'], entry['borrows'], entry['giants'], entry['tokens'], entry['ctokens'] = struct.unpack_from('=IIIii', xstats)
+		if entry['kind'] == 'htb' and handle & 0xffff:
+			# Taxas em vigor no kernel (tc_htb_opt: ratespec rate em +8, ceil em +20; RATE64/CEIL64 acima de 4 GB/s), em bit/s
+			options = self._parse_attrs(attrs.get(self.TCA_OPTIONS, b''), 0, len(attrs.get(self.TCA_OPTIONS, b'')))
+			parms = options.get(self.TCA_HTB_PARMS, b'')
+			if len(parms) >= 24:
+				rate, ceil = struct.unpack_from('=I', parms, 8)[0], struct.unpack_from('=I', parms, 20)[0]
+				if len(options.get(self.TCA_HTB_RATE64, b'')) >= 8: rate = struct.unpack_from('=Q', options[self.TCA_HTB_RATE64])[0]
+				if len(options.get(self.TCA_HTB_CEIL64, b'')) >= 8: ceil = struct.unpack_from('=Q', options[self.TCA_HTB_CEIL64])[0]
+				entry['htb_rate'], entry['htb_ceil'] = rate * 8, ceil * 8
+		return entry
+
+	def tc_stats(self, ifindexes, qdiscs=True):
+		# Um unico dump de qdiscs (todas as interfaces) e um dump de classes por interface, tudo no mesmo socket
+		stats = {index: {'qdiscs': [], 'classes': []} for index in ifindexes}
+		for payload in (self.dump(self.RTM_GETQDISC, self._tcmsg(0, 0, 0)) if qdiscs else []):
+			entry = self._parse_tc_stats(payload)
+			if entry['ifindex'] in stats: stats[entry['ifindex']]['qdiscs'].append(entry)
+		for index in ifindexes:
+			for payload in self.dump(self.RTM_GETTCLASS, self._tcmsg(index, 0, 0)):
+				entry = self._parse_tc_stats(payload)
+				if entry['ifindex'] == index: stats[index]['classes'].append(entry)
+		return stats
+
+	# --- Snapshot (rollback do modo staged) ---
+	def _attr_list(self, data, pos, end):
+		# Atributos pela ordem do dump, com o tipo original (flag NLA_F_NESTED incluida)
+		attrs = []
+		while pos + 4 <= end:
+			attr_len, attr_type = struct.unpack_from('=HH', data, pos)
+			if attr_len < 4: break
+			attrs.append((attr_type, data[pos + 4:pos + attr_len])); pos += (attr_len + 3) & ~3
+		return attrs
+
+	def _tc_object(self, payload):
+		_family, ifindex, handle, parent, info = struct.unpack_from('=BxxxiIII', payload, 0)
+		# So o que o kernel aceita de volta num RTM_NEW*: tipo, opcoes e chain (estatisticas, offload e afins ficam de fora)
+		attrs = [(t, v) for t, v in self._attr_list(payload, 20, len(payload)) if t & self.NLA_TYPE_MASK in (self.TCA_KIND, self.TCA_OPTIONS, self.TCA_CHAIN)]
+		kind = next((v for t, v in attrs if t & self.NLA_TYPE_MASK == self.TCA_KIND), b'').rstrip(b'\0').decode(errors='replace')
+		options = next(((t, self._attr_list(v, 0, len(v))) for t, v in attrs if t & self.NLA_TYPE_MASK == self.TCA_OPTIONS), None)
+		return {'ifindex': ifindex, 'handle': handle, 'parent': parent, 'info': info, 'kind': kind, 'attrs': attrs, 'options': options}
+
+	def _tc_new_message(self, msg_type, obj, handle=None, options=None):
+		body = self._tcmsg(obj['ifindex'], obj['handle'] if handle is None else handle, obj['parent'], obj['info'])
+		for attr_type, value in obj['attrs']:
+			if attr_type & self.NLA_TYPE_MASK == self.TCA_OPTIONS and options is not None: value = b''.join(self._attr(t, v) for t, v in options)
+			body += self._attr(attr_type, value)
+		return msg_type, self.NLM_F_CREATE | self.NLM_F_EXCL, body
+
+	def snapshot(self, ifindex, parent=None):
+		# Hierarquia tc de um dispositivo (a de saida inteira, ou so a subarvore ligada a parent) como mensagens RTM_NEW* que a recriam
+		# tal como estava, com os atributos do proprio dump. Raiz por omissao do kernel (handle 0): nada a repor alem da remocao
+		top = self.TC_H_ROOT if parent is None else parent
+		qdiscs = [q for q in map(self._tc_object, self.dump(self.RTM_GETQDISC, self._tcmsg(ifindex, 0, 0))) if q['ifindex'] == ifindex and q['parent'] != self.TC_H_INGRESS]
+		classes = [c for c in map(self._tc_object, self.dump(self.RTM_GETTCLASS, self._tcmsg(ifindex, 0, 0))) if c['ifindex'] == ifindex]
+		head = next((q for q in qdiscs if q['parent'] == top), None)
+		if head is None or not head['handle']: return []
+		for c in classes:
+			# Classes de topo vem com parent TC_H_ROOT: recriadas sob o proprio qdisc (que pode ser filho de mq ou de uma classe LAN)
+			c['is_class'] = True
+			if c['parent'] == self.TC_H_ROOT: c['parent'] = c['handle'] & 0xFFFF0000
+		messages = []; ready = {top}; qdisc_handles = set(); inner_candidates = []; pending = qdiscs + classes
+		# Ordem de criacao: cada qdisc depois da classe onde liga, cada classe depois do seu qdisc e da classe pai
+		while pending:
+			waiting = [obj for obj in pending if obj['parent'] not in ready or (obj.get('is_class') and obj['handle'] & 0xFFFF0000 not in qdisc_handles)]
+			if len(waiting) == len(pending): break # fora do ambito (outras subarvores, orfaos)
+			waiting_ids = {id(obj) for obj in waiting}
+			for obj in pending:
+				if id(obj) in waiting_ids: continue
+				ready.add(obj['handle'])
+				if obj.get('is_class'):
+					# Classes do mq (uma por fila) sao criadas pelo proprio qdisc
+					if obj['kind'] != 'mq': messages.append(self._tc_new_message(self.RTM_NEWTCLASS, obj)); inner_candidates.append(obj['handle'])
+					continue
+				if not obj['handle'] & 0xFFFF0000: continue
+				qdisc_handles.add(obj['handle']); options = obj['options'][1] if obj['options'] else None
+				if obj['kind'] == 'htb' and options is not None:
+					# O dump devolve a versao completa (HTB_VER); na criacao o kernel so aceita a principal (3), como o tc envia
+					options = [(t, struct.pack('=I', 3) + v[4:]) if t & self.NLA_TYPE_MASK == self.TCA_HTB_INIT and len(v) >= 4 else (t, v) for t, v in options]
+				messages.append(self._tc_new_message(self.RTM_NEWQDISC, obj, options=options))
+			pending = waiting
+		# Filtros dos qdiscs e das classes internas (cadeias da equidade por host); as classes folha nunca os consultam
+		inner = {c['parent'] for c in classes}
+		return messages + self._snapshot_filters(ifindex, sorted(qdisc_handles) + [h for h in inner_candidates if h in inner])
+
+	def _snapshot_filters(self, ifindex, parents):
+		filters = [f for parent in parents for f in map(self._tc_object, self.dump(self.RTM_GETTFILTER, self._tcmsg(ifindex, 0, parent))) if f['options'] is not None]
+		# u32: contadores fora e das flags so voltam skip_hw/skip_sw (in_hw/not_in_hw sao estado, o kernel recusa-as na criacao)
+		u32_value = lambda t, v: struct.pack('=I', struct.unpack('=I', v)[0] & self.TCA_CLS_FLAGS_SKIP) if t & self.NLA_TYPE_MASK == self.TCA_U32_FLAGS and len(v) == 4 else v
+		options = {id(f): [(t, u32_value(t, v) if f['kind'] == 'u32' else v) for t, v in f['options'][1] if f['kind'] != 'u32' or t & self.NLA_TYPE_MASK != self.TCA_U32_PCNT] for f in filters}
+		# u32: a tabela raiz de cada prio e criada pelo kernel com um id novo (um contador por qdisc, partilhado pelos filtros das classes);
+		# as tabelas ligadas (link) sao recriadas com o mesmo handle e antes dos nos. Os nos da raiz seguem sem handle nem hash, pela ordem
+		# das tabelas de todos os parents (o kernel volta a atribuir os mesmos ids e a mesma ordem dos nos)
+		linked = {struct.unpack('=I', v)[0] & 0xFFF00000 for f in filters if f['kind'] == 'u32' for t, v in options[id(f)] if t & self.NLA_TYPE_MASK == self.TCA_U32_LINK and len(v) == 4}
+		tables = [f for f in filters if f['kind'] == 'u32' and not f['handle'] & 0xFFFFF]
+		messages = [self._tc_new_message(self.RTM_NEWTFILTER, f, options=options[id(f)]) for f in tables if f['handle'] in linked]
+		root_nodes = sorted((f for f in filters if f['kind'] == 'u32' and f['handle'] & 0xFFFFF and f['handle'] & 0xFFF00000 not in linked), key=lambda f: f['handle'])
+		messages += [self._tc_new_message(self.RTM_NEWTFILTER, f, options=options[id(f)]) for f in filters if f['kind'] != 'u32' or f['handle'] & 0xFFFFF and f['handle'] & 0xFFF00000 in linked]
+		messages += [self._tc_new_message(self.RTM_NEWTFILTER, f, handle=0, options=[(t, v) for t, v in options[id(f)] if t & self.NLA_TYPE_MASK != self.TCA_U32_HASH]) for f in root_nodes]
+		return messages
+
+	# --- Eventos (daemon) ---
+	def monitor_socket(self, groups):
+		# Socket separado, nao bloqueante, subscrito aos grupos multicast (nao partilha o socket de pedidos/ACKs)
+		sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC | socket.SOCK_NONBLOCK, socket.NETLINK_ROUTE)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+		sock.bind((0, groups))
+		return sock
+
+	def link_events(self, data):
+		# RTM_NEWLINK/RTM_DELLINK -> [(nome, apagada)]
+		events = []; offset = 0
+		while offset + 16 <= len(data):
+			length, msg_type, _flags, _seq, _pid = struct.unpack_from('=IHHII', data, offset)
+			if length < 16: break
+			if msg_type in (self.RTM_NEWLINK, self.RTM_DELLINK) and length >= 32:
+				name = self._parse_attrs(data, offset + 32, offset + length).get(self.IFLA_IFNAME, b'').rstrip(b'\0').decode(errors='replace')
+				if name: events.append((name, msg_type == self.RTM_DELLINK))
+			offset += (length + 3) & ~3
+		return events
+
+	# --- Traducao tc/ip -> netlink ---
+	def _parse_handle(self, value):
+		# 'ffff:' -> 0xffff0000, '1:30' -> 0x10030 (hexadecimal como no tc)
+		if value in ('root', 'none'): return 0
+		major, _, minor = value.partition(':')
+		major, minor = int(major or '0', 16), int(minor or '0', 16)
+		if major > 0xFFFF or minor > 0xFFFF: raise RtnlError(f"handle invalido: {value}")
+		return (major << 16) | minor
+
+	def _parse_u32_handle(self, value):
+		parts = (value.split(':') + ['', ''])[:3]
+		htid, bucket, node = (int(p or '0', 16) for p in parts)
+		return (htid << 20) | (bucket << 12) | node
+
+	def _parse_size(self, value):
+		m = re.match(r'^(\d+(?:\.\d+)?)\s*(b|k|kb|kbit|m|mb|mbit|g|gb|gbit)?$', value.lower())
+		if not m: raise RtnlError(f"tamanho invalido: {value}")
+		unit = m.group(2) or 'b'
+		scale = {'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024**2, 'mb': 1024**2, 'g': 1024**3, 'gb': 1024**3, 'kbit': 128, 'mbit': 131072, 'gbit': 134217728}[unit]
+		return int(float(m.group(1)) * scale)
+
+	def _parse_rate_bytes(self, value):
+		m = re.match(r'^(\d+(?:\.\d+)?)\s*([kmgt]?)bit$', value.lower())
+		if not m: raise RtnlError(f"taxa invalida: {value}")
+		return int(float(m.group(1)) * {'': 1, 'k': 10**3, 'm': 10**6, 'g': 10**9, 't': 10**12}[m.group(2)]) // 8
+
+	def _xmittime(self, rate_bytes, size):
+		# tc_core_time2tick() do iproute2 recebe o tempo ja truncado para unsigned
+		return int(int(1000000 * (size / rate_bytes)) * self._tick_in_usec)
+
+	def _ifindex(self, name):
+		index = self.link_index(name)
+		if index is None: raise RtnlError(f"Cannot find device \"{name}\"", errno.ENODEV)
+		return index
+
+	def translate(self, cmd):
+		# Devolve (tipo, flags, corpo) para um comando tc/ip; RtnlError para sintaxe nao suportada
+		if cmd[0] == 'ip': return self._translate_ip(cmd[1:])
+		if cmd[0] == 'tc': return self._translate_tc(cmd[1:])
+		raise RtnlError(f"ferramenta nao suportada: {cmd[0]}")
+
+	def _translate_ip(self, args):
+		if args[:2] == ['link', 'add'] and len(args) >= 5 and args[-2] == 'type':
+			name, kind = args[2], args[-1]; attrs = b''
+			queue_attrs = {'numtxqueues': self.IFLA_NUM_TX_QUEUES, 'numrxqueues': self.IFLA_NUM_RX_QUEUES}
+			opts = args[3:-2]
+			if len(opts) % 2 or any(opt not in queue_attrs for opt in opts[::2]): raise RtnlError(f"comando ip nao suportado: {' '.join(args)}")
+			for opt, value in zip(opts[::2], opts[1::2]): attrs += self._attr(queue_attrs[opt], struct.pack('=I', int(value)))
+			linkinfo = self._nest(self.IFLA_LINKINFO, self._attr(self.IFLA_INFO_KIND, kind.encode()))
+			return self.RTM_NEWLINK, self.NLM_F_CREATE | self.NLM_F_EXCL, self._ifinfomsg() + self._attr(self.IFLA_IFNAME, name.encode() + b'\0') + attrs + linkinfo
+		if args[:3] == ['link', 'set', 'dev'] and len(args) == 5 and args[4] in ('up', 'down'):
+			return self.RTM_NEWLINK, 0, self._ifinfomsg(self._ifindex(args[3]), self.IFF_UP if args[4] == 'up' else 0, self.IFF_UP)
+		if args[:3] == ['link', 'del', 'dev'] and len(args) == 4:
+			return self.RTM_DELLINK, 0, self._ifinfomsg(self._ifindex(args[3]))
+		raise RtnlError(f"comando ip nao suportado: {' '.join(args)}")
+
+	def _translate_tc(self, args):
+		if len(args) < 4 or args[2] != 'dev': raise RtnlError(f"comando tc nao suportado: {' '.join(args)}")
+		obj, verb, dev, rest = args[0], args[1], args[3], args[4:]
+		if verb == 'del': msg_flags = 0
+		elif verb in self.TC_VERB_FLAGS: msg_flags = self.TC_VERB_FLAGS[verb]
+		else: raise RtnlError(f"verbo tc nao suportado: {verb}")
+		ifindex = self._ifindex(dev)
+		if obj == 'qdisc': return self._translate_qdisc(verb, msg_flags, ifindex, rest)
+		if obj == 'class': return self._translate_class(verb, msg_flags, ifindex, rest)
+		if obj == 'filter': return self._translate_filter(verb, msg_flags, ifindex, rest)
+		raise RtnlError(f"objeto tc nao suportado: {obj}")
+
+	def _translate_qdisc(self, verb, msg_flags, ifindex, args):
+		parent = handle = 0; kind = None; i = 0; opts = b''
+		while i < len(args):
+			tok = args[i]
+			if tok == 'root': parent = self.TC_H_ROOT
+			elif tok == 'ingress': parent = self.TC_H_INGRESS; handle = 0xFFFF0000; kind = 'ingress'
+			elif tok == 'parent': parent = self._parse_handle(args[i + 1]); i += 1
+			elif tok == 'handle': handle = self._parse_handle(args[i + 1]); i += 1
+			elif tok == 'mq': kind = 'mq'
+			elif tok in ('fq_codel', 'cake', 'sfq', 'pfifo'):
+				kind = tok; opts = self._leaf_options(kind, args[i + 1:])
+				break
+			elif tok == 'htb':
+				kind = 'htb'; glob = {'default': 0, 'r2q': 10}
+				i += 1
+				while i < len(args):
+					if args[i] == 'default': glob['default'] = int(args[i + 1], 16)
+					elif args[i] == 'r2q': glob['r2q'] = int(args[i + 1])
+					else: raise RtnlError(f"opcao htb nao suportada: {args[i]}")
+					i += 2
+				opts = self._nest(self.TCA_OPTIONS, self._attr(self.TCA_HTB_INIT, struct.pack('=IIIII', 3, glob['r2q'], glob['default'], 0, 0)))
+				break
+			else: raise RtnlError(f"opcao qdisc nao suportada: {tok}")
+			i += 1
+		body = self._tcmsg(ifindex, handle, parent)
+		if verb == 'del': return self.RTM_DELQDISC, 0, body + (self._attr(self.TCA_KIND, kind.encode() + b'\0') if kind else b'')
+		if not kind: raise RtnlError("qdisc sem tipo")
+		return self.RTM_NEWQDISC, msg_flags, body + self._attr(self.TCA_KIND, kind.encode() + b'\0') + opts
+
+	def _leaf_options(self, kind, args):
+		if len(args) % 2: raise RtnlError(f"opcoes {kind} invalidas: {' '.join(args)}")
+		params = dict(zip(args[::2], args[1::2]))
+		attr_types = {'fq_codel': {'target': (self.TCA_FQ_CODEL_TARGET, self._parse_time_us), 'interval': (self.TCA_FQ_CODEL_INTERVAL, self._parse_time_us), 'flows': (self.TCA_FQ_CODEL_FLOWS, int), 'memory_limit': (self.TCA_FQ_CODEL_MEMORY_LIMIT, self._parse_size)},
+					  'cake': {'rtt': (self.TCA_CAKE_RTT, self._parse_time_us), 'memlimit': (self.TCA_CAKE_MEMORY, self._parse_size)}, 'sfq': {'flows': None}, 'pfifo': {}}[kind]
+		for name in params:
+			if name not in attr_types: raise RtnlError(f"opcao {kind} nao suportada: {name}")
+		if not params: return b''
+		# O sfq recebe uma struct tc_sfq_qopt (campos a zero mantem os defaults do kernel), nao atributos aninhados
+		if kind == 'sfq': return self._attr(self.TCA_OPTIONS, struct.pack('=IiIII', 0, 0, 0, 0, int(params['flows'])))
+		return self._nest(self.TCA_OPTIONS, *(self._attr(attr_types[name][0], struct.pack('=I', attr_types[name][1](value))) for name, value in params.items()))
+
+	def _parse_time_us(self, value):
+		m = re.match(r'^(\d+(?:\.\d+)?)\s*(s|sec|ms|msec|us|usec)?$', value.lower())
+		if not m: raise RtnlError(f"tempo invalido: {value}")
+		return int(float(m.group(1)) * {'s': 10**6, 'sec': 10**6, 'ms': 1000, 'msec': 1000}.get(m.group(2), 1))
+
+	def _ratespec(self, rate_bytes):
+		return struct.pack('=BBHhHI', 0, self.TC_LINKLAYER_ETHERNET, 0, -1, 0, min(rate_bytes, 0xFFFFFFFF))
+
+	def _translate_class(self, verb, msg_flags, ifindex, args):
+		parent = classid = 0; htb = None; i = 0
+		while i < len(args):
+			tok = args[i]
+			if tok == 'parent': parent = self._parse_handle(args[i + 1]); i += 2; continue
+			if tok == 'root': parent = self.TC_H_ROOT; i += 1; continue
+			if tok == 'classid': classid = self._parse_handle(args[i + 1]); i += 2; continue
+			if tok == 'htb':
+				htb = {}; i += 1
+				while i < len(args):
+					if args[i] not in ('rate', 'ceil', 'prio', 'burst', 'cburst', 'quantum'): raise RtnlError(f"opcao htb nao suportada: {args[i]}")
+					htb[args[i]] = args[i + 1]; i += 2
+				break
+			raise RtnlError(f"opcao class nao suportada: {tok}")
+		body = self._tcmsg(ifindex, classid, parent)
+		if verb == 'del': return self.RTM_DELTCLASS, 0, body
+		if htb is None or 'rate' not in htb: raise RtnlError("classe sem parametros htb")
+		rate = self._parse_rate_bytes(htb['rate']); ceil = self._parse_rate_bytes(htb.get('ceil', htb['rate']))
+		buffer = self._parse_size(htb['burst']) if 'burst' in htb else rate // self._hz + self.HTB_MTU
+		cbuffer = self._parse_size(htb['cburst']) if 'cburst' in htb else ceil // self._hz + self.HTB_MTU
+		opt = self._ratespec(rate) + self._ratespec(ceil) + struct.pack('=IIIII', self._xmittime(rate, buffer), self._xmittime(ceil, cbuffer), int(htb.get('quantum', 0)), 0, int(htb.get('prio', 0)))
+		attrs = self._attr(self.TCA_HTB_PARMS, opt)
+		if rate > 0xFFFFFFFF: attrs += self._attr(self.TCA_HTB_RATE64, struct.pack('=Q', rate))
+		if ceil > 0xFFFFFFFF: attrs += self._attr(self.TCA_HTB_CEIL64, struct.pack('=Q', ceil))
+		return self.RTM_NEWTCLASS, msg_flags, body + self._attr(self.TCA_KIND, b'htb\0') + self._nest(self.TCA_OPTIONS, attrs)
+
+	def _translate_filter(self, verb, msg_flags, ifindex, args):
+		parent = handle = prio = 0; protocol = 0; kind = None; i = 0
+		classid = None; mark = None; keys = []; actions = []; u32_attrs = []; hashkey = (0, 0); divisor = None
+		while i < len(args):
+			tok = args[i]
+			if tok == 'parent': parent = self._parse_handle(args[i + 1]); i += 2
+			elif tok == 'protocol': protocol = {'ip': 0x0800, 'all': 0x0003, 'ipv6': 0x86DD}[args[i + 1]]; i += 2
+			elif tok in ('prio', 'pref'): prio = int(args[i + 1]); i += 2
+			elif tok == 'handle': handle = args[i + 1]; i += 2
+			elif tok in ('u32', 'fw'): kind = tok; i += 1
+			elif tok == 'match' and args[i + 1] == 'mark': mark = (int(args[i + 2], 0), int(args[i + 3], 0)); i += 4
+			elif tok == 'match' and args[i + 1] == 'u32':
+				off = 0; step = 4
+				if i + 5 < len(args) and args[i + 4] == 'at': off = int(args[i + 5]); step = 6
+				keys.append((int(args[i + 2], 0), int(args[i + 3], 0), off)); i += step
+			elif tok in ('flowid', 'classid'): classid = self._parse_handle(args[i + 1]); i += 2
+			# Tabelas de hash u32: 'divisor N' cria a tabela, 'ht X:Y:' insere no balde Y, 'link X:' + 'hashkey mask M at OFF' encaminha para a tabela
+			elif tok == 'divisor': divisor = int(args[i + 1]); i += 2
+			elif tok in ('ht', 'link'): u32_attrs.append(self._attr(self.TCA_U32_HASH if tok == 'ht' else self.TCA_U32_LINK, struct.pack('=I', self._parse_u32_handle(args[i + 1])))); i += 2
+			elif tok == 'hashkey' and args[i + 1] == 'mask' and args[i + 3] == 'at': hashkey = (int(args[i + 2], 16), int(args[i + 4])); i += 5
+			elif tok == 'action' and args[i + 1:i + 3] == ['ctinfo', 'cpmark']:
+				mask = 0xFFFFFFFF; i += 3
+				if i < len(args) and re.match(r'^(0x)?[0-9a-fA-F]+$', args[i]) and args[i] != 'action': mask = int(args[i], 16); i += 1
+				control = self.TC_ACT_PIPE
+				if i < len(args) and args[i] in self.TC_ACT_CONTROLS: control = self.TC_ACT_CONTROLS[args[i]]; i += 1
+				actions.append(('ctinfo', self._attr(self.TCA_CTINFO_ACT, struct.pack('=IIiii', 0, 0, control, 0, 0)) + self._attr(self.TCA_CTINFO_PARMS_CPMARK_MASK, struct.pack('=I', mask))))
+			elif tok == 'action' and args[i + 1:i + 5] == ['mirred', 'egress', 'redirect', 'dev']:
+				target = self._ifindex(args[i + 5])
+				actions.append(('mirred', self._attr(self.TCA_MIRRED_PARMS, struct.pack('=IIiiiiI', 0, 0, self.TC_ACT_STOLEN, 0, 0, self.TCA_EGRESS_REDIR, target)))); i += 6
+			else: raise RtnlError(f"opcao filter nao suportada: {tok}")
+		handle_value = 0
+		if handle is not None and handle != 0: handle_value = self._parse_u32_handle(handle) if kind in (None, 'u32') else int(handle, 0)
+		body = self._tcmsg(ifindex, handle_value, parent, (prio << 16) | socket.htons(protocol))
+		if verb == 'del': return self.RTM_DELTFILTER, 0, body + (self._attr(self.TCA_KIND, kind.encode() + b'\0') if kind else b'')
+		if kind == 'fw':
+			if mark is not None or keys or actions: raise RtnlError("filtro fw aceita apenas handle e classid")
+			return self.RTM_NEWTFILTER, msg_flags, body + self._attr(self.TCA_KIND, b'fw\0') + self._nest(self.TCA_OPTIONS, self._attr(self.TCA_FW_CLASSID, struct.pack('=I', classid)) if classid is not None else b'')
+		if kind != 'u32': raise RtnlError("apenas filtros u32 e fw sao suportados")
+		if divisor is not None: return self.RTM_NEWTFILTER, msg_flags, body + self._attr(self.TCA_KIND, b'u32\0') + self._nest(self.TCA_OPTIONS, self._attr(self.TCA_U32_DIVISOR, struct.pack('=I', divisor)))
+		opts = b''.join(u32_attrs)
+		if classid is not None: opts += self._attr(self.TCA_U32_CLASSID, struct.pack('=I', classid))
+		if True: # o cls_u32 exige sempre o seletor, mesmo sem chaves (ex: so 'match mark')
+			flags = self.TC_U32_TERMINAL if classid is not None or actions else 0
+			sel = struct.pack('=BBBxHHhh', flags, 0, len(keys), 0, 0, 0, hashkey[1]) + struct.pack('!I', hashkey[0]) + b''.join(struct.pack('!II', mask, val) + struct.pack('=ii', off, 0) for val, mask, off in keys)
+			opts += self._attr(self.TCA_U32_SEL, sel)
+		if mark is not None: opts += self._attr(self.TCA_U32_MARK, struct.pack('=III', mark[0], mark[1], 0))
+		if actions:
+			opts += self._nest(self.TCA_U32_ACT, *(self._nest(order, self._attr(self.TCA_ACT_KIND, name.encode() + b'\0'), self._nest(self.TCA_ACT_OPTIONS, params)) for order, (name, params) in enumerate(actions, 1)))
+		return self.RTM_NEWTFILTER, msg_flags, body + self._attr(self.TCA_KIND, b'u32\0') + self._nest(self.TCA_OPTIONS, opts)
+
+class ConfigWatcher:
+	# inotify (via ctypes) nos diretorios dos ficheiros vigiados: os editores substituem o ficheiro por rename,
+	# por isso vigia-se a entrada do diretorio. Sem inotify, compara o mtime a cada POLL_INTERVAL segundos.
+	# Um caminho que e um diretorio de conf (lido como o foomuuri le /etc/foomuuri) conta com qualquer *.conf criado, alterado ou removido
+	IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+	POLL_INTERVAL = 5
+
+	def __init__(self, paths):
+		self.paths = [Path(p).absolute() for p in paths]
+		self.dirs = {p for p in self.paths if p.is_dir()}
+		self.fd = None; self._dir_wds = set()
+		self._mtimes = self._stat()
+		try:
+			libc = ctypes.CDLL(None, use_errno=True)
+			fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+			if fd < 0: raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+			mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+			for directory in {p if p in self.dirs else p.parent for p in self.paths}:
+				wd = libc.inotify_add_watch(fd, str(directory).encode(), mask)
+				if wd < 0: error = ctypes.get_errno(); os.close(fd); raise OSError(error, f"{directory}: {os.strerror(error)}")
+				if directory in self.dirs: self._dir_wds.add(wd)
+			self.fd = fd
+		except (OSError, AttributeError) as e:
+			logger.warning(f"inotify indisponivel ({e}); alteracoes ao conf detetadas por mtime a cada {self.POLL_INTERVAL}s.")
+
+	def _stat(self):
+		mtimes = {}
+		for path in self.paths:
+			if path in self.dirs: mtimes[path] = tuple((conf.name, self._stat_one(conf)) for conf in FoomuuriConfReader.paths(path))
+			else: mtimes[path] = self._stat_one(path)
+		return mtimes
+
+	def _stat_one(self, path):
+		try: st = path.stat(); return (st.st_mtime_ns, st.st_size, st.st_ino)
+		except OSError: return None
+
+	def fileno(self):
+		return self.fd
+
+	def changed(self):
+		# Consome os eventos pendentes; True se algum dos ficheiros vigiados mudou
+		if self.fd is None:
+			mtimes = self._stat(); changed = mtimes != self._mtimes; self._mtimes = mtimes; return changed
+		names = {path.name for path in self.paths}; changed = False
+		while True:
+			try: data = os.read(self.fd, 1 << 16)
+			except BlockingIOError: return changed
+			offset = 0
+			while offset + 16 <= len(data):
+				wd, _mask, _cookie, name_len = struct.unpack_from('=iIII', data, offset)
+				name = data[offset + 16:offset + 16 + name_len].rstrip(b'\0').decode(errors='replace')
+				if name in names or (wd in self._dir_wds and FoomuuriConfReader.is_conf_name(name)): changed = True
+				offset += 16 + name_len
+
+	def close(self):
+		if self.fd is not None: os.close(self.fd); self.fd = None
+
+class FoomuuriConfReader:
+	# Leitura do conf do foomuuri por tokens, em streaming: blocos aninhados, aspas, ';' (varios valores), comentarios '#' e continuacao
+	# de linha com '\'. Um diretorio e lido como o foomuuri le /etc/foomuuri: todos os *.conf por ordem alfabetica. Cada ficheiro e
+	# analisado de forma independente e o resultado (macros e regras snat com a linha de origem) fica em cache por caminho: reutilizado
+	# enquanto mtime/tamanho/inode se mantiverem ou, se mudarem, enquanto o sha256 do conteudo for o mesmo
+	ENTRY_KEYS = ('stat', 'sha256', 'verified', 'macros', 'snat', 'warnings')
+	# Um mtime a menos de 1s da verificacao nao prova nada (escrita no mesmo tick do relogio): o ficheiro volta a ser comparado pelo hash
+	MTIME_GRACE_NS = 10**9
+
+	def __init__(self):
+		self.files = {} # caminho absoluto -> entrada com as chaves ENTRY_KEYS (serializavel, guardada em --parse-cache)
+		self.stats = {'parsed': 0, 'reused': 0}
+		self.dirty = False # alguma entrada nova/alterada desde que o cache foi carregado
+
+	@staticmethod
+	def is_conf_name(name):
+		return name.endswith('.conf') and not name.startswith('.')
+
+	@staticmethod
+	def paths(root):
+		root = Path(root)
+		if root.is_dir(): return sorted(p for p in root.iterdir() if FoomuuriConfReader.is_conf_name(p.name) and p.is_file())
+		return [root] if root.is_file() else []
+
+	# Por linha: espaco, comentario, '{', '}', ';', texto entre aspas (ou aspas sem fecho), '\\' de continuacao no fim ou palavra.
+	# Atalhos para os casos comuns: linhas sem nenhum de SPECIAL_RE sao so separadas por espacos; 'NOME "valor" # comentario' numa expressao
+	TOKEN_RE = re.compile(r"""\s+|#.*|(?P<punct>[{};])|"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<open>["'].*)|(?P<cont>\\\s*$)|(?P<word>[^\s{};#"']+)""")
+	SPECIAL_RE = re.compile(r"""[{};"'\\]""")
+	QUOTED_PAIR_RE = re.compile(r"""\s*([^\s{};#"'\\]+)\s+(?:"([^"]*)"|'([^']*)')\s*(?:#.*)?""")
+
+	def parse(self, lines):
+		# Instrucao = palavras ate ao fim da linha logica, '{' ou '}' (None marca um ';' fora de aspas). A pilha guarda a primeira palavra
+		# do cabecalho de cada bloco aberto; so as instrucoes dos blocos de topo macro e snat sao guardadas, com a linha onde comecam
+		result = {'macros': [], 'snat': [], 'warnings': []}; stack = []; statement = []; start = line_num = 0
+		def flush():
+			section = stack[0] if len(stack) == 1 else None
+			if section == 'macro' and len(statement) > 1 and statement[0] is not None:
+				result['macros'].append([statement[0], ' '.join(';' if word is None else word for word in statement[1:]), start])
+			elif section == 'snat':
+				rule = []
+				for word in statement + [None]:
+					if word is not None: rule.append(word)
+					elif rule: result['snat'].append([rule, start]); rule = []
+			statement.clear()
+		for line_num, line in enumerate(lines, 1):
+			if not statement: start = line_num
+			continued = False
+			if not self.SPECIAL_RE.search(line): statement += line.split('#', 1)[0].split()
+			elif (pair := self.QUOTED_PAIR_RE.fullmatch(line)): statement += [pair.group(1), pair.group(2) if pair.group(3) is None else pair.group(3)]
+			else:
+				for match in self.TOKEN_RE.finditer(line):
+					kind = match.lastgroup
+					if kind is None: continue
+					if kind == 'punct':
+						punct = match.group(kind)
+						if punct == ';': statement.append(None); continue
+						if punct == '{': stack.append((statement[0] or '').lower() if statement else ''); statement.clear()
+						else:
+							flush()
+							if stack: stack.pop()
+							else: result['warnings'].append([line_num, "'}' sem bloco aberto"])
+						start = line_num
+					elif kind == 'open': result['warnings'].append([line_num, "aspas sem fecho"]); statement.append(match.group(kind)[1:].rstrip())
+					elif kind == 'cont': continued = True
+					else: statement.append(match.group(kind))
+			if not continued: flush()
+		flush()
+		if stack: result['warnings'].append([line_num, f"bloco '{stack[-1]}' sem fecho no fim do ficheiro"])
+		return result
+
+	def _file_entry(self, path):
+		key = str(path.absolute()); entry = self.files.get(key)
+		st = path.stat(); stat = [st.st_mtime_ns, st.st_size, st.st_ino]
+		if entry and entry['stat'] == stat and stat[0] < entry['verified'] - self.MTIME_GRACE_NS: self.stats['reused'] += 1; return entry
+		data = path.read_bytes(); digest = hashlib.sha256(data).hexdigest(); self.dirty = True
+		if entry and entry['sha256'] == digest: entry.update(stat=stat, verified=time.time_ns()); self.stats['reused'] += 1; return entry
+		entry = dict(self.parse(data.decode(errors='replace').splitlines()), stat=stat, sha256=digest, verified=time.time_ns())
+		self.files[key] = entry; self.stats['parsed'] += 1; return entry
+
+	def load(self, root):
+		# Indice de macros (nome -> valor, ficheiro, linha) e regras snat de todos os ficheiros; o ultimo a definir um macro prevalece
+		index = {}; snat = []; seen = set(); self.stats = {'parsed': 0, 'reused': 0}
+		for path in self.paths(root):
+			entry = self._file_entry(path); seen.add(str(path.absolute()))
+			for line_num, msg in entry['warnings']: logger.warning(f"{path}:{line_num}: {msg}.")
+			for name, value, line_num in entry['macros']:
+				previous = index.get(name)
+				if previous and name.startswith('QOS_') and previous['value'] != value: logger.warning(f"Macro {name} redefinido em {path}:{line_num} (antes em {previous['file']}:{previous['line']}). Usando o ultimo.")
+				index[name] = {'value': value, 'file': str(path), 'line': line_num}
+			snat += [{'tokens': tokens, 'file': str(path), 'line': line_num} for tokens, line_num in entry['snat']]
+		for key in set(self.files) - seen: del self.files[key]; self.dirty = True
+		return index, snat
+
+class IcmpProbe:
+	# Eco ICMP por socket raw (sem fork de ping), preso a interface WAN com SO_BINDTODEVICE para medir o caminho desse ISP
+	SO_BINDTODEVICE = 25
+	ICMP_ECHO_REPLY, ICMP_ECHO = 0, 8
+
+	def __init__(self, target, device=None, timeout=1.0, priority=None):
+		self.target = socket.gethostbyname(target)
+		self.timeout = timeout
+		self._ident = (os.getpid() ^ id(self)) & 0xffff; self._seq = 0
+		self._sock = socket.socket(socket.AF_INET, socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.IPPROTO_ICMP)
+		if device: self._sock.setsockopt(socket.SOL_SOCKET, self.SO_BINDTODEVICE, device.encode())
+		# skb->priority igual ao handle do HTB (X:0) = fila direta: a sonda nao espera atras das filas do proprio shaper
+		if priority is not None: self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, priority)
+
+	def _checksum(self, data):
+		if len(data) % 2: data += b'\0'
+		total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+		total = (total >> 16) + (total & 0xffff); total += total >> 16
+		return ~total & 0xffff
+
+	def rtt_ms(self):
+		# RTT em ms, ou None sem resposta dentro do timeout
+		self._seq = (self._seq + 1) & 0xffff
+		packet = struct.pack('!BBHHH', self.ICMP_ECHO, 0, 0, self._ident, self._seq) + b'foomuuri-qos-autorate'
+		packet = packet[:2] + struct.pack('!H', self._checksum(packet)) + packet[4:]
+		sent = time.monotonic()
+		try: self._sock.sendto(packet, (self.target, 0))
+		except OSError as e: logger.debug("Sonda ICMP para %s falhou: %s", self.target, e); return None
+		while True:
+			remaining = sent + self.timeout - time.monotonic()
+			if remaining <= 0 or not select.select([self._sock], [], [], remaining)[0]: return None
+			data, addr = self._sock.recvfrom(2048)
+			ihl = (data[0] & 0x0f) * 4
+			if addr[0] != self.target or len(data) < ihl + 8: continue
+			icmp_type, _code, _csum, ident, seq = struct.unpack_from('!BBHHH', data, ihl)
+			if icmp_type == self.ICMP_ECHO_REPLY and ident == self._ident and seq == self._seq: return (time.monotonic() - sent) * 1000
+
+	def close(self):
+		self._sock.close()
+
 class QoSEngineMacroParserValidated:
-	def __init__(self, foomuuri_config_path="/etc/foomuuri/foomuuri.conf"):
-		self.foomuuri_config_path = Path(foomuuri_config_path)
-		self.config = {'interfaces': [], 'services': []}
+	APPLY_MODES = ('exec', 'batch', 'netlink')
+	BATCH_TOOLS = ('tc', 'ip')
+	# Estado das interfaces lido do sysfs (existencia, MTU, filas TX, flags); bench/apply_time.py aponta-o para uma arvore falsa
+	SYS_CLASS_NET = "/sys/class/net"
+	# Espera apos remover a qdisc root / a IFB no modo exec, para o kernel concluir a remocao antes de recriar (aparece no trace como 'settle')
+	SETTLE_DELAY = 0.1
+	# Sufixo da IFB de staging (modo staged): a hierarquia nova e construida nela antes da troca do redirect
+	STAGING_SUFFIX = "-stg"
+	# Handle u32 do filtro de redirect para a IFB no ingress da WAN
+	IFB_REDIRECT_HANDLE = "800::800"
+	CLASSIFIERS = ('u32', 'fw')
+	FW_FILTER_PRIO = 1
+	DEFAULT_MARK = 0xff
+	DEFAULT_FILTER_PRIO = 20
+	TOPOLOGIES = ('htb', 'mq')
+	MAX_QUEUES = 256
+	ROOT_TREE = {'major': '1', 'parent': 'root', 'queues': 1}
+	# Modelo de taxas HTB: burst cobre um intervalo do timer (1ms, tick a 1000 Hz) mais um MTU; quantum dentro dos limites do sch_htb
+	HTB_TIMER_GRANULARITY_US = 1000
+	HTB_R2Q = 10
+	HTB_MAX_QUANTUM = 200000
+	DEFAULT_MTU = 1500
+	ETH_HLEN = 14
+	# Qdiscs folha suportadas: parametro generico do macro -> palavra-chave do tc
+	LEAF_QDISCS = {'fq_codel': {'target': 'target', 'interval': 'interval', 'flows': 'flows', 'memory_limit': 'memory_limit'},
+				   'cake': {'interval': 'rtt', 'memory_limit': 'memlimit'}, 'sfq': {'flows': 'flows'}, 'pfifo': {}}
+	LEAF_PARAM_UNITS = {'target': 'time', 'interval': 'time', 'flows': 'count', 'memory_limit': 'size'}
+	# Exportador de estatisticas: campo da amostra -> (sufixo da metrica Prometheus, tipo, descricao)
+	STATS_FORMATS = ('prometheus', 'json')
+	STATS_STATE_FILE = "/run/foomuuri-qos-stats.json"
+	STATS_METRIC_PREFIX = "foomuuri_qos"
+	STATS_METRICS = (('bytes', 'bytes_total', 'counter', "Bytes enviados"), ('packets', 'packets_total', 'counter', "Pacotes enviados"),
+					 ('drops', 'drops_total', 'counter', "Pacotes descartados"), ('overlimits', 'overlimits_total', 'counter', "Eventos overlimit"),
+					 ('requeues', 'requeues_total', 'counter', "Pacotes reenfileirados"), ('lends', 'lends_total', 'counter', "Pacotes enviados dentro da taxa propria (HTB)"),
+					 ('borrows', 'borrows_total', 'counter', "Pacotes enviados com banda emprestada do pai (HTB)"), ('giants', 'giants_total', 'counter', "Pacotes maiores que o MTU (HTB)"),
+					 ('backlog', 'backlog_bytes', 'gauge', "Bytes em fila"), ('qlen', 'queue_packets', 'gauge', "Pacotes em fila"),
+					 ('tokens', 'tokens', 'gauge', "Tokens da taxa (ticks psched, HTB)"), ('ctokens', 'ctokens', 'gauge', "Tokens do ceil (ticks psched, HTB)"),
+					 ('rate', 'rate_bits', 'gauge', "Taxa configurada (bit/s)"), ('ceil', 'ceil_bits', 'gauge', "Ceil configurado (bit/s)"),
+					 ('htb_rate', 'live_rate_bits', 'gauge', "Taxa em vigor no kernel (bit/s; difere da configurada com autorate)"), ('htb_ceil', 'live_ceil_bits', 'gauge', "Ceil em vigor no kernel (bit/s)"),
+					 ('bytes_rate', 'bits_per_second', 'gauge', "Debito medido entre as duas ultimas amostras (bit/s)"),
+					 ('packets_rate', 'packets_per_second', 'gauge', "Pacotes/s entre as duas ultimas amostras"),
+					 ('drops_rate', 'drops_per_second', 'gauge', "Descartes/s entre as duas ultimas amostras"),
+					 ('overlimits_rate', 'overlimits_per_second', 'gauge', "Overlimits/s entre as duas ultimas amostras"))
+	STATS_RATE_COUNTERS = ('bytes', 'packets', 'drops', 'overlimits')
+	# Cache do plano compilado (persistente) e registo do plano ativo (tmpfs: perde-se no reboot, tal como o estado tc)
+	PLAN_CACHE_FILE = "/var/cache/foomuuri-qos/plan.json"
+	PARSE_CACHE_FILE = "/var/cache/foomuuri-qos/parse.json" # resultado do tokenizer por ficheiro de conf (reanalise incremental)
+	LIVE_PLAN_FILE = "/run/foomuuri-qos-live.json"
+	# Daemon: eventos agrupados durante DAEMON_DEBOUNCE s (sem adiar mais de DAEMON_MAX_DELAY s com eventos continuos)
+	DAEMON_DEBOUNCE = 1.0
+	DAEMON_MAX_DELAY = 10.0
+	# Autorate: a taxa da classe raiz segue a latencia sob carga, entre QOS_IF_<KEY>_AUTORATE_<DIR>_MIN e _MAX
+	AUTORATE_DECREASE = 0.9 # com atraso e carga: nova taxa = debito medido * fator (esvazia a fila do modem)
+	AUTORATE_INCREASE = 1.05 # com carga alta e sem atraso: sobe 5% por iteracao
+	AUTORATE_HIGH_LOAD = 0.75
+	AUTORATE_LOW_LOAD = 0.4
+	AUTORATE_MIN_CHANGE = 0.02 # variacoes menores nao geram 'tc class change'
+	AUTORATE_BASELINE_ALPHA = (0.5, 0.01) # EWMA da RTT de base: desce depressa, sobe devagar
+	AUTORATE_PROBE_TIMEOUT = 1.0
+	AUTORATE_MAX_LOST = 3
+	# Equidade por host LAN (QOS_SRV_<nome>_PER_HOST_SUBNET): subclasses <sufixo><octeto> sob a classe do servico, escolhidas por uma
+	# tabela de hash u32 de 256 baldes indexada pelo ultimo octeto (um lookup, qualquer que seja o numero de hosts)
+	# As tabelas u32 sao partilhadas por todo o qdisc e listadas por prio: cada servico usa prio 100 + minor da classe (fora das prios 0-15/20)
+	# e a tabela 0x900 + minor (acima dos ids atribuidos pelo kernel, 0x1-0x800)
+	PER_HOST_FILTER_PRIO = 100
+	PER_HOST_HT_BASE = 0x900
+	PER_HOST_MIN_PREFIX = 24
+	PER_HOST_KEY_OFFSET = {'upload': 12, 'download': 16} # endereco IPv4 de origem / destino
+	# Download sem IFB (QOS_DOWNLOAD_MODE "lan"): shaping na saida de QOS_LAN_IFACE, com a hierarquia de cada WAN (N:) sob a classe 1:N
+	# de um HTB raiz; o filtro da prio N escolhe a WAN pelos bits QOS_LAN_WAN_MARK_MASK da marca do conntrack. Sem bits de WAN
+	# (trafego do proprio router ou entre redes LAN) o pacote vai para a fila direta do HTB raiz, sem shaping
+	DOWNLOAD_MODES = ('ifb', 'lan')
+	LAN_WAN_MARK_MASK = 0xff00
+	LAN_CTINFO_PRIO = 1
+	# Templates de servico (QOS_TPL_<nome>_*, listados em QOS_TEMPLATE_LIST): QOS_TPL_<nome>_MARKS gera um servico <nome>_<marca> por marca.
+	# Sufixo 'auto' (default com template): o alocador escolhe o minor livre, 0x2-0xff para servicos com PER_HOST, os outros de 0x100 a 0xffff
+	AUTO_SUFFIX = 'auto'
+	AUTO_MINOR_START = 0x100
+	MAX_MINOR = 0xffff
+	MAX_TEMPLATE_MARKS = 0xfffe
+
+	def __init__(self, foomuuri_config_path="/etc/foomuuri", apply_mode='exec', jobs=1, plan_cache=None, live_plan=None, trace=None, parse_cache=None, staged=False):
+		self.foomuuri_config_path = Path(foomuuri_config_path) # ficheiro ou diretorio com *.conf
+		self.config = {'interfaces': [], 'services': [], 'snat': [], 'lan': None}
 		self.managed_ifbs = {}
 		self.IFACE_PREFIX = "QOS_IF_"
 		self.SERVICE_PREFIX = "QOS_SRV_"
 		self.SERVICE_LIST_MACRO = "QOS_SERVICE_LIST"
+		self.TEMPLATE_PREFIX = "QOS_TPL_"
+		self.TEMPLATE_LIST_MACRO = "QOS_TEMPLATE_LIST"
+		if apply_mode not in self.APPLY_MODES: raise ValueError(f"Modo de aplicacao invalido: '{apply_mode}' (validos: {', '.join(self.APPLY_MODES)})")
+		self.apply_mode = apply_mode
+		self._batch = None # Lista de comandos pendentes quando em modo batch
+		self._batch_links = {} # Estado previsto das interfaces (nome -> existe) apos o batch pendente
+		self._cmd_context = None # Origem (interface/macro) dos comandos emitidos, para mapear erros
+		self._rtnl = RtnlBackend() if apply_mode == 'netlink' else None
+		if jobs < 1: raise ValueError(f"Numero de jobs invalido: {jobs}")
+		self.jobs = jobs
+		self.iface_results = {} # nome da interface -> True/False apos o ultimo setup_tc
+		self._stats_rtnl = None # Socket rtnetlink reutilizado entre amostras de --stats
+		self._stats_labels = {} # dispositivo -> {classid: etiquetas}, calculado uma vez por execucao
+		self.plan_cache = plan_cache; self.live_plan = live_plan # None desativa o cache / o registo do plano ativo
+		self.iface_plans = {} # interface -> comandos gravados durante o setup (plano compilado)
+		self._plan_record = None # Lista onde _run_command grava os comandos enquanto um plano e compilado
+		self._replay_plans = None # Planos do cache a reexecutar no lugar de _setup_iface
+		self._daemon_signatures = {} # interface -> estrutura tc esperada (modo daemon)
+		self.trace = trace # Tracer partilhado com os workers, ou None (sem medicao)
+		self.parse_cache = parse_cache # None: o tokenizer so reutiliza ficheiros dentro do mesmo processo (daemon)
+		self.conf_reader = FoomuuriConfReader()
+		self.macro_index = {} # nome do macro -> {'value', 'file', 'line'} do ultimo parsing
+		self.staged = staged # Alteracoes estruturais construidas ao lado e trocadas de uma vez, com rollback
+		self._staging_ifbs = {} # IFB de staging -> IFB definitiva (a configuracao e a desta)
+
+	def _span(self, name, cat, **args):
+		# Sem trace: contexto vazio, o bloco recebe o mesmo dicionario mas nada e medido nem guardado
+		if self.trace is None: return contextlib.nullcontext(args)
+		return self.trace.span(name, cat, **args)
+
+	def _settle(self, reason):
+		with self._span('settle', 'sleep', reason=reason): time.sleep(self.SETTLE_DELAY)
+
+	def _link_exists(self, name):
+		if self._batch is not None and name in self._batch_links: return self._batch_links[name]
+		if self._rtnl is not None:
+			try: return self._rtnl.link_index(name) is not None
+			except RtnlTransportError as e: self._netlink_failover(name, e)
+		return Path(f"{self.SYS_CLASS_NET}/{name}").exists()
+
+	def _netlink_failover(self, label, error):
+		# Kernel sem resposta no socket netlink: o resto da aplicacao (e as seguintes, no daemon) segue pelo tc/ip, como no modo batch
+		logger.warning(f"Backend netlink indisponivel em '{label}' ({error}). Passando a aplicar via tc/ip.")
+		self._rtnl.close(); self._rtnl = None
+
+	def _begin_batch(self):
+		if self.apply_mode == 'exec': return
+		self._batch = []; self._batch_links = {}
+
+	def _queue_command(self, cmd, failure_ok, context, fatal):
+		cmd_str = ' '.join(shlex.quote(c) for c in cmd)
+		logger.debug("Comando em batch: %s", cmd_str)
+		self._batch.append({'tool': 'netlink' if self._rtnl is not None else cmd[0], 'line': ' '.join(shlex.quote(c) for c in cmd[1:]), 'cmd': cmd, 'cmd_str': cmd_str, 'failure_ok': failure_ok, 'context': context, 'fatal': fatal})
+		# Manter o estado previsto das interfaces para que as verificacoes de existencia vejam o efeito dos comandos ainda por executar
+		if cmd[0] == 'ip' and cmd[1:3] == ['link', 'add']: self._batch_links[cmd[3]] = True
+		elif cmd[0] == 'ip' and cmd[1:3] == ['link', 'del']: self._batch_links[cmd[-1]] = False
+		return True
+
+	def _flush_batch(self, label):
+		if self._batch is None: return True
+		entries = self._batch; self._batch = None; self._batch_links = {}
+		if not entries: return True
+		# Comandos consecutivos da mesma ferramenta formam um segmento executado num unico processo; a ordem global e mantida
+		segments = []
+		for entry in entries:
+			if segments and segments[-1][0] == entry['tool']: segments[-1][1].append(entry)
+			else: segments.append((entry['tool'], [entry]))
+		logger.info(f"Aplicando batch '{label}': {len(entries)} comandos " + (f"em {len(segments)} processo(s)." if self._rtnl is None else "via rtnetlink."))
+		success = True
+		for tool, seg_entries in segments:
+			with self._span(f"{tool} batch", 'batch', label=label, commands=len(seg_entries)) as span:
+				if not self._run_batch_segment(tool, seg_entries, label): success = False; span['ok'] = False
+		return success
+
+	def _run_batch_segment(self, tool, entries, label):
+		if tool == 'netlink': return self._run_netlink_segment(entries, label)
+		script = ''.join(f"{e['line']}\n" for e in entries)
+		try:
+			with self._span(tool, 'cmd', cmd=f"{tool} -force -batch -", context=label, commands=len(entries)) as span:
+				result = subprocess.run([tool, '-force', '-batch', '-'], input=script, capture_output=True, text=True, timeout=20 + len(entries) // 50); span['status'] = result.returncode
+		except subprocess.TimeoutExpired:
+			logger.error(f"Batch {tool} '{label}' excedeu o tempo limite."); return False
+		except Exception as e:
+			logger.error(f"Erro inesperado ao executar batch {tool} '{label}': {e}"); return False
+		success = True
+		failed_lines = set()
+		pending_msgs = []
+		for err_line in result.stderr.splitlines():
+			m = re.match(r'^Command failed (\S+):(\d+)\s*$', err_line.strip())
+			if not m:
+				if err_line.strip(): pending_msgs.append(err_line.strip())
+				continue
+			line_no = int(m.group(2)); msg = ' '.join(pending_msgs); pending_msgs = []
+			if not 1 <= line_no <= len(entries): logger.error(f"Batch {tool} '{label}' falhou na linha {line_no} (fora do plano): {msg}"); success = False; continue
+			failed_lines.add(line_no); entry = entries[line_no - 1]
+			ctx = f" [{entry['context']}]" if entry['context'] else ""
+			is_replace_exists_error = ("File exists" in msg and ("replace" in entry['cmd'] or "add" in entry['cmd']))
+			if entry['failure_ok'] or is_replace_exists_error:
+				logger.debug("Falha (ignorada) no batch %s linha %d%s: %s: %s", tool, line_no, ctx, entry['cmd_str'], msg)
+			else:
+				logger.error(f"Falha no comando {entry['cmd_str']}{ctx} (batch {tool} '{label}' linha {line_no}): {msg}")
+				if entry['fatal']: success = False
+		if pending_msgs: logger.warning(f"Erros/Warnings do batch {tool} '{label}': {' '.join(pending_msgs)}")
+		if result.returncode != 0 and (result.returncode == 255 or not failed_lines):
+			# Erros de sintaxe abortam o batch (exit -1) sem indicar a linha; repetir o segmento comando a comando para localizar a falha
+			logger.warning(f"Batch {tool} '{label}' abortado (codigo {result.returncode}). Repetindo {len(entries)} comandos individualmente.")
+			return self._replay_batch_entries(entries)
+		return success
+
+	def _run_netlink_segment(self, entries, label):
+		# Traduz e envia em pipeline; criar ou remover um dispositivo envia o que esta pendente, para que os comandos seguintes
+		# resolvam o ifindex do dispositivo novo (e nao o do removido, ex. IFB recriada). Sintaxe sem traducao e executada pelo tc/ip como fallback.
+		# Sem resposta do kernel (timeout/ENOBUFS) o backend e abandonado: os pendentes e os restantes seguem pelo tc/ip.
+		success = True; pending = []; started = time.monotonic()
+		def run_exec(entry):
+			nonlocal success
+			try: ok = self._exec_command(entry['cmd'], check=not entry['failure_ok'], failure_ok=entry['failure_ok'], context=entry['context'])
+			except Exception: ok = False
+			if not ok and entry['fatal']: success = False
+		def fail_over(error):
+			# Nao se sabe quais dos pendentes chegaram ao kernel: repeti-los todos (replace e idempotente, 'File exists' e ignorado)
+			self._netlink_failover(label, error)
+			for entry, _msg in pending: run_exec(entry)
+			pending.clear()
+		def send_pending():
+			nonlocal success
+			if not pending: return
+			try:
+				with self._span('netlink', 'cmd', context=label, commands=len(pending)) as span:
+					replies = self._rtnl.request([msg for _entry, msg in pending]); span['errors'] = sum(1 for error, _text in replies if error)
+			except RtnlTransportError as e: fail_over(e); return
+			for (entry, _msg), (error, text) in zip(pending, replies):
+				if error and not self._report_netlink_failure(entry, error, text, label): success = False
+			pending.clear()
+		for entry in entries:
+			if self._rtnl is None: run_exec(entry); continue
+			try:
+				try: msg_type, flags, body = self._rtnl.translate(entry['cmd'])
+				except RtnlError as e:
+					if len(e.args) < 2 or e.args[1] != errno.ENODEV or not pending: raise
+					send_pending()
+					if self._rtnl is None: run_exec(entry); continue
+					msg_type, flags, body = self._rtnl.translate(entry['cmd'])
+				pending.append((entry, self._rtnl.message(msg_type, flags, body)))
+				if entry['cmd'][:3] in (['ip', 'link', 'add'], ['ip', 'link', 'del']): send_pending()
+			except RtnlTransportError as e:
+				fail_over(e); run_exec(entry)
+			except RtnlError as e:
+				if len(e.args) >= 2 and e.args[1] == errno.ENODEV:
+					if not self._report_netlink_failure(entry, errno.ENODEV, e.args[0], label): success = False
+					continue
+				logger.debug("Sem traducao netlink para '%s' (%s); usando %s.", entry['cmd_str'], e, entry['cmd'][0])
+				send_pending(); run_exec(entry)
+		send_pending()
+		logger.debug("Segmento netlink '%s': %d comandos em %.1f ms.", label, len(entries), (time.monotonic() - started) * 1000)
+		return success
+
+	def _report_netlink_failure(self, entry, error, text, label):
+		if error == errno.ENODEV and text: msg = text
+		else: msg = f"RTNETLINK answers: {os.strerror(error)}" + (f" ({text})" if text else "")
+		ctx = f" [{entry['context']}]" if entry['context'] else ""
+		is_replace_exists_error = (error == errno.EEXIST and ("replace" in entry['cmd'] or "add" in entry['cmd']))
+		if entry['failure_ok'] or is_replace_exists_error:
+			logger.debug("Falha (ignorada) netlink%s: %s: %s", ctx, entry['cmd_str'], msg); return True
+		logger.error(f"Falha no comando {entry['cmd_str']}{ctx} (netlink '{label}'): {msg}")
+		return not entry['fatal']
 
-	def _run_command(self, cmd, check=True, failure_ok=False, log_output=False):
+	def _replay_batch_entries(self, entries):
+		success = True
+		for entry in entries:
+			try:
+				ok = self._run_command(entry['cmd'], check=not entry['failure_ok'], failure_ok=entry['failure_ok'], context=entry['context'])
+			except Exception: ok = False
+			if not ok and entry['fatal']: success = False
+		return success
+
+	def _run_command(self, cmd, check=True, failure_ok=False, log_output=False, context=None):
+		# Como no modo exec, falhas em comandos de servico (contexto explicito) sao registadas mas nao invalidam a interface
+		if self._plan_record is not None: self._plan_record.append([cmd, check, failure_ok, context, self._cmd_context])
+		fatal = context is None
+		context = context or self._cmd_context
+		if self._batch is not None and cmd[0] in self.BATCH_TOOLS: return self._queue_command(cmd, failure_ok, context, fatal)
+		if self._rtnl is not None and cmd[0] in self.BATCH_TOOLS:
+			self._batch = []; self._queue_command(cmd, failure_ok, context, fatal); entries = self._batch; self._batch = None
+			if self._run_netlink_segment(entries, cmd[0]) or failure_ok: return True
+			if check: raise RtnlError(f"Falha no comando {entries[0]['cmd_str']}")
+			return False
+		return self._exec_command(cmd, check, failure_ok, log_output, context)
+
+	def _exec_command(self, cmd, check=True, failure_ok=False, log_output=False, context=None):
 		try:
 			cmd_str = ' '.join(shlex.quote(c) for c in cmd)
-			logger.debug(f"Executando comando: {cmd_str}")
-			result = subprocess.run(cmd, check=check, capture_output=True, text=True, timeout=20)
+			if context: cmd_str = f"{cmd_str} [{context}]"
+			logger.debug("Executando comando: %s", cmd_str)
+			with self._span(cmd[0], 'cmd', cmd=cmd_str) as span:
+				try: result = subprocess.run(cmd, check=check, capture_output=True, text=True, timeout=20); span['status'] = result.returncode
+				except subprocess.CalledProcessError as e: span['status'] = e.returncode; raise
 			if result.stdout and log_output:
-				logger.debug(f"Saida: {result.stdout.strip()}")
+				logger.debug("Saida: %s", result.stdout.strip())
 			elif result.stdout:
-				logger.debug(f"Comando teve saida stdout (nao mostrada)")
+				logger.debug("Comando teve saida stdout (nao mostrada)")
 
 			if result.stderr:
 				log_level_stderr = logging.DEBUG if failure_ok else logging.WARNING
 				is_replace_exists_error = ("RTNETLINK answers: File exists" in result.stderr and ("replace" in cmd or "add" in cmd))
 				if not is_replace_exists_error:
-					logger.log(log_level_stderr, f"Erros/Warnings do comando: {result.stderr.strip()}")
+					logger.log(log_level_stderr, "Erros/Warnings do comando: %s", result.stderr.strip())
 				else:
-					logger.debug(f"Warning (ignorado) ao operar em objeto existente: {result.stderr.strip()}")
+					logger.debug("Warning (ignorado) ao operar em objeto existente: %s", result.stderr.strip())
 			return True
 		except subprocess.CalledProcessError as e:
 			log_level = logging.DEBUG if failure_ok else logging.ERROR
-			logger.log(log_level, f"Falha no comando {cmd_str}: {e.stderr.strip()}")
+			logger.log(log_level, "Falha no comando %s: %s", cmd_str, e.stderr.strip())
 			if check and not failure_ok:
 				raise
 			return False
@@ -75,7 +1121,17 @@ class QoSEngineMacroParserValidated:
 		if not re.match(r'^\d+(\.\d+)?\s*(kbit|mbit|gbit|bit)$', value.lower()):
 			logger.warning(f"Formato/unidade de banda invalida para {context_msg}: '{value}'. Ignorando.")
 			return None
-		return value
+		bps = self._parse_rate_bps(value)
+		if not bps: logger.warning(f"Banda nula para {context_msg}: '{value}'. Ignorando."); return None
+		return bps
+
+	def _parse_rate_bps(self, value):
+		# Converte '200Mbit', '500kbit' ou '1.5Mbit' (unidades SI do tc) em bit/s inteiros
+		if value is None: return None
+		if isinstance(value, int): return value
+		m = re.match(r'^(\d+(?:\.\d+)?)\s*([kmgt]?)bit$', str(value).strip().lower())
+		if not m: return None
+		return int(float(m.group(1)) * {'': 1, 'k': 10**3, 'm': 10**6, 'g': 10**9, 't': 10**12}[m.group(2)])
 
 	def _validate_priority(self, value, context_msg, default_prio=7):
 		if value is None:
@@ -90,6 +1146,118 @@ class QoSEngineMacroParserValidated:
 			logger.warning(f"Valor de prioridade invalido '{value}' para {context_msg}. Usando default {default_prio}.")
 			return default_prio
 
+	def _validate_classifier(self, value, context_msg):
+		if value is None: return 'u32'
+		if not isinstance(value, str) or value.lower() not in self.CLASSIFIERS:
+			logger.warning(f"Classificador invalido para {context_msg}: '{value}' (validos: {', '.join(self.CLASSIFIERS)}). Usando u32.")
+			return 'u32'
+		return value.lower()
+
+	def _validate_topology(self, value, context_msg):
+		if value is None: return 'htb'
+		if not isinstance(value, str) or value.lower() not in self.TOPOLOGIES:
+			logger.warning(f"Topologia invalida para {context_msg}: '{value}' (validas: {', '.join(self.TOPOLOGIES)}). Usando htb.")
+			return 'htb'
+		return value.lower()
+
+	def _validate_queues(self, value, context_msg):
+		if value is None: return None
+		try: queues = int(value)
+		except (ValueError, TypeError): queues = 0
+		if not 1 <= queues <= self.MAX_QUEUES:
+			logger.warning(f"Numero de filas invalido para {context_msg}: '{value}' (1-{self.MAX_QUEUES}). Usando as filas da NIC.")
+			return None
+		return queues
+
+	def _parse_leaf_value(self, value, unit):
+		# Normaliza para as unidades que o kernel devolve (us, bytes, contagem) para comparar no reconcile
+		value = str(value).strip().lower()
+		if unit == 'time': m = re.match(r'^(\d+(?:\.\d+)?)\s*(s|sec|ms|msec|us|usec)?$', value); scale = {'s': 10**6, 'sec': 10**6, 'ms': 1000, 'msec': 1000}
+		elif unit == 'size': m = re.match(r'^(\d+(?:\.\d+)?)\s*(b|k|kb|m|mb|g|gb)?$', value); scale = {'k': 1024, 'kb': 1024, 'm': 1024**2, 'mb': 1024**2, 'g': 1024**3, 'gb': 1024**3}
+		else: m = re.match(r'^(\d+)()$', value); scale = {}
+		if not m: return None
+		result = int(float(m.group(1)) * scale.get(m.group(2), 1))
+		return result if 0 < result <= 0xFFFFFFFF else None
+
+	def _parse_leaf_macros(self, raw_macros, prefix, ctx):
+		# prefix: 'QOS_SRV_<nome>_LEAF_' ou 'QOS_IF_<KEY>_DEFAULT_LEAF_'
+		kind = self._get_macro_value(raw_macros, f"{prefix}QDISC", ctx)
+		if kind is None: return None
+		if kind.lower() not in self.LEAF_QDISCS:
+			logger.warning(f"Qdisc folha invalida para {ctx}: '{kind}' (validas: {', '.join(self.LEAF_QDISCS)}). Ignorando.")
+			return None
+		kind = kind.lower(); params = []
+		for param, unit in self.LEAF_PARAM_UNITS.items():
+			value = self._get_macro_value(raw_macros, f"{prefix}{param.upper()}", ctx)
+			if value is None: continue
+			keyword = self.LEAF_QDISCS[kind].get(param)
+			if keyword is None: logger.warning(f"Parametro {prefix}{param.upper()} nao se aplica a {kind} ({ctx}). Ignorando."); continue
+			canonical = self._parse_leaf_value(value, unit)
+			if canonical is None: logger.warning(f"Valor invalido para {prefix}{param.upper()} ({ctx}): '{value}'. Ignorando."); continue
+			params.append((keyword, value, canonical))
+		return {'kind': kind, 'params': params, 'source': f"{prefix}*"}
+
+	def _parse_autorate_macros(self, raw_macros, prefix, ctx, if_cfg):
+		# prefix: 'QOS_IF_<KEY>_AUTORATE_'; autorate ativo por direcao quando <DIR>_MIN esta definido (MAX por omissao = banda total)
+		directions = {}
+		for direction in ('upload', 'download'):
+			min_raw = self._get_macro_value(raw_macros, f"{prefix}{direction.upper()}_MIN", ctx)
+			if min_raw is None: continue
+			min_bps = self._validate_rate_ceil(min_raw, f"{ctx} autorate {direction} min")
+			max_raw = self._get_macro_value(raw_macros, f"{prefix}{direction.upper()}_MAX", ctx)
+			max_bps = self._validate_rate_ceil(max_raw, f"{ctx} autorate {direction} max") if max_raw is not None else if_cfg[f'total_{direction}_bw']
+			if not min_bps or not max_bps or min_bps > max_bps: logger.warning(f"Limites autorate {direction} invalidos para {ctx} (min {min_raw}, max {max_raw}). Autorate {direction} desativado."); continue
+			directions[direction] = {'min': min_bps, 'max': max_bps}
+		if not directions: return None
+		reflector = self._get_macro_value(raw_macros, f"{prefix}REFLECTOR", ctx)
+		probe_cmd = self._get_macro_value(raw_macros, f"{prefix}PROBE_CMD", ctx)
+		if not reflector and not probe_cmd: logger.warning(f"Autorate para {ctx} sem {prefix}REFLECTOR nem {prefix}PROBE_CMD. Autorate desativado."); return None
+		timing = {}
+		for name, default in (('interval', '500ms'), ('threshold', '15ms')):
+			raw = self._get_macro_value(raw_macros, f"{prefix}{name.upper()}", ctx, default_value=default)
+			timing[name] = self._parse_leaf_value(raw, 'time')
+			if timing[name] is None: logger.warning(f"Valor invalido para {prefix}{name.upper()} ({ctx}): '{raw}'. Usando {default}."); timing[name] = self._parse_leaf_value(default, 'time')
+		return {'directions': directions, 'reflector': reflector, 'probe_cmd': probe_cmd, 'interval_us': timing['interval'], 'threshold_us': timing['threshold'], 'source': f"{prefix}*"}
+
+	def _parse_per_host_macros(self, raw_macros, prefix, ctx):
+		# prefix: 'QOS_SRV_<nome>_'; rate/ceil por host opcionais (default: rate do servico repartido, ceil do servico)
+		subnet_raw = self._get_macro_value(raw_macros, f"{prefix}PER_HOST_SUBNET", ctx)
+		if subnet_raw is None: return None
+		try: network = ipaddress.IPv4Network(subnet_raw)
+		except ValueError: logger.warning(f"Subrede invalida em {prefix}PER_HOST_SUBNET ({ctx}): '{subnet_raw}'. Equidade por host desativada."); return None
+		if not self.PER_HOST_MIN_PREFIX <= network.prefixlen <= 30: logger.warning(f"{prefix}PER_HOST_SUBNET ({ctx}) deve ter prefixo /{self.PER_HOST_MIN_PREFIX} a /30 (hosts no ultimo octeto): '{subnet_raw}'. Equidade por host desativada."); return None
+		per_host = {'subnet': str(network), 'source': f"{prefix}PER_HOST_*"}
+		for direction in ('upload', 'download'):
+			per_host[direction] = {}
+			for param in ('rate', 'ceil'):
+				raw = self._get_macro_value(raw_macros, f"{prefix}PER_HOST_{direction.upper()}_{param.upper()}", ctx)
+				if raw is not None: per_host[direction][param] = self._validate_rate_ceil(raw, f"{ctx} per_host {direction} {param}")
+		return per_host
+
+	def _parse_lan_macros(self, raw_macros):
+		# None no modo ifb (default); False se o modo lan estiver mal configurado
+		ctx = "modo de download"
+		mode = (self._get_macro_value(raw_macros, "QOS_DOWNLOAD_MODE", ctx, default_value="ifb") or '').lower()
+		if mode not in self.DOWNLOAD_MODES: logger.error(f"QOS_DOWNLOAD_MODE invalido: '{mode}' (validos: {', '.join(self.DOWNLOAD_MODES)})."); return False
+		if mode == 'ifb': return None
+		dev = self._get_macro_value(raw_macros, "QOS_LAN_IFACE", ctx, is_critical=True)
+		mask = self._validate_mark(self._get_macro_value(raw_macros, "QOS_LAN_WAN_MARK_MASK", ctx, default_value=hex(self.LAN_WAN_MARK_MASK)), "QOS_LAN_WAN_MARK_MASK")
+		if not dev or mask is None: return False
+		if self.DEFAULT_MARK & mask: logger.error(f"QOS_LAN_WAN_MARK_MASK {mask:#x} sobrepoe-se a marca default {self.DEFAULT_MARK:#x}."); return False
+		return {'dev': dev, 'mask': mask}
+
+	def _parse_snat_rule(self, tokens):
+		# Regra da seccao snat do foomuuri: apenas 'saddr' e 'oifname' interessam (enderecos LAN reescritos a saida dessa interface)
+		rule = {'saddr': [], 'oifname': []}; current = None
+		for token in tokens:
+			if token in rule: current = token; continue
+			if current == 'saddr':
+				try: rule['saddr'].append(str(ipaddress.IPv4Network(token, strict=False))); continue
+				except ValueError: pass
+			elif current == 'oifname' and not token.startswith('-'): rule['oifname'].append(token)
+			current = None
+		return rule
+
 	def _validate_mark(self, value, context_msg):
 		if value is None:
 			return None
@@ -105,82 +1273,266 @@ class QoSEngineMacroParserValidated:
 	def _validate_suffix(self, value, context_msg):
 		if value is None:
 			return None
+		if isinstance(value, str) and value.lower() == self.AUTO_SUFFIX:
+			return self.AUTO_SUFFIX
 		if not isinstance(value, str) or not value.isdigit():
-			logger.error(f"Valor de class_id_suffix invalido para {context_msg}: '{value}' (deve ser string numerica).")
+			logger.error(f"Valor de class_id_suffix invalido para {context_msg}: '{value}' (deve ser string numerica ou '{self.AUTO_SUFFIX}').")
+			return None
+		return value
+
+	def _validate_default_id(self, value, context_msg):
+		# ID da classe default (ex. '1:30'): o minor e hexadecimal para o tc, como os sufixos das classes dos servicos
+		if value is None:
+			return None
+		if not isinstance(value, str) or not re.fullmatch(r'([0-9a-fA-F]{1,4}:)?[0-9a-fA-F]{1,4}', value):
+			logger.error(f"ID de classe default invalido para {context_msg}: '{value}' (deve ser '<major>:<minor>' em hex, ex: '1:30').")
 			return None
 		return value
 
 	def _get_macro_value(self, raw_macros, macro_name, context_msg, is_critical=False, default_value=None):
 		value = raw_macros.get(macro_name)
 		if value is None:
-			log_func = logger.error if is_critical else logger.debug
-			log_func(f"Macro {'obrigatorio' if is_critical else 'opcional'} {'em falta' if is_critical else 'nao encontrado'} para {context_msg}: {macro_name}" + (f". Usando default: {default_value}" if not is_critical and default_value is not None else ""))
+			# Macro opcional em falta e o caso comum no parse (um por campo nao definido): a mensagem so e formatada com DEBUG ativo
+			if is_critical: logger.error(f"Macro obrigatorio em falta para {context_msg}: {macro_name}")
+			elif default_value is not None: logger.debug("Macro opcional nao encontrado para %s: %s. Usando default: %s", context_msg, macro_name, default_value)
+			else: logger.debug("Macro opcional nao encontrado para %s: %s", context_msg, macro_name)
 			return default_value
-		logger.debug(f"Macro lido para {context_msg}: {macro_name} = '{value}'")
+		if logger.isEnabledFor(logging.DEBUG): logger.debug("Macro lido para %s: %s = '%s' (%s)", context_msg, macro_name, value, self._macro_location(macro_name))
 		return value
 
+	def _macro_location(self, macro_name):
+		entry = self.macro_index.get(macro_name)
+		return f"{entry['file']}:{entry['line']}" if entry else "sem origem"
+
+	def _conf_files(self):
+		return FoomuuriConfReader.paths(self.foomuuri_config_path)
+
+	def _load_parse_cache(self):
+		# So no primeiro parsing do processo; depois o reader ja tem o estado atual em memoria
+		if not self.parse_cache or self.conf_reader.files: return
+		cached = self._read_json(self.parse_cache)
+		if not isinstance(cached, dict) or cached.get('engine') != self._engine_hash() or not isinstance(cached.get('files'), dict): return
+		self.conf_reader.files = {path: entry for path, entry in cached['files'].items() if isinstance(entry, dict) and all(k in entry for k in FoomuuriConfReader.ENTRY_KEYS)}
+
+	def _save_parse_cache(self):
+		if self.parse_cache and self.conf_reader.dirty and self._write_json_atomic(self.parse_cache, {'engine': self._engine_hash(), 'files': self.conf_reader.files}): self.conf_reader.dirty = False
+
+	def _index_prefixed_macros(self, raw_macros, prefix, names):
+		# Uma passagem pelos macros: <prefixo><nome>_<CAMPO> -> {nome: {CAMPO: valor}}. Nomes com '_' resolvem-se pelo nome conhecido
+		# mais longo (corte no '_' mais a direita primeiro); macros de nomes fora da lista sao ignorados, como antes
+		index = {name: {} for name in names}
+		for macro_name, value in raw_macros.items():
+			if not macro_name.startswith(prefix): continue
+			rest = macro_name[len(prefix):]; cut = rest.rfind('_')
+			while cut > 0:
+				fields = index.get(rest[:cut])
+				if fields is not None: fields[rest[cut + 1:]] = value; break
+				cut = rest.rfind('_', 0, cut)
+		return index
+
+	def _override_keys(self, raw_macros, interface_names_map, lan):
+		# <CHAVE> de OVERRIDE_<CHAVE>_<DIR>_* -> (dispositivo, rank): upload pela chave da interface; download pelo nome da IFB (rank 0)
+		# com fallback na chave da interface (rank 1), ou no modo lan so pela chave da interface (o override fica sob o nome da WAN)
+		keys = {'UPLOAD': {}, 'DOWNLOAD': {}}
+		for if_key, if_name_val in interface_names_map.items():
+			keys['UPLOAD'][if_key] = (if_name_val, 0)
+			if lan: keys['DOWNLOAD'][if_key] = (if_name_val, 0); continue
+			ifb_name = raw_macros.get(f"{self.IFACE_PREFIX}{if_key}_IFB")
+			if ifb_name: keys['DOWNLOAD'][ifb_name.upper()] = (ifb_name, 0); keys['DOWNLOAD'].setdefault(if_key, (ifb_name, 1))
+		return keys
+
+	def _parse_mark_ranges(self, value, macro_name):
+		# "0x1000-0x10ff 0x2000": intervalos inclusivos e marcas soltas, pela ordem dada
+		marks = []
+		for token in value.split('#', 1)[0].split():
+			first_raw, _sep, last_raw = token.partition('-')
+			first = self._validate_mark(first_raw, macro_name); last = self._validate_mark(last_raw or first_raw, macro_name)
+			if first is None or last is None or last < first: logger.error(f"Intervalo de marcas invalido em {macro_name}: '{token}'. Ignorando o template."); return None
+			if len(marks) + last - first + 1 > self.MAX_TEMPLATE_MARKS: logger.error(f"{macro_name} gera mais de {self.MAX_TEMPLATE_MARKS} servicos. Ignorando o template."); return None
+			marks.extend(range(first, last + 1))
+		return marks
+
+	def _parse_service_fields(self, fields, prefix, ctx, override_keys):
+		# Campos presentes de um servico ou template ({CAMPO: valor} de QOS_SRV_<nome>_* / QOS_TPL_<nome>_*), ja validados; um campo
+		# invalido fica None (a direcao fica incompleta, como antes). A instancia sobrepoe-se ao template campo a campo
+		parsed = {}
+		if 'MARK' in fields: parsed['mark'] = self._validate_mark(fields['MARK'], f"{ctx} mark")
+		if 'PRIORITY' in fields: parsed['priority'] = self._validate_priority(fields['PRIORITY'], f"{ctx} priority")
+		if 'CLASS_BASE' in fields:
+			base = self._validate_mark(fields['CLASS_BASE'], f"{ctx} class_base")
+			if base is not None and not 2 <= base <= self.MAX_MINOR: logger.warning(f"{prefix}CLASS_BASE ({ctx}) fora de 0x2-{self.MAX_MINOR:#x}. Ignorando."); base = None
+			parsed['class_base'] = base
+		for direction, default_fprio in (('upload', 10), ('download', 15)):
+			key = direction.upper(); values = {}
+			if f"{key}_SUFFIX" in fields: values['class_id_suffix'] = self._validate_suffix(fields[f"{key}_SUFFIX"], f"{ctx} {direction}_suffix")
+			for param in ('rate', 'ceil'):
+				if f"{key}_{param.upper()}_DEFAULT" in fields: values[param] = self._validate_rate_ceil(fields[f"{key}_{param.upper()}_DEFAULT"], f"{ctx} {direction}_{param}_default")
+			if f"{key}_FILTER_PRIO_DEFAULT" in fields: values['filter_priority'] = self._validate_priority(fields[f"{key}_FILTER_PRIO_DEFAULT"], f"{ctx} {direction}_filter_priority", default_fprio)
+			if values: values['source'] = f"{prefix}{key}_*"; parsed[direction] = values
+		overrides = {}; scoped = False
+		for field, value in fields.items():
+			if field.startswith(('LEAF_', 'PER_HOST_')): scoped = True; continue
+			if not field.startswith('OVERRIDE_'): continue
+			parts = field[len('OVERRIDE_'):].rsplit('_', 2)
+			target = override_keys.get(parts[1], {}).get(parts[0]) if len(parts) == 3 and parts[2] in ('RATE', 'CEIL') else None
+			if target is None: logger.warning(f"{prefix}{field} ({ctx}) nao corresponde a nenhuma interface/IFB configurada. Ignorando."); continue
+			dev, rank = target; direction = parts[1].lower(); param = parts[2].lower()
+			bps = self._validate_rate_ceil(value, f"{ctx} override {dev} {direction}_{param}")
+			slot = (dev, direction, param)
+			if bps and (slot not in overrides or rank < overrides[slot][0]): overrides[slot] = (rank, bps, f"{prefix}OVERRIDE_{parts[0]}_{parts[1]}_*")
+		if overrides: parsed['overrides'] = overrides
+		if scoped:
+			# Os parsers de LEAF_/PER_HOST_ leem pelo nome completo (mensagens e 'source' com o prefixo do servico/template)
+			macros = {f"{prefix}{field}": value for field, value in fields.items()}
+			leaf = self._parse_leaf_macros(macros, f"{prefix}LEAF_", ctx); per_host = self._parse_per_host_macros(macros, prefix, ctx)
+			if leaf: parsed['leaf'] = leaf
+			if per_host: parsed['per_host'] = per_host
+		return parsed
+
+	def _build_service(self, srv_key, fields, tpl_key, mark, templates, lan, override_keys):
+		# Servico final: campos do template (QOS_SRV_<nome>_TEMPLATE ou instancia de QOS_TPL_<template>_MARKS) sobrepostos pelos do servico;
+		# com template, o sufixo em falta e 'auto'
+		srv_ctx = f"servico '{srv_key}'"; srv_prefix = f"{self.SERVICE_PREFIX}{srv_key}_"; instance = mark is not None
+		tpl_key = tpl_key or fields.get('TEMPLATE')
+		if tpl_key is not None and tpl_key not in templates: logger.warning(f"{srv_prefix}TEMPLATE: template '{tpl_key}' nao esta em {self.TEMPLATE_LIST_MACRO}. Ignorando servico."); return None
+		own = self._parse_service_fields(fields, srv_prefix, srv_ctx, override_keys); base = templates[tpl_key] if tpl_key else {}
+		merged = {**base, **own}
+		for key in ('upload', 'download', 'overrides'):
+			if key in base and key in own: merged[key] = {**base[key], **own[key]}
+		if mark is None:
+			if 'MARK' not in fields: logger.error(f"Macro obrigatorio em falta para {srv_ctx}: {srv_prefix}MARK")
+			mark = merged.get('mark')
+		if mark is None: logger.warning(f"Marca invalida ou em falta para {srv_ctx}. Ignorando servico."); return None
+		if lan and mark & lan['mask']: logger.warning(f"Marca {mark:#x} de {srv_ctx} usa bits de QOS_LAN_WAN_MARK_MASK {lan['mask']:#x}. Ignorando servico."); return None
+
+		srv_cfg = {'name': srv_key, 'mark': mark, 'priority': merged.get('priority', 5)}
+		if tpl_key: srv_cfg['template'] = tpl_key
+		if instance: srv_cfg['mark_source'] = f"{self.TEMPLATE_PREFIX}{tpl_key}_MARKS"
+		if merged.get('leaf'): srv_cfg['leaf'] = merged['leaf']
+		if merged.get('per_host'): srv_cfg['per_host'] = merged['per_host']
+		for direction, default_fprio in (('upload', 10), ('download', 15)):
+			values = merged.get(direction, {})
+			suffix = values['class_id_suffix'] if 'class_id_suffix' in values else (self.AUTO_SUFFIX if tpl_key else None)
+			if all([suffix, values.get('rate'), values.get('ceil')]):
+				srv_cfg[direction] = {'class_id_suffix': suffix, 'rate': values['rate'], 'ceil': values['ceil'], 'filter_priority': values.get('filter_priority', default_fprio), 'source': values['source']}
+
+		# Override por dispositivo so com rate e ceil validos (cada um pode vir do nome da IFB ou, em fallback, da chave da interface)
+		interfaces = {}
+		for (dev, direction, param), (_rank, bps, source) in merged.get('overrides', {}).items():
+			if direction in srv_cfg: interfaces.setdefault(dev, {}).setdefault(direction, {'sources': set()}).update({param: bps}); interfaces[dev][direction]['sources'].add(source)
+		for dev, directions in interfaces.items():
+			for direction, values in directions.items():
+				if 'rate' in values and 'ceil' in values: srv_cfg.setdefault('interfaces', {}).setdefault(dev, {})[direction] = {'rate': values['rate'], 'ceil': values['ceil'], 'source': ' / '.join(sorted(values['sources']))}
+
+		if 'per_host' in srv_cfg and any(srv_cfg[d]['class_id_suffix'] != self.AUTO_SUFFIX and len(srv_cfg[d]['class_id_suffix'].lstrip('0') or '0') > 2 for d in ('upload', 'download') if d in srv_cfg):
+			logger.error(f"{srv_ctx}: {srv_prefix}PER_HOST_SUBNET exige sufixos de classe com ate 2 digitos (subclasses <sufixo><octeto>). Equidade por host desativada."); del srv_cfg['per_host']
+		if 'upload' not in srv_cfg and 'download' not in srv_cfg:
+			logger.warning(f"Servico {srv_key} (marca {mark:#04x}) nao tem configuracao de upload nem download valida apos parsing. Ignorando."); return None
+		return srv_cfg
+
+	def _allocate_class_ids(self, services, class_bases):
+		# Minors das classes dos servicos (o sufixo e hexadecimal para o tc), por direcao. Reservados: 0 (qdisc), 1 (classe raiz N:1) e os
+		# ids default das interfaces; um servico com PER_HOST ocupa ainda o bloco <minor>00-<minor>ff das subclasses por host (a prio 100 +
+		# minor e a tabela 0x900 + minor dos seus filtros ficam assim unicas). Primeiro os sufixos manuais, pela ordem dos servicos: uma
+		# colisao e erro e essa direcao e ignorada. Depois os 'auto', com o mesmo minor nas duas direcoes: servicos com PER_HOST no primeiro
+		# livre de 0x2-0xff, os restantes a partir de AUTO_MINOR_START (ou de QOS_TPL_<template>_CLASS_BASE). Os cursores so avancam
+		owners = {d: {0: "o qdisc", 1: "a classe raiz"} for d in ('upload', 'download')}
+		blocks = {d: {} for d in owners}; high = {d: {} for d in owners}
+
+		def claim(direction, minor, per_host, owner):
+			owners[direction][minor] = owner; high[direction].setdefault(minor >> 8, owner)
+			if per_host: blocks[direction][minor] = owner
+
+		def conflict(direction, minor, per_host):
+			if minor in owners[direction]: return owners[direction][minor]
+			if minor >> 8 in blocks[direction]: return f"as subclasses por host de {blocks[direction][minor >> 8]}"
+			if per_host and minor in high[direction]: return f"{high[direction][minor]} (no bloco {minor:x}00-{minor:x}ff das subclasses por host)"
+			return None
+
+		for if_cfg in self.config['interfaces']:
+			for direction in owners:
+				claim(direction, int(if_cfg[f'default_{direction}_class']['id'].split(':')[-1], 16), False, f"a classe default {direction} de {if_cfg['name']}")
+		for srv in services:
+			per_host = 'per_host' in srv
+			for direction in owners:
+				suffix = srv.get(direction, {}).get('class_id_suffix')
+				if suffix is None or suffix == self.AUTO_SUFFIX: continue
+				minor = int(suffix, 16); clash = f"o limite {self.MAX_MINOR:#x}" if minor > self.MAX_MINOR else conflict(direction, minor, per_host)
+				if clash: logger.error(f"Classe {direction} :{suffix} do servico '{srv['name']}' colide com {clash}. Direcao {direction} ignorada."); del srv[direction]; continue
+				claim(direction, minor, per_host, f"o servico '{srv['name']}'")
+
+		cursors = {}; allocated = 0
+		for srv in sorted(services, key=lambda s: 'per_host' not in s):
+			directions = [d for d in owners if srv.get(d, {}).get('class_id_suffix') == self.AUTO_SUFFIX]
+			if not directions: continue
+			per_host = 'per_host' in srv
+			start, limit = (2, 0xff) if per_host else (class_bases.get(srv.get('template')) or self.AUTO_MINOR_START, self.MAX_MINOR)
+			minor = cursors.get((start, limit), start)
+			while minor <= limit and any(conflict(d, minor, per_host) for d in directions): minor += 1
+			if minor > limit:
+				logger.error(f"Sem minors livres ({start:#x}-{limit:#x}) para o servico '{srv['name']}'. Ignorando {'/'.join(directions)}.")
+				for d in directions: del srv[d]
+				continue
+			cursors[(start, limit)] = minor + 1; allocated += 1
+			for d in directions: claim(d, minor, per_host, f"o servico '{srv['name']}'"); srv[d]['class_id_suffix'] = f"{minor:x}"
+		if allocated: logger.info(f"Classes atribuidas automaticamente a {allocated} servicos.")
+
+		kept = [srv for srv in services if 'upload' in srv or 'download' in srv]
+		if len(kept) < len(services): logger.warning(f"{len(services) - len(kept)} servicos ficaram sem classes validas. Ignorados.")
+		return kept
+
 	def _parse_macros_from_foomuuri_conf(self):
 		logger.info(f"Lendo macros de QoS de: {self.foomuuri_config_path}")
-		if not self.foomuuri_config_path.is_file():
-			logger.error(f"Ficheiro de configuração Foomuuri não encontrado: {self.foomuuri_config_path}")
+		if not self._conf_files():
+			logger.error(f"Configuração Foomuuri não encontrada (ficheiro, ou diretorio com *.conf): {self.foomuuri_config_path}")
 			return False
 
-		raw_macros = {}
-		in_macro_section = False
-		macro_regex = re.compile(r'^\s*([A-Za-z0-9_]+)\s+(?:"([^"]*)"|\'([^\']*)\'|([^\s#]+))')
-
 		try:
-			with open(self.foomuuri_config_path, 'r') as f:
-				for line_num, line_content in enumerate(f, 1):
-					line = line_content.strip()
-					if line.lower().startswith("macro {"):
-						in_macro_section = True
-						continue
-					if line == "}":
-						in_macro_section = False
-						continue
-					
-					if in_macro_section and not line.startswith("#") and line:
-						match = macro_regex.match(line)
-						if match:
-							macro_name = match.group(1)
-							macro_value = match.group(2) or match.group(3) or match.group(4)
-							raw_macros[macro_name] = macro_value
+			self._load_parse_cache()
+			self.macro_index, snat_rules = self.conf_reader.load(self.foomuuri_config_path)
 		except Exception as e:
 			logger.error(f"Erro ao ler ou parsear {self.foomuuri_config_path}: {e}")
 			return False
+		stats = self.conf_reader.stats
+		(logger.info if stats['parsed'] + stats['reused'] > 1 else logger.debug)(f"Ficheiros de conf: {stats['parsed']} analisados, {stats['reused']} reutilizados sem alteracoes; {len(self.macro_index)} macros.")
+		self._save_parse_cache()
+		raw_macros = {name: entry['value'] for name, entry in self.macro_index.items()}
+		self.config['snat'] = [self._parse_snat_rule(rule['tokens']) for rule in snat_rules]
 
 		interface_names_map = {}
 		for name, value in raw_macros.items():
 			if name.startswith(self.IFACE_PREFIX) and name.endswith("_NAME"):
 				key_part = name[len(self.IFACE_PREFIX):-len("_NAME")]
 				interface_names_map[key_part] = value
-		logger.debug(f"Nomes de interface (chaves macro) encontrados: {list(interface_names_map.keys())}")
+		logger.debug("Nomes de interface (chaves macro) encontrados: %s", list(interface_names_map))
 
 		if not interface_names_map:
 			logger.error("Nenhum macro de definicao de interface (ex: QOS_IF_ENP1S0_NAME) encontrado. Abortando.")
 			return False
+		lan = self._parse_lan_macros(raw_macros)
+		if lan is False: return False
+		self.config['lan'] = lan; lan_marks = {}
 
 		for if_key, if_name_val in interface_names_map.items():
 			ctx = f"interface '{if_name_val}' (chave macro {if_key})"
-			logger.debug(f"Processando {ctx}")
-			if_cfg = {'name': if_name_val}
+			logger.debug("Processando %s", ctx)
+			if_cfg = {'name': if_name_val, 'key': if_key}
 
-			if_cfg['ifb'] = self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_IFB", ctx, is_critical=True)
+			if_cfg['ifb'] = None if lan else self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_IFB", ctx, is_critical=True)
 			if_cfg['total_upload_bw'] = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_TOTAL_UPLOAD_BW", ctx, is_critical=True), f"{ctx} total_upload_bw")
 			if_cfg['total_download_bw'] = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_TOTAL_DOWNLOAD_BW", ctx, is_critical=True), f"{ctx} total_download_bw")
 			
-			def_up_id = self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_UPLOAD_ID", ctx, is_critical=True)
+			def_up_id = self._validate_default_id(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_UPLOAD_ID", ctx, is_critical=True), f"{ctx} default_upload_id")
 			def_up_prio_str = self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_UPLOAD_PRIO", ctx, default_value="7")
 			def_up_rate = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_UPLOAD_RATE", ctx, is_critical=True), f"{ctx} default_upload_rate")
 			def_up_ceil = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_UPLOAD_CEIL", ctx, is_critical=True), f"{ctx} default_upload_ceil")
 
-			def_dl_id = self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_DOWNLOAD_ID", ctx, is_critical=True)
+			def_dl_id = self._validate_default_id(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_DOWNLOAD_ID", ctx, is_critical=True), f"{ctx} default_download_id")
 			def_dl_prio_str = self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_DOWNLOAD_PRIO", ctx, default_value="7")
 			def_dl_rate = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_DOWNLOAD_RATE", ctx, is_critical=True), f"{ctx} default_download_rate")
 			def_dl_ceil = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_DOWNLOAD_CEIL", ctx, is_critical=True), f"{ctx} default_download_ceil")
 
-			if not all([if_cfg['ifb'], if_cfg['total_upload_bw'], if_cfg['total_download_bw'], 
+			if not all([if_cfg['ifb'] or lan, if_cfg['total_upload_bw'], if_cfg['total_download_bw'], 
 						def_up_id, def_up_rate, def_up_ceil,
 						def_dl_id, def_dl_rate, def_dl_ceil]):
 				logger.error(f"Configuracao de interface base incompleta ou invalida para {ctx}. Ignorando esta interface.")
@@ -196,77 +1548,58 @@ class QoSEngineMacroParserValidated:
 				'priority': self._validate_priority(def_dl_prio_str, f"{ctx} default_download_priority"),
 				'rate': def_dl_rate, 'ceil': def_dl_ceil
 			}
+			if_cfg['classifier'] = self._validate_classifier(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_CLASSIFIER", ctx, default_value="u32"), f"{ctx} classifier")
+			if_cfg['topology'] = self._validate_topology(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_TOPOLOGY", ctx, default_value="htb"), f"{ctx} topology")
+			if_cfg['queues'] = self._validate_queues(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_QUEUES", ctx), f"{ctx} queues")
+			if_cfg['default_leaf'] = self._parse_leaf_macros(raw_macros, f"{self.IFACE_PREFIX}{if_key}_DEFAULT_LEAF_", ctx)
+			if_cfg['autorate'] = self._parse_autorate_macros(raw_macros, f"{self.IFACE_PREFIX}{if_key}_AUTORATE_", ctx, if_cfg)
+			if lan:
+				wan_mark = self._validate_mark(self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_LAN_MARK", ctx, is_critical=True), f"{ctx} lan_mark")
+				if wan_mark is None: logger.error(f"Modo de download lan sem {self.IFACE_PREFIX}{if_key}_LAN_MARK valido para {ctx}. Ignorando esta interface."); continue
+				if wan_mark & ~lan['mask']: logger.error(f"{self.IFACE_PREFIX}{if_key}_LAN_MARK {wan_mark:#x} ({ctx}) tem bits fora de QOS_LAN_WAN_MARK_MASK {lan['mask']:#x}. Ignorando esta interface."); continue
+				if wan_mark in lan_marks: logger.error(f"{self.IFACE_PREFIX}{if_key}_LAN_MARK {wan_mark:#x} ({ctx}) ja usada por {lan_marks[wan_mark]}. Ignorando esta interface."); continue
+				lan_marks[wan_mark] = if_name_val
+				# Hierarquia N: sob a classe 1:N da raiz LAN (N = 2, 3, ... pela ordem das interfaces; a prio do filtro da WAN e N)
+				if_cfg['lan'] = {'dev': lan['dev'], 'mark': wan_mark, 'mask': lan['mask'], 'major': f"{len(lan_marks) + 1:x}", 'source': f"{self.IFACE_PREFIX}{if_key}_LAN_MARK"}
 			self.config['interfaces'].append(if_cfg)
 
 		if not self.config['interfaces']:
 			logger.error("Nenhuma interface WAN foi configurada corretamente a partir dos macros. Abortando.")
 			return False
 
-		service_list_str = self._get_macro_value(raw_macros, self.SERVICE_LIST_MACRO, "lista de servicos", is_critical=True)
-		if not service_list_str:
+		template_keys = (self._get_macro_value(raw_macros, self.TEMPLATE_LIST_MACRO, "lista de templates") or '').split('#', 1)[0].split()
+		service_list_str = self._get_macro_value(raw_macros, self.SERVICE_LIST_MACRO, "lista de servicos", is_critical=not template_keys)
+		if not service_list_str and not template_keys:
 			logger.warning(f"Macro {self.SERVICE_LIST_MACRO} nao encontrado ou vazio. Nenhum servico especifico sera configurado.")
 			return True
 
-		service_list_str = service_list_str.split('#', 1)[0].strip()
-		service_keys = service_list_str.split()
-		
-		if not service_keys: logger.info("Nenhuma chave de servico encontrada em QOS_SERVICE_LIST apos limpeza."); return True
-		logger.debug(f"Chaves de servico para processar: {service_keys}")
+		service_keys = (service_list_str or '').split('#', 1)[0].split()
+		if not service_keys and not template_keys: logger.info("Nenhuma chave de servico encontrada em QOS_SERVICE_LIST apos limpeza."); return True
+		logger.debug("Chaves de servico para processar: %s; templates: %s", service_keys, template_keys)
 
-		for srv_key_from_list in service_keys:
-			srv_ctx = f"servico '{srv_key_from_list}'"
-			srv_prefix = f"{self.SERVICE_PREFIX}{srv_key_from_list}_"
-			
-			mark_val = self._validate_mark(self._get_macro_value(raw_macros, f"{srv_prefix}MARK", srv_ctx, is_critical=True), f"{srv_ctx} mark")
-			prio_val_str = self._get_macro_value(raw_macros, f"{srv_prefix}PRIORITY", srv_ctx, default_value="5")
-			if mark_val is None: logger.warning(f"Marca invalida ou em falta para {srv_ctx}. Ignorando servico."); continue
-			
-			srv_cfg = {'mark': mark_val, 'priority': self._validate_priority(prio_val_str, f"{srv_ctx} priority")}
-			
-			up_sfx = self._validate_suffix(self._get_macro_value(raw_macros, f"{srv_prefix}UPLOAD_SUFFIX", f"{srv_ctx} upload_suffix"), f"{srv_ctx} upload_suffix")
-			up_rate = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}UPLOAD_RATE_DEFAULT", f"{srv_ctx} upload_rate_default"), f"{srv_ctx} upload_rate_default")
-			up_ceil = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}UPLOAD_CEIL_DEFAULT", f"{srv_ctx} upload_ceil_default"), f"{srv_ctx} upload_ceil_default")
-			up_fprio_str = self._get_macro_value(raw_macros, f"{srv_prefix}UPLOAD_FILTER_PRIO_DEFAULT", f"{srv_ctx} upload_filter_prio", default_value="10")
-			if all([up_sfx, up_rate, up_ceil]):
-				srv_cfg['upload'] = {'class_id_suffix': up_sfx, 'rate': up_rate, 'ceil': up_ceil, 'filter_priority': self._validate_priority(up_fprio_str, f"{srv_ctx} upload_filter_priority", 10)}
-
-			dl_sfx = self._validate_suffix(self._get_macro_value(raw_macros, f"{srv_prefix}DOWNLOAD_SUFFIX", f"{srv_ctx} download_suffix"), f"{srv_ctx} download_suffix")
-			dl_rate = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}DOWNLOAD_RATE_DEFAULT", f"{srv_ctx} download_rate_default"), f"{srv_ctx} download_rate_default")
-			dl_ceil = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}DOWNLOAD_CEIL_DEFAULT", f"{srv_ctx} download_ceil_default"), f"{srv_ctx} download_ceil_default")
-			dl_fprio_str = self._get_macro_value(raw_macros, f"{srv_prefix}DOWNLOAD_FILTER_PRIO_DEFAULT", f"{srv_ctx} download_filter_prio", default_value="15")
-			if all([dl_sfx, dl_rate, dl_ceil]):
-				srv_cfg['download'] = {'class_id_suffix': dl_sfx, 'rate': dl_rate, 'ceil': dl_ceil, 'filter_priority': self._validate_priority(dl_fprio_str, f"{srv_ctx} download_filter_priority", 15)}
-			
-			srv_cfg['interfaces'] = {}
-			for if_key, if_name_val in interface_names_map.items():
-				if 'upload' in srv_cfg:
-					up_ovr_rate_val = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}OVERRIDE_{if_key}_UPLOAD_RATE", f"{srv_ctx} override {if_name_val} upload_rate"), f"{srv_ctx} override {if_name_val} upload_rate")
-					up_ovr_ceil_val = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}OVERRIDE_{if_key}_UPLOAD_CEIL", f"{srv_ctx} override {if_name_val} upload_ceil"), f"{srv_ctx} override {if_name_val} upload_ceil")
-					if up_ovr_rate_val and up_ovr_ceil_val:
-						if if_name_val not in srv_cfg['interfaces']: srv_cfg['interfaces'][if_name_val] = {}
-						srv_cfg['interfaces'][if_name_val]['upload'] = {'rate': up_ovr_rate_val, 'ceil': up_ovr_ceil_val}
-				
-				if 'download' in srv_cfg:
-					ifb_name_for_override = self._get_macro_value(raw_macros, f"{self.IFACE_PREFIX}{if_key}_IFB", f"{srv_ctx} ifb for override {if_key}")
-					if ifb_name_for_override:
-						dl_ovr_rate_val = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}OVERRIDE_{ifb_name_for_override.upper()}_DOWNLOAD_RATE", f"{srv_ctx} override {ifb_name_for_override} download_rate"), f"{srv_ctx} override {ifb_name_for_override} download_rate")
-						if not dl_ovr_rate_val:
-							dl_ovr_rate_val = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}OVERRIDE_{if_key}_DOWNLOAD_RATE", f"{srv_ctx} override {if_key} download_rate (fallback)"), f"{srv_ctx} override {if_key} download_rate (fallback)")
-						
-						dl_ovr_ceil_val = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}OVERRIDE_{ifb_name_for_override.upper()}_DOWNLOAD_CEIL", f"{srv_ctx} override {ifb_name_for_override} download_ceil"), f"{srv_ctx} override {ifb_name_for_override} download_ceil")
-						if not dl_ovr_ceil_val:
-							dl_ovr_ceil_val = self._validate_rate_ceil(self._get_macro_value(raw_macros, f"{srv_prefix}OVERRIDE_{if_key}_DOWNLOAD_CEIL", f"{srv_ctx} override {if_key} download_ceil (fallback)"), f"{srv_ctx} override {if_key} download_ceil (fallback)")
-
-						if dl_ovr_rate_val and dl_ovr_ceil_val:
-							if ifb_name_for_override not in srv_cfg['interfaces']: srv_cfg['interfaces'][ifb_name_for_override] = {}
-							srv_cfg['interfaces'][ifb_name_for_override]['download'] = {'rate': dl_ovr_rate_val, 'ceil': dl_ovr_ceil_val}
-			
-			if not srv_cfg['interfaces']: del srv_cfg['interfaces']
-			
-			if 'upload' in srv_cfg or 'download' in srv_cfg:
-				self.config['services'].append(srv_cfg)
-			else:
-				logger.warning(f"Servico {srv_key_from_list} (marca {mark_val:#04x}) nao tem configuracao de upload nem download valida apos parsing. Ignorando.")
+		# Instancias dos templates: um servico <template>_<marca hex> por marca de QOS_TPL_<template>_MARKS
+		instances = []
+		for tpl_key in template_keys:
+			marks_macro = f"{self.TEMPLATE_PREFIX}{tpl_key}_MARKS"
+			if marks_macro not in raw_macros: continue # template usado apenas via QOS_SRV_<nome>_TEMPLATE
+			marks = self._parse_mark_ranges(raw_macros[marks_macro], marks_macro)
+			if lan and marks:
+				rejected = sum(1 for mark in marks if mark & lan['mask'])
+				if rejected: logger.warning(f"{rejected} marcas de {marks_macro} usam bits de QOS_LAN_WAN_MARK_MASK {lan['mask']:#x}. Ignorando essas instancias."); marks = [mark for mark in marks if not mark & lan['mask']]
+			instances += [(f"{tpl_key}_{mark:x}", tpl_key, mark) for mark in marks or ()]
+
+		# Uma unica passagem pelos macros agrupa os campos por servico/template; o resto do parsing so consulta os campos presentes
+		override_keys = self._override_keys(raw_macros, interface_names_map, lan)
+		templates = {key: self._parse_service_fields(fields, f"{self.TEMPLATE_PREFIX}{key}_", f"template '{key}'", override_keys)
+					 for key, fields in self._index_prefixed_macros(raw_macros, self.TEMPLATE_PREFIX, template_keys).items()}
+		service_fields = self._index_prefixed_macros(raw_macros, self.SERVICE_PREFIX, service_keys + [name for name, _tpl, _mark in instances])
+		services = []; seen = set()
+		for srv_key, tpl_key, mark in [(key, None, None) for key in service_keys] + instances:
+			if srv_key in seen: logger.warning(f"Servico '{srv_key}' repetido ({self.SERVICE_LIST_MACRO} / {self.TEMPLATE_PREFIX}*_MARKS). Ignorando a repeticao."); continue
+			seen.add(srv_key)
+			srv_cfg = self._build_service(srv_key, service_fields[srv_key], tpl_key, mark, templates, lan, override_keys)
+			if srv_cfg: services.append(srv_cfg)
+		self.config['services'] = self._allocate_class_ids(services, {key: tpl.get('class_base') for key, tpl in templates.items()})
 
 		logger.info(f"Configuracao QoS lida dos macros: {len(self.config['interfaces'])} interfaces, {len(self.config['services'])} servicos.")
 		return True
@@ -275,201 +1608,1263 @@ class QoSEngineMacroParserValidated:
 		return self.config.get('interfaces', [])
 
 	def _full_cleanup_attempt(self):
+		with self._span('cleanup', 'phase'): self._full_cleanup()
+
+	def _full_cleanup(self):
 		logger.info("Tentando limpeza completa TC/IFBs...")
 		interfaces = self._get_config_interfaces()
 		if not interfaces: logger.warning("Nenhuma interface na config para cleanup TC/IFB.")
 		else:
+			self._begin_batch()
 			logger.debug("Limpando qdiscs interfaces físicas...")
 			for iface_cfg in interfaces:
 				if isinstance(iface_cfg, dict) and 'name' in iface_cfg: self._cleanup_tc(iface_cfg['name'])
 			logger.debug("Removendo interfaces IFB listadas...")
 			known_ifbs = set()
+			# IFBs de staging so sobram de uma troca staged interrompida: uma leitura do sysfs em vez de uma verificacao por IFB
+			try: links = set(os.listdir(self.SYS_CLASS_NET))
+			except OSError: links = set()
 			for iface_cfg in interfaces:
 				 if isinstance(iface_cfg, dict) and 'ifb' in iface_cfg:
 					 ifb_name = iface_cfg['ifb']
-					 if ifb_name and ifb_name not in known_ifbs: self._cleanup_ifb(ifb_name); known_ifbs.add(ifb_name)
+					 if ifb_name and ifb_name not in known_ifbs:
+						 self._cleanup_ifb(ifb_name); known_ifbs.add(ifb_name)
+						 if self._staging_ifb(ifb_name) in links: self._cleanup_ifb(self._staging_ifb(ifb_name))
+			lan = self.config.get('lan')
+			if lan and self._link_exists(lan['dev']): logger.info(f"Limpando qdisc root LAN em {lan['dev']}"); self._run_command(['tc', 'qdisc', 'del', 'dev', lan['dev'], 'root'], check=False, failure_ok=True)
+			self._flush_batch("limpeza")
 		self.managed_ifbs = {}; logger.info("Limpeza inicial TC/IFB completa.")
 
-	def setup_tc(self):
+	def setup_tc(self, reconcile=False):
 		if not self.config: logger.error("Config não carregada para TC."); return False
 		interfaces = self.config.get('interfaces', [])
 		if not interfaces: logger.warning("Nenhuma interface definida para TC."); return True
-		modules_needed = ['ifb', 'sch_htb', 'act_ctinfo']
-		logger.info("Carregando módulos do kernel necessários...")
-		for mod in modules_needed: self._run_command(['modprobe', mod], check=False, failure_ok=True)
-		logger.info("Configurando TC...")
-		tc_success = True
+		with self._span('modules', 'phase'): self._load_modules()
+		logger.info("Reconciliando TC com o estado atual..." if reconcile else "Configurando TC...")
+		iface_cfgs = []
 		for iface_cfg in interfaces:
 			if not isinstance(iface_cfg, dict) or 'name' not in iface_cfg: logger.warning(f"Config de iface inválida: {iface_cfg}"); continue
-			if not self._setup_iface(iface_cfg): tc_success = False
-		if not tc_success: logger.error("Falha config TC para uma ou mais interfaces.")
-		return tc_success
+			iface_cfgs.append(iface_cfg)
+		with self._span('lan_root', 'phase'): lan_ok = self._setup_lan_root()
+		if not lan_ok: return False
+		with self._span('reconcile' if reconcile else 'apply', 'phase', interfaces=len(iface_cfgs), jobs=self.jobs):
+			if self.jobs > 1 and len(iface_cfgs) > 1: results = self._apply_ifaces_parallel(iface_cfgs, reconcile)
+			else: results = [self._apply_iface(iface_cfg, reconcile) for iface_cfg in iface_cfgs]
+		self.iface_results = {iface_cfg['name']: iface_ok for iface_cfg, iface_ok in zip(iface_cfgs, results)}
+		failed = [name for name, iface_ok in self.iface_results.items() if not iface_ok]
+		if failed: logger.error(f"Falha config TC para interface(s): {', '.join(failed)}.")
+		return not failed
+
+	def _setup_lan_root(self):
+		# Modo lan: HTB 1: partilhado na interface LAN, sem classe default (trafego sem WAN, ex. do proprio router, segue pela fila direta)
+		# e prio 1 com ctinfo cpmark 'continue': a marca do conntrack chega ao pacote antes dos filtros de despacho por WAN
+		lan = self.config.get('lan')
+		if not lan: return True
+		dev = lan['dev']
+		if not self._link_exists(dev): logger.warning(f"Interface LAN {dev} não encontrada."); return True
+		live = self._read_live_tc(dev) or {'root': None, 'filters': []}
+		fresh = not self._htb_qdisc_ok(live['root'], '1:', None, '0')
+		self._begin_batch()
+		if fresh:
+			logger.info(f"Configurando raiz LAN em {dev} (HTB 1:, uma subarvore por WAN)...")
+			self._run_command(['tc', 'qdisc', 'del', 'dev', dev, 'root'], check=False, failure_ok=True)
+			self._run_command(['tc', 'qdisc', 'add', 'dev', dev, 'root', 'handle', '1:', 'htb', 'default', '0', 'r2q', str(self.HTB_R2Q)])
+		if fresh or not any(f['pref'] == self.LAN_CTINFO_PRIO and self._same_classid(f['parent'], '1:') for f in live['filters']):
+			self._run_command(['tc', 'filter', 'add', 'dev', dev, 'parent', '1:', 'protocol', 'all', 'prio', str(self.LAN_CTINFO_PRIO), 'u32', 'match', 'u32', '0', '0', 'action', 'ctinfo', 'cpmark', 'continue'])
+		if not self._flush_batch(f"raiz LAN {dev}"): logger.error(f"Falha ao configurar a raiz LAN em {dev}."); return False
+		return True
+
+	def _download_target(self, if_cfg):
+		# Dispositivo onde o download da interface e moldado: a IFB, ou a interface LAN (partilhada pelas WANs) no modo lan
+		return if_cfg['lan']['dev'] if if_cfg.get('lan') else if_cfg.get('ifb')
+
+	def _lan_tree(self, if_cfg):
+		# Subarvore da WAN na interface LAN: HTB <major>: pendurado na classe 1:<major> da raiz partilhada
+		return {'major': if_cfg['lan']['major'], 'parent': f"1:{if_cfg['lan']['major']}", 'queues': 1, 'wan': if_cfg['name']}
+
+	def _lan_dispatch_cmd(self, verb, dev, if_cfg):
+		# Bits de WAN da marca -> classe 1:N da WAN; o segundo ctinfo deixa no pacote so os bits de servico (o que os filtros da subarvore comparam)
+		lan = if_cfg['lan']
+		return ['tc', 'filter', verb, 'dev', dev, 'parent', '1:', 'protocol', 'all', 'prio', str(int(lan['major'], 16))] + (['u32', 'match', 'mark', hex(lan['mark']), hex(lan['mask']), 'flowid', f"1:{lan['major']}",
+				'action', 'ctinfo', 'cpmark', hex(~lan['mask'] & 0xffffffff)] if verb == 'add' else [])
+
+	def _lan_branch_rate(self, if_cfg):
+		# A classe da WAN na raiz LAN nunca limita: o teto e o da subarvore (total de download, ou o maximo do autorate)
+		bounds = ((if_cfg.get('autorate') or {}).get('directions') or {}).get('download') or {}
+		return max(if_cfg['total_download_bw'], bounds.get('max', 0))
+
+	def _setup_lan_branch(self, dev, tree):
+		if_cfg = self._iface_cfg_for_dev(dev, 'download', tree['wan']); rate = self._lan_branch_rate(if_cfg)
+		try: ok = self._run_command(['tc', 'class', 'replace', 'dev', dev, 'parent', '1:', 'classid', tree['parent']] + self._htb_args(rate, rate, tree))
+		except Exception: ok = False
+		if not ok: logger.error(f"Falha add classe {tree['parent']} da WAN {tree['wan']} em {dev}."); return False
+		self._run_command(self._lan_dispatch_cmd('del', dev, if_cfg), check=False, failure_ok=True)
+		if not self._run_command(self._lan_dispatch_cmd('add', dev, if_cfg), context=f"{self.IFACE_PREFIX}{if_cfg.get('key')}_LAN_MARK"): logger.error(f"Falha filtro de despacho da WAN {tree['wan']} em {dev}."); return False
+		logger.info(f"Despacho LAN {dev}: marca {hex(if_cfg['lan']['mark'])}/{hex(if_cfg['lan']['mask'])} -> {tree['parent']} (WAN {tree['wan']}).")
+		return True
+
+	def _cleanup_lan_branch(self, iface_cfg):
+		# So a subarvore desta WAN: filtro de despacho e classe 1:N (que leva consigo o HTB N:); a raiz e as outras WANs ficam
+		dev = iface_cfg['lan']['dev']
+		if not self._link_exists(dev): logger.debug("Interface LAN %s não encontrada para cleanup TC.", dev); return
+		logger.info(f"Limpando subarvore da WAN {iface_cfg['name']} em {dev}")
+		self._run_command(self._lan_dispatch_cmd('del', dev, iface_cfg), check=False, failure_ok=True)
+		self._run_command(['tc', 'class', 'del', 'dev', dev, 'classid', f"1:{iface_cfg['lan']['major']}"], check=False, failure_ok=True)
+
+	def _load_modules(self):
+		interfaces = self.config.get('interfaces', [])
+		per_host = [s for s in self.config.get('services', []) if isinstance(s, dict) and s.get('per_host')]
+		# IFB: ingress + redirect mirred; u32: classificador, redirect do ingress, filtros da LAN e hash por host; cls_flow: por host com SNAT no upload
+		modules_needed = (['ifb', 'sch_ingress', 'act_mirred'] if any(isinstance(i, dict) and i.get('ifb') for i in interfaces) else []) + ['sch_htb', 'act_ctinfo']
+		if any(isinstance(i, dict) and (i.get('classifier') == 'u32' or i.get('ifb') or i.get('lan')) for i in interfaces) or per_host: modules_needed.append('cls_u32')
+		if any(isinstance(i, dict) and i.get('classifier') == 'fw' for i in interfaces): modules_needed.append('cls_fw')
+		if any('upload' in s and self._per_host_snat(i['name'], s['per_host']['subnet']) for s in per_host for i in interfaces if isinstance(i, dict)): modules_needed.append('cls_flow')
+		if any(isinstance(i, dict) and i.get('topology') == 'mq' for i in interfaces): modules_needed.append('sch_mq')
+		leaf_kinds = {i['default_leaf']['kind'] for i in interfaces if isinstance(i, dict) and i.get('default_leaf')} | {s['leaf']['kind'] for s in self.config.get('services', []) if isinstance(s, dict) and s.get('leaf')}
+		modules_needed += [f"sch_{kind}" for kind in sorted(leaf_kinds) if kind != 'pfifo']
+		logger.info("Carregando módulos do kernel necessários...")
+		for mod in modules_needed: self._run_command(['modprobe', mod], check=False, failure_ok=True)
+
+	def _apply_iface(self, iface_cfg, reconcile=False):
+		with self._span(iface_cfg['name'], 'iface', mode='reconcile' if reconcile else 'setup') as span:
+			span['ok'] = self._apply_iface_traced(iface_cfg, reconcile, span)
+		return span['ok']
+
+	def _apply_iface_traced(self, iface_cfg, reconcile, span):
+		started = time.monotonic()
+		self._begin_batch()
+		replayed = not reconcile and self._replay_plans is not None and iface_cfg['name'] in self._replay_plans
+		if reconcile: iface_ok = self._reconcile_iface(iface_cfg)
+		elif replayed: iface_ok = self._replay_iface_plan(iface_cfg)
+		else: iface_ok = self._setup_iface_recorded(iface_cfg)
+		self._cmd_context = None
+		if not self._flush_batch(iface_cfg['name']): iface_ok = False
+		if replayed: span['mode'] = 'cache'
+		if not iface_ok and (reconcile or replayed):
+			logger.warning(f"Reconciliacao falhou para {iface_cfg['name']}. Reconstruindo a interface." if reconcile else f"Plano em cache falhou para {iface_cfg['name']}. Reconstruindo a interface a partir da configuracao.")
+			self._begin_batch()
+			if not self.staged: self._cleanup_iface(iface_cfg)
+			iface_ok = self._setup_iface_recorded(iface_cfg); span['rebuilt'] = True
+			self._cmd_context = None
+			if not self._flush_batch(iface_cfg['name']): iface_ok = False
+		logger.info(f"Interface {iface_cfg['name']}: {'OK' if iface_ok else 'FALHA'} em {(time.monotonic() - started) * 1000:.0f} ms.")
+		return iface_ok
+
+	def _setup_iface_recorded(self, iface_cfg):
+		# Setup completo a partir de um estado limpo: os comandos emitidos formam o plano compilado da interface
+		self._plan_record = []
+		try: iface_ok = self._setup_iface(iface_cfg)
+		finally: plan = self._plan_record; self._plan_record = None
+		if iface_ok: self.iface_plans[iface_cfg['name']] = plan
+		return iface_ok
+
+	def _replay_iface_plan(self, iface_cfg):
+		# Arranque pelo cache: reexecuta os comandos gravados (no modo de aplicacao atual) sem resolver a configuracao
+		plan = self._replay_plans[iface_cfg['name']]
+		logger.info(f"Aplicando plano em cache para {iface_cfg['name']}: {len(plan)} comandos.")
+		if iface_cfg.get('ifb') and Path(f"{self.SYS_CLASS_NET}/{iface_cfg['name']}").exists(): self.managed_ifbs[iface_cfg['name']] = iface_cfg['ifb']
+		try:
+			for cmd, check, failure_ok, context, cmd_context in plan:
+				self._cmd_context = cmd_context
+				if not self._run_command(cmd, check=check, failure_ok=failure_ok, context=context) and check and not failure_ok and context is None:
+					logger.error(f"Falha no plano em cache de {iface_cfg['name']}: {' '.join(cmd)}"); return False
+		except (subprocess.SubprocessError, RtnlError) as e:
+			logger.error(f"Falha no plano em cache de {iface_cfg['name']}: {e}"); return False
+		return True
+
+	def _apply_ifaces_parallel(self, iface_cfgs, reconcile):
+		# Cada par interface/IFB e independente: um worker por interface, com batch, contexto, socket netlink e resultados proprios
+		# (IFBs geridas e planos gravados), juntados aqui pela thread principal
+		workers = min(self.jobs, len(iface_cfgs))
+		logger.info(f"Aplicando {len(iface_cfgs)} interfaces em paralelo ({workers} workers)...")
+		results = []
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qos-iface") as pool:
+			futures = [pool.submit(self._apply_iface_worker, iface_cfg, reconcile) for iface_cfg in iface_cfgs]
+			for future in futures:
+				iface_ok, records, managed_ifbs, iface_plans = future.result()
+				for record in records: logger.handle(record)
+				self.managed_ifbs.update(managed_ifbs); self.iface_plans.update(iface_plans)
+				results.append(iface_ok)
+		return results
+
+	def _apply_iface_worker(self, iface_cfg, reconcile):
+		_log_buffer.records = []
+		# Copia rasa: a configuracao e so lida; o que o worker escreve vai para dicionarios seus
+		worker = copy.copy(self); worker.managed_ifbs = {}; worker.iface_plans = {}
+		worker._batch = None; worker._batch_links = {}; worker._cmd_context = None; worker._staging_ifbs = {}; worker._rtnl = None # o socket do pai nunca e usado nem fechado
+		try:
+			if self._rtnl is not None:
+				worker._rtnl = RtnlBackend()
+				try: worker._rtnl.open()
+				except RtnlTransportError as e: worker._netlink_failover(iface_cfg['name'], e)
+			iface_ok = worker._apply_iface(iface_cfg, reconcile)
+		except Exception as e:
+			logger.error(f"Erro inesperado ao aplicar {iface_cfg['name']}: {e}", exc_info=True); iface_ok = False
+		finally:
+			if worker._rtnl is not None: worker._rtnl.close()
+			records = _log_buffer.records; _log_buffer.records = None
+		return iface_ok, records, worker.managed_ifbs, worker.iface_plans
 
 	def _setup_iface(self, iface_cfg):
 		iface = iface_cfg['name']; ifb_name = iface_cfg.get('ifb')
-		logger.info(f"Configurando TC para iface: {iface}" + (f" com IFB: {ifb_name}" if ifb_name else ""))
-		if not Path(f"/sys/class/net/{iface}").exists(): logger.warning(f"Iface física {iface} não encontrada."); return True
+		logger.info(f"Configurando TC para iface: {iface}" + (f" com IFB: {ifb_name}" if ifb_name else f" com download em {iface_cfg['lan']['dev']}" if iface_cfg.get('lan') else ""))
+		self._cmd_context = f"interface {iface} ({self.IFACE_PREFIX}{iface_cfg.get('key', iface.upper())}_*)"
+		if not self._link_exists(iface): logger.warning(f"Iface física {iface} não encontrada."); return True
 		if not self._run_command(['ip', 'link', 'set', 'dev', iface, 'up'], check=False, failure_ok=True): logger.warning(f"Falha ao garantir que {iface} está UP.")
 		if 'total_upload_bw' in iface_cfg and 'default_upload_class' in iface_cfg:
-			if self._setup_shaping(iface, iface_cfg['total_upload_bw'], iface_cfg.get('default_upload_class'), 'upload'): self._apply_classes_and_filters(iface, 'upload')
-			else: logger.error(f"Falha shaping upload (HTB) para {iface}."); return False
+			if not self._build_shaping(iface, iface_cfg['total_upload_bw'], iface_cfg.get('default_upload_class'), 'upload'): logger.error(f"Falha shaping upload (HTB) para {iface}."); return False
 		else: logger.info(f"Shaping upload não config {iface} (faltam total_upload_bw/default_upload_class).")
-		if ifb_name and 'total_download_bw' in iface_cfg and 'default_download_class' in iface_cfg:
-			if not self._setup_ifb(iface, ifb_name): logger.error(f"Falha config IFB {ifb_name} p/ {iface}."); return True
+		if iface_cfg.get('lan') and 'total_download_bw' in iface_cfg and 'default_download_class' in iface_cfg:
+			lan_dev = iface_cfg['lan']['dev']
+			if not self._link_exists(lan_dev): logger.warning(f"Interface LAN {lan_dev} não encontrada: download de {iface} sem shaping."); return True
+			if not self._build_shaping(lan_dev, iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), 'download', wan=iface): logger.error(f"Falha shaping download (HTB) da WAN {iface} em {lan_dev}."); return False
+		elif ifb_name and 'total_download_bw' in iface_cfg and 'default_download_class' in iface_cfg:
+			# Modo staged com o redirect ja ativo: ingress e IFB ficam como estao ate a troca (feita por _build_shaping)
+			redirect_live = self.staged and self._ingress_redirect_target(iface) in (ifb_name, self._staging_ifb(ifb_name))
+			if not redirect_live and not self._setup_ifb(iface, ifb_name): logger.error(f"Falha config IFB {ifb_name} p/ {iface}."); return True
 			self.managed_ifbs[iface] = ifb_name
-			if self._setup_shaping(ifb_name, iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), 'download'): self._apply_classes_and_filters(ifb_name, 'download')
-			else: logger.error(f"Falha shaping download (HTB) para {ifb_name}."); return False
+			if not self._build_shaping(ifb_name, iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), 'download'): logger.error(f"Falha shaping download (HTB) para {ifb_name}."); return False
 		elif ifb_name: logger.info(f"Shaping download não config {iface}/{ifb_name} (faltam total_download_bw/default_download_class).")
 		return True
 
 	def _setup_ifb(self, iface, ifb_name):
 		logger.info(f"Configurando IFB {ifb_name} para {iface} (com ctinfo cpmark)")
-		if not Path(f"/sys/class/net/{ifb_name}").exists():
-			logger.info(f"IFB {ifb_name} não existe, criando...")
-			if not self._run_command(['ip', 'link', 'add', ifb_name, 'type', 'ifb']): logger.error(f"Falha ao criar IFB {ifb_name}."); return False
-			logger.info(f"IFB {ifb_name} criada.")
-		else: logger.info(f"IFB {ifb_name} já existe.")
-		if not self._run_command(['ip', 'link', 'set', 'dev', ifb_name, 'up']): logger.error(f"Falha ao ativar IFB {ifb_name}."); return False
+		if not self._create_ifb(ifb_name, self._ifb_queue_count(ifb_name)): return False
 		self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'ingress'], check=False, failure_ok=True)
 		if not self._run_command(['tc', 'qdisc', 'add', 'dev', iface, 'handle', 'ffff:', 'ingress']): logger.error(f"Falha ao adicionar qdisc ingress em {iface}."); return False
-		cmd_filter = ['tc', 'filter', 'replace', 'dev', iface, 'parent', 'ffff:', 'protocol', 'all', 'prio', '1', 'u32', 'match', 'u32', '0', '0', 'action', 'ctinfo', 'cpmark', 'action', 'mirred', 'egress', 'redirect', 'dev', ifb_name]
-		if not self._run_command(cmd_filter):
+		if not self._run_command(self._ifb_redirect_cmd(iface, ifb_name)):
 			logger.error(f"Falha ao adicionar filtro redirect com ctinfo cpmark {iface}->{ifb_name}."); self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'ingress'], check=False, failure_ok=True); return False
 		logger.info(f"Redirect {iface}->{ifb_name} com ctinfo cpmark configurado OK."); return True
 
-	def _setup_shaping(self, iface, bandwidth, default_class, direction):
-		logger.info(f"Configurando shaping HTB {direction} em {iface}...")
-		if not Path(f"/sys/class/net/{iface}").exists(): logger.error(f"Interface {iface} não encontrada."); return False
-		self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'root'], check=False, failure_ok=True); time.sleep(0.1)
+	def _create_ifb(self, ifb_name, queues):
+		if self._link_exists(ifb_name) and queues > 1 and self._tx_queue_count(ifb_name) != queues:
+			logger.info(f"IFB {ifb_name} existe com {self._tx_queue_count(ifb_name)} fila(s), esperadas {queues}. Recriando...")
+			self._cleanup_ifb(ifb_name)
+		if not self._link_exists(ifb_name):
+			logger.info(f"IFB {ifb_name} não existe, criando" + (f" com {queues} filas..." if queues > 1 else "..."))
+			queue_args = ['numtxqueues', str(queues), 'numrxqueues', str(queues)] if queues > 1 else []
+			if not self._run_command(['ip', 'link', 'add', ifb_name] + queue_args + ['type', 'ifb']): logger.error(f"Falha ao criar IFB {ifb_name}."); return False
+			logger.info(f"IFB {ifb_name} criada.")
+		else: logger.info(f"IFB {ifb_name} já existe.")
+		if not self._run_command(['ip', 'link', 'set', 'dev', ifb_name, 'up']): logger.error(f"Falha ao ativar IFB {ifb_name}."); return False
+		return True
+
+	def _ifb_redirect_cmd(self, iface, ifb_name):
+		# Handle fixo (o que o kernel daria ao primeiro no): sem ele o 'replace' de um u32 acrescenta outro no em vez de substituir.
+		# Com ele e tambem a troca de IFB do modo staged, numa unica operacao
+		return ['tc', 'filter', 'replace', 'dev', iface, 'parent', 'ffff:', 'protocol', 'all', 'prio', '1', 'handle', self.IFB_REDIRECT_HANDLE, 'u32', 'match', 'u32', '0', '0', 'action', 'ctinfo', 'cpmark', 'action', 'mirred', 'egress', 'redirect', 'dev', ifb_name]
+
+	def _staging_ifb(self, ifb_name):
+		# IFB onde o modo staged constroi a hierarquia nova de ifb_name (nomes de interface: max. 15 caracteres)
+		return ifb_name[:15 - len(self.STAGING_SUFFIX)] + self.STAGING_SUFFIX
+
+	def _ingress_redirect_target(self, iface):
+		# IFB para onde o filtro prio 1 do ingress da WAN envia agora o trafego (None sem ingress/redirect)
+		filters = self._parse_tc_filter_output(self._capture_command(['tc', 'filter', 'show', 'dev', iface, 'ingress']) or '')
+		return next((f['redirect'] for f in filters if f['pref'] == 1 and f['redirect']), None)
+
+	def _setup_shaping(self, iface, bandwidth, default_class, direction, wan=None):
+		logger.info(f"Configurando shaping HTB {direction} em {iface}" + (f" (WAN {wan})..." if wan else "..."))
+		if not self._link_exists(iface): logger.error(f"Interface {iface} não encontrada."); return False
+		trees = self._shaping_trees(iface, direction, wan); lan_tree = trees[0] if trees[0].get('wan') else None
+		# Modo lan: so a subarvore desta WAN e recriada; a raiz partilhada e as outras WANs ficam intactas
+		del_args = ['parent', lan_tree['parent']] if lan_tree else ['root']
+		self._run_command(['tc', 'qdisc', 'del', 'dev', iface] + del_args, check=False, failure_ok=True)
+		if self._batch is None: self._settle(f"qdisc {iface}")
 		if bandwidth is None: logger.error(f"Largura de banda total ({direction}) não def."); return False
 		logger.info(f"Aplicando HTB {direction} em {iface} (Banda: {bandwidth})")
 		if not default_class or not all(k in default_class for k in ('id', 'rate', 'ceil')): logger.error(f"Classe default {direction} inválida."); return False
-		try: default_minor_id = default_class['id'].split(':')[-1]; assert default_minor_id.isdigit()
-		except Exception: logger.error(f"ID classe default {direction} inválido."); return False
-		if not self._run_command(['tc', 'qdisc', 'add', 'dev', iface, 'root', 'handle', '1:', 'htb', 'default', default_minor_id]): logger.error(f"Falha add qdisc root HTB {direction}."); return False
-		if not self._run_command(['tc', 'class', 'add', 'dev', iface, 'parent', '1:', 'classid', '1:1', 'htb', 'rate', bandwidth, 'ceil', bandwidth]): logger.error(f"Falha add classe raiz HTB {direction}."); self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'root'], check=False, failure_ok=True); return False
-		default_class_prio = str(default_class.get('priority', 7)); default_class_id = default_class['id']
-		if not self._run_command(['tc', 'class', 'add', 'dev', iface, 'parent', '1:1', 'classid', default_class_id, 'htb', 'rate', default_class['rate'], 'ceil', default_class['ceil'], 'prio', default_class_prio]): logger.error(f"Falha add classe default HTB {direction}."); self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'root'], check=False, failure_ok=True); return False
+		if lan_tree:
+			if not self._setup_lan_branch(iface, lan_tree): return False
+		elif trees[0]['parent'] != 'root':
+			logger.info(f"Topologia mq {direction} em {iface}: {len(trees)} filas, banda dividida em partes iguais.")
+			if not self._run_command(['tc', 'qdisc', 'add', 'dev', iface, 'root', 'handle', '1:', 'mq']): logger.error(f"Falha add qdisc root mq {direction}."); return False
+		for tree in trees:
+			if not self._setup_htb_tree(iface, bandwidth, default_class, direction, tree): self._run_command(['tc', 'qdisc', 'del', 'dev', iface] + del_args, check=False, failure_ok=True); return False
+		return True
+
+	def _build_shaping(self, dev, bandwidth, default_class, direction, wan=None):
+		# Hierarquia completa (qdisc, classes, filtros). Modo staged: a arvore em uso continua a moldar o trafego ate a nova estar pronta
+		if self.staged:
+			if_cfg = self._iface_cfg_for_dev(dev, direction, wan) or {}
+			active = self._ingress_redirect_target(if_cfg['name']) if direction == 'download' and if_cfg.get('ifb') == dev else None
+			if active in (dev, self._staging_ifb(dev)): return self._staged_ifb_swap(if_cfg['name'], dev, bandwidth, default_class, active)
+			if self._link_exists(dev): return self._staged_replace(dev, bandwidth, default_class, direction, wan)
+		return self._apply_shaping(dev, bandwidth, default_class, direction, wan)
+
+	def _apply_shaping(self, dev, bandwidth, default_class, direction, wan=None):
+		if not self._setup_shaping(dev, bandwidth, default_class, direction, wan): return False
+		self._apply_classes_and_filters(dev, direction, wan); return True
+
+	def _checkpoint(self, label):
+		# Modo staged: o que esta em batch e aplicado (e verificado) antes do passo seguinte; a troca so segue uma arvore ja aplicada
+		if self._batch is None: return True
+		ok = self._flush_batch(label); self._begin_batch(); return ok
+
+	def _staged_ifb_swap(self, iface, ifb_name, bandwidth, default_class, active):
+		# Duplo buffer: a hierarquia nova e construida numa IFB de staging e o trafego passa para ela com um unico 'tc filter replace' no
+		# ingress da WAN. A IFB definitiva, ja sem trafego, e refeita (recriada se o numero de filas mudou) e recebe-o de volta da mesma forma.
+		# Falha antes da troca: o trafego nunca saiu da arvore anterior. active == staging: troca anterior interrompida, so falta a volta.
+		staging = self._staging_ifb(ifb_name); queues = self._ifb_queue_count(ifb_name)
+		self._staging_ifbs[staging] = ifb_name
+		try:
+			if active != staging:
+				logger.info(f"Modo staged: hierarquia nova de {ifb_name} construida em {staging}; {iface} continua na arvore atual.")
+				try:
+					ok = self._checkpoint(iface); self._cleanup_ifb(staging)
+					ok = self._create_ifb(staging, queues) and self._checkpoint(f"staging {staging}") and ok
+					ok = ok and self._apply_shaping(staging, bandwidth, default_class, 'download') and self._checkpoint(f"staging {staging}")
+				except (subprocess.SubprocessError, RtnlError) as e: logger.error(f"Falha em {staging}: {e}"); ok = False
+				if not ok or not self._swap_redirect(iface, staging):
+					logger.error(f"Hierarquia nova falhou em {staging}: {iface} mantem a arvore anterior em {ifb_name}.")
+					self._cleanup_ifb(staging); self._checkpoint(f"limpeza {staging}"); return False
+			try:
+				ok = self._create_ifb(ifb_name, queues) and self._checkpoint(f"staging {ifb_name}")
+				ok = ok and self._apply_shaping(ifb_name, bandwidth, default_class, 'download') and self._checkpoint(f"staging {ifb_name}")
+			except (subprocess.SubprocessError, RtnlError) as e: logger.error(f"Falha em {ifb_name}: {e}"); ok = False
+			if not ok or not self._swap_redirect(iface, ifb_name):
+				logger.error(f"Falha ao refazer {ifb_name}: o download de {iface} fica em {staging} (hierarquia nova) ate a proxima aplicacao."); return False
+		finally: self._staging_ifbs.pop(staging, None)
+		self._cleanup_ifb(staging); self._checkpoint(f"limpeza {staging}")
+		return True
+
+	def _swap_redirect(self, iface, ifb_name):
+		# Ponto de troca do modo staged: uma unica operacao (um comando tc / uma mensagem netlink), sem intervalo sem qdisc
+		with self._span(f"troca {iface}", 'swap', target=ifb_name) as span:
+			try: span['ok'] = self._run_command(self._ifb_redirect_cmd(iface, ifb_name)) and self._checkpoint(f"troca {iface}")
+			except (subprocess.SubprocessError, RtnlError) as e: logger.error(f"Falha na troca {iface}->{ifb_name}: {e}"); span['ok'] = False
+		if span['ok']: logger.info(f"Troca atomica: download de {iface} agora em {ifb_name}.")
+		return span['ok']
+
+	def _staged_replace(self, dev, bandwidth, default_class, direction, wan=None):
+		# Raiz de saida ou subarvore LAN: o kernel so aceita classes num qdisc ja ligado ao dispositivo, nao ha onde construir ao lado.
+		# A remocao e a hierarquia nova seguem juntas num unico batch (tambem no modo exec, e sem a espera de _settle); se falhar,
+		# repoe-se o estado lido do kernel antes da troca
+		in_batch = self._batch is not None
+		ok = self._flush_batch(dev)
+		trees = self._shaping_trees(dev, direction, wan); scope = trees[0]['parent'] if trees[0].get('wan') else None
+		snapshot = self._snapshot_hierarchy(dev, scope)
+		self._batch = []; self._batch_links = {}
+		try: ok = self._apply_shaping(dev, bandwidth, default_class, direction, wan) and ok
+		except (subprocess.SubprocessError, RtnlError) as e: logger.error(f"Falha em {dev}: {e}"); ok = False
+		with self._span(f"troca {dev}", 'swap', direction=direction) as span: span['ok'] = self._flush_batch(f"staged {dev}") and ok
+		if in_batch: self._begin_batch()
+		if span['ok']: return True
+		self._rollback_shaping(dev, scope, snapshot); return False
+
+	def _snapshot_hierarchy(self, dev, scope=None):
+		# Estado tc em uso (a raiz de saida, ou a subarvore LAN ligada a scope) num dump rtnetlink: o rollback repoe-o tal como estava,
+		# sem depender do cache de planos nem da configuracao que o gerou
+		rtnl = RtnlBackend()
+		try:
+			index = rtnl.link_index(dev)
+			snapshot = None if index is None else rtnl.snapshot(index, rtnl._parse_handle(scope) if scope else None)
+		except (OSError, RtnlError) as e: logger.warning(f"Falha ao ler a hierarquia em uso em {dev}: {e}. Sem rollback possivel."); return None
+		finally: rtnl.close()
+		if snapshot is not None: logger.debug("Snapshot de %s: %d objetos tc.", dev, len(snapshot))
+		return snapshot
+
+	def _rollback_shaping(self, dev, scope, snapshot):
+		# Remove a hierarquia nova (incompleta) e recria a anterior a partir do snapshot, num unico pedido rtnetlink
+		if snapshot is None: logger.error(f"Hierarquia nova falhou em {dev} e nao ha snapshot da anterior para repor."); return False
+		logger.warning(f"Hierarquia nova falhou em {dev}: repondo a hierarquia em uso antes da troca ({len(snapshot)} objetos tc).")
+		rtnl = RtnlBackend()
+		with self._span(f"rollback {dev}", 'swap', objects=len(snapshot)) as span:
+			try:
+				messages = [rtnl.translate(['tc', 'qdisc', 'del', 'dev', dev] + (['parent', scope] if scope else ['root']))] + snapshot
+				replies = rtnl.request([rtnl.message(msg_type, flags, body) for msg_type, flags, body in messages])
+			except (OSError, RtnlError) as e: logger.error(f"Rollback em {dev} falhou: {e}"); span['ok'] = False; return False
+			finally: rtnl.close()
+			# A remocao pode nao encontrar nada (a arvore nova nem chegou a ser ligada)
+			errors = [f"{os.strerror(error)}" + (f" ({text})" if text else "") for error, text in replies[1:] if error]
+			span['ok'] = not errors
+		if errors: logger.error(f"Rollback em {dev} falhou em {len(errors)} de {len(snapshot)} objetos: {errors[0]}"); return False
+		logger.info(f"Rollback em {dev}: hierarquia anterior reposta."); return True
+
+	def _setup_htb_tree(self, iface, bandwidth, default_class, direction, tree):
+		major = tree['major']; default_minor_id = default_class['id'].split(':')[-1]
+		parent_args = ['root'] if tree['parent'] == 'root' else ['parent', tree['parent']]
+		if not self._run_command(['tc', 'qdisc', 'add', 'dev', iface] + parent_args + ['handle', f"{major}:", 'htb', 'default', default_minor_id, 'r2q', str(tree.get('r2q', self.HTB_R2Q))]): logger.error(f"Falha add qdisc HTB {major}: {direction}."); return False
+		tree_bw = self._tree_rate(bandwidth, tree)
+		if not self._run_command(['tc', 'class', 'add', 'dev', iface, 'parent', f"{major}:", 'classid', f"{major}:1"] + self._htb_args(tree_bw, tree_bw, tree)): logger.error(f"Falha add classe raiz HTB {direction}."); return False
+		default_class_prio = str(default_class.get('priority', 7)); default_class_id = self._tree_classid(default_class['id'], tree)
+		if not self._run_command(['tc', 'class', 'add', 'dev', iface, 'parent', f"{major}:1", 'classid', default_class_id] + self._htb_args(self._tree_rate(default_class['rate'], tree), self._tree_rate(default_class['ceil'], tree), tree, default_class_prio)): logger.error(f"Falha add classe default HTB {direction}."); return False
 		logger.info(f"Classe default {direction} {default_class_id} config OK.")
+		self._attach_leaf_qdisc(iface, default_class_id, (self._iface_cfg_for_dev(iface, direction, tree.get('wan')) or {}).get('default_leaf'))
+		return True
+
+	def _leaf_qdisc_cmd(self, dev, class_id, leaf):
+		return ['tc', 'qdisc', 'replace', 'dev', dev, 'parent', class_id, leaf['kind']] + [token for keyword, value, _canonical in leaf['params'] for token in (keyword, value)]
+
+	def _attach_leaf_qdisc(self, dev, class_id, leaf):
+		# Sem configuracao a classe fica com a folha pfifo default do kernel
+		if not leaf: return True
+		try: ok = self._run_command(self._leaf_qdisc_cmd(dev, class_id, leaf), context=f"folha {leaf['kind']} ({leaf['source']})")
+		except Exception: ok = False
+		if not ok: logger.error(f"Falha ao anexar qdisc folha {leaf['kind']} a {class_id} em {dev}."); return False
+		logger.info(f"Qdisc folha {leaf['kind']} anexada a {class_id} em {dev}.")
 		return True
 
-	def _apply_classes_and_filters(self, iface, direction):
+	def _tx_queue_count(self, name):
+		try: return sum(1 for q in Path(f"{self.SYS_CLASS_NET}/{name}/queues").iterdir() if q.name.startswith('tx-'))
+		except OSError: return 0
+
+	def _ifb_queue_count(self, ifb_name):
+		# IFB com tantas filas como a NIC fisica (ou QOS_IF_<KEY>_QUEUES), para o download nao ficar preso a um unico core
+		if_cfg = self._iface_cfg_for_dev(ifb_name, 'download') or {}
+		if if_cfg.get('topology') != 'mq': return 1
+		return if_cfg.get('queues') or max(self._tx_queue_count(if_cfg['name']), 1)
+
+	def _shaping_trees(self, dev, direction, wan=None):
+		# Topologia htb: uma hierarquia na raiz 1:. Topologia mq: raiz mq 1: com uma hierarquia HTB por fila de TX (2:, 3:, ...)
+		# Modo lan: uma hierarquia N: por WAN sob a classe 1:N da interface LAN (wan=None: as de todas as WANs)
+		lan_wans = [c for c in self.config.get('interfaces', []) if direction == 'download' and c.get('lan') and c['lan']['dev'] == dev and wan in (None, c['name'])]
+		if lan_wans:
+			mtu = self._link_mtu(dev)
+			return [dict(self._lan_tree(c), mtu=mtu, r2q=self._htb_r2q(dev, direction, 1, mtu, c['name'])) for c in lan_wans]
+		if_cfg = self._iface_cfg_for_dev(dev, direction) or {}
+		if if_cfg.get('topology') != 'mq': queues = 1
+		elif direction == 'download': queues = self._ifb_queue_count(dev)
+		else:
+			nic_queues = self._tx_queue_count(dev)
+			queues = min(if_cfg['queues'], nic_queues) if if_cfg.get('queues') and nic_queues else (if_cfg.get('queues') or nic_queues)
+		mtu = self._link_mtu(dev); r2q = self._htb_r2q(dev, direction, max(queues, 1), mtu)
+		if queues < 2: return [dict(self.ROOT_TREE, mtu=mtu, r2q=r2q)] # mq exige um dispositivo multi-fila
+		return [{'major': f"{q + 2:x}", 'parent': f"1:{q + 1:x}", 'queues': queues, 'mtu': mtu, 'r2q': r2q} for q in range(queues)]
+
+	def _link_mtu(self, dev):
+		# Tamanho maximo de frame (MTU + cabecalho Ethernet); IFB ainda por criar (batch) usa o MTU default
+		try: return int(Path(f"{self.SYS_CLASS_NET}/{dev}/mtu").read_text().strip()) + self.ETH_HLEN
+		except (OSError, ValueError): return self.DEFAULT_MTU + self.ETH_HLEN
+
+	def _htb_r2q(self, dev, direction, queues, mtu, wan=None):
+		# r2q tal que a classe mais lenta ainda tenha quantum >= MTU
+		rates = [child['rate'] for child in self._leaf_class_rates(dev, direction, wan)]
+		if not rates: return self.HTB_R2Q
+		return max(1, min(rates) // queues // 8 // mtu)
+
+	def _htb_args(self, rate, ceil, tree, prio=None):
+		mtu = tree.get('mtu', self.DEFAULT_MTU + self.ETH_HLEN); r2q = tree.get('r2q', self.HTB_R2Q)
+		burst = rate // 8 * self.HTB_TIMER_GRANULARITY_US // 1000000 + mtu
+		cburst = ceil // 8 * self.HTB_TIMER_GRANULARITY_US // 1000000 + mtu
+		quantum = min(max(rate // 8 // r2q, mtu), self.HTB_MAX_QUANTUM)
+		return ['htb', 'rate', f"{rate}bit", 'ceil', f"{ceil}bit"] + (['prio', str(prio)] if prio is not None else []) + ['burst', f"{burst}b", 'cburst', f"{cburst}b", 'quantum', str(quantum)]
+
+	def _leaf_class_rates(self, dev, direction, wan=None):
+		# Classes folha (default + servicos) de um dispositivo, com rate/ceil em bit/s, antes da divisao por filas
+		if_cfg = self._iface_cfg_for_dev(dev, direction, wan) or {}
+		tree = self._lan_tree(if_cfg) if direction == 'download' and if_cfg.get('lan') else None
+		default_class = if_cfg.get(f'default_{direction}_class'); children = []
+		if isinstance(default_class, dict) and default_class.get('rate') and default_class.get('ceil'):
+			children.append({'name': f"classe default {default_class.get('id')}", 'rate': default_class['rate'], 'ceil': default_class['ceil'], 'source': f"{self.IFACE_PREFIX}{if_cfg.get('key')}_DEFAULT_{direction.upper()}_*"})
+		for service in self.config.get('services', []):
+			if not isinstance(service, dict) or 'mark' not in service or not isinstance(service.get(direction), dict): continue
+			srv = self._resolve_service_class(dev, service, direction, tree)
+			if srv: children.append({'name': f"servico '{srv['name']}' ({srv['class_id']})", 'rate': srv['rate'], 'ceil': srv['ceil'], 'source': srv['class_context']})
+		return children
+
+	def _validate_hierarchy(self):
+		# Antes de tocar em qualquer qdisc: soma das taxas garantidas <= 1:1, rate <= ceil <= 1:1 em cada classe
+		valid = True
+		for if_cfg in self.config.get('interfaces', []):
+			for direction, dev in (('upload', if_cfg.get('name')), ('download', self._download_target(if_cfg))):
+				bandwidth = if_cfg.get(f'total_{direction}_bw')
+				if not dev or not bandwidth or not isinstance(if_cfg.get(f'default_{direction}_class'), dict): continue
+				wan = if_cfg['name'] if direction == 'download' and if_cfg.get('lan') else None; tree = self._lan_tree(if_cfg) if wan else None
+				children = self._leaf_class_rates(dev, direction, wan); total = sum(child['rate'] for child in children)
+				for child in children:
+					if child['rate'] > child['ceil']: logger.error(f"Hierarquia {direction} em {dev}: {child['name']} tem rate {child['rate']}bit > ceil {child['ceil']}bit [{child['source']}]."); valid = False
+					if child['ceil'] > bandwidth: logger.error(f"Hierarquia {direction} em {dev}: {child['name']} tem ceil {child['ceil']}bit > banda total 1:1 {bandwidth}bit [{child['source']}]."); valid = False
+				if total > bandwidth: logger.error(f"Hierarquia {direction} em {dev}: soma das taxas garantidas ({len(children)} classes) {total}bit > banda total 1:1 {bandwidth}bit."); valid = False
+				for service in self.config.get('services', []):
+					if not isinstance(service, dict) or not service.get('per_host') or not isinstance(service.get(direction), dict): continue
+					srv = self._resolve_service_class(dev, service, direction, tree); plan = self._per_host_plan(dev, service, direction, srv, tree)
+					if srv and not plan:
+						logger.warning(f"Equidade por host {direction} do servico '{srv['name']}' desativada em {dev}: {service['per_host']['subnet']} sai com SNAT por {if_cfg['name']} e no IFB o destino ainda e o endereco WAN [{service['per_host']['source']}]."); continue
+					if not plan: continue
+					ctx = f"Hierarquia {direction} em {dev}: hosts do servico '{srv['name']}' ({srv['class_id']})"
+					if plan['rate'] > plan['ceil']: logger.error(f"{ctx} tem rate {plan['rate']}bit > ceil {plan['ceil']}bit [{service['per_host']['source']}]."); valid = False
+					if plan['ceil'] > srv['ceil']: logger.error(f"{ctx} tem ceil {plan['ceil']}bit > ceil do servico {srv['ceil']}bit [{service['per_host']['source']}]."); valid = False
+					if plan['rate'] * len(plan['classes']) > srv['rate']: logger.error(f"{ctx}: soma das taxas garantidas ({len(plan['classes'])} classes) {plan['rate'] * len(plan['classes'])}bit > rate do servico {srv['rate']}bit [{service['per_host']['source']}]."); valid = False
+		return valid
+
+	def _tree_classid(self, classid, tree):
+		return f"{tree['major']}:{classid.split(':')[-1]}"
+
+	def _tree_rate(self, value, tree):
+		# Divisao proporcional da banda pelas filas (cada fila tem o seu HTB independente)
+		bps = self._parse_rate_bps(value)
+		if tree['queues'] == 1 or bps is None: return bps
+		return max(bps // tree['queues'], 8)
+
+	def _iface_cfg_for_dev(self, dev, direction, wan=None):
+		# Upload e aplicado na interface fisica, download na IFB associada; no modo lan as WANs partilham a interface LAN e wan escolhe qual
+		dev = self._staging_ifbs.get(dev, dev)
+		for if_cfg in self.config.get('interfaces', []):
+			if (direction == 'upload' and if_cfg.get('name') == dev) or (direction == 'download' and if_cfg.get('ifb') == dev): return if_cfg
+			if direction == 'download' and if_cfg.get('lan') and if_cfg['lan']['dev'] == dev and wan in (None, if_cfg['name']): return if_cfg
+		return None
+
+	def _mark_class_map(self, dev, direction, default_class_id, tree=None):
+		# Resultado efetivo da cadeia u32 (prio crescente, primeira regra ganha): marca -> classe.
+		# E a mesma tabela que o classificador fw instala, garantindo classificacao identica nos dois modos.
+		rules = []
+		for order, service in enumerate(self.config.get('services', [])):
+			if not isinstance(service, dict) or 'mark' not in service or not isinstance(service.get(direction), dict): continue
+			srv = self._resolve_service_class(dev, service, direction, tree)
+			if srv: rules.append((int(srv['filter_priority']), order, service['mark'], srv['class_id'], srv['filter_context']))
+		if default_class_id: rules.append((self.DEFAULT_FILTER_PRIO, len(rules), self.DEFAULT_MARK, self._tree_classid(default_class_id, tree or self.ROOT_TREE), None))
+		mark_map = {}
+		for prio, _order, mark, class_id, context in sorted(rules, key=lambda r: (r[0], r[1])):
+			if mark in mark_map: logger.warning(f"Marca {hex(mark)} repetida em {dev} ({direction}): {class_id} (prio {prio}) ignorada, ja mapeada para {mark_map[mark]['flowid']}."); continue
+			mark_map[mark] = {'mark': mark, 'flowid': class_id, 'context': context}
+		return list(mark_map.values())
+
+	def _apply_fw_filters(self, dev, direction, default_class_id, tree=None):
+		# Classificador fw: uma unica prio na cadeia, com lookup por hash do handle (= marca) em vez de percorrer um filtro u32 por servico
+		tree = tree or self.ROOT_TREE
+		entries = self._mark_class_map(dev, direction, default_class_id, tree)
+		logger.info(f"Aplicando classificador fw {direction} em {dev} ({len(entries)} marcas, prio {self.FW_FILTER_PRIO})...")
+		failed = 0
+		for entry in entries:
+			try: ok = self._run_command(['tc', 'filter', 'replace', 'dev', dev, 'parent', f"{tree['major']}:", 'protocol', 'ip', 'prio', str(self.FW_FILTER_PRIO), 'handle', hex(entry['mark']), 'fw', 'flowid', entry['flowid']], context=entry['context'])
+			except Exception: ok = False
+			if not ok: failed += 1
+		if failed: logger.error(f"Falha em {failed} filtro(s) fw {direction} em {dev}.")
+		else: logger.info(f"Classificador fw {direction} em {dev} config OK.")
+
+	def _apply_classes_and_filters(self, iface, direction, wan=None):
 		logger.info(f"Aplicando classes/filtros de serviço {direction.upper()} em {iface}...")
 		services = self.config.get('services', [])
 		if not services: logger.info("Nenhuma classe de serviço definida."); return
 
-		default_mark_hex = '0xff'
+		default_mark_hex = hex(self.DEFAULT_MARK)
 		default_class_id_for_filter = None
-		for if_cfg_item in self.config.get('interfaces', []):
-			if (direction == 'upload' and if_cfg_item.get('name') == iface) or \
-			   (direction == 'download' and if_cfg_item.get('ifb') == iface):
-				key = f'default_{direction}_class'
-				if key in if_cfg_item and isinstance(if_cfg_item[key], dict):
-					default_class_id_for_filter = if_cfg_item[key].get('id')
-					break
+		if_cfg_item = self._iface_cfg_for_dev(iface, direction, wan) or {}
+		key = f'default_{direction}_class'
+		if key in if_cfg_item and isinstance(if_cfg_item[key], dict):
+			default_class_id_for_filter = if_cfg_item[key].get('id')
+		classifier = if_cfg_item.get('classifier', 'u32')
 		
 		if not default_class_id_for_filter:
 			logger.error(f"Não foi possível encontrar ID da classe default para {direction} em {iface}. Filtro default NÃO será adicionado.")
 		
-		for service in services:
-			if not isinstance(service, dict): logger.warning(f"Def serviço inválida: {service}"); continue
-			if 'mark' not in service: logger.warning(f"Serviço sem 'mark' ignorado: {service}"); continue
-
-			if direction == 'upload':
-				if 'upload' in service and isinstance(service['upload'], dict):
-					self._add_upload_class_and_filter(iface, service)
-			elif direction == 'download':
-				if 'download' in service and isinstance(service['download'], dict):
-					self._add_download_class_and_filter(iface, service)
-		
-		if default_class_id_for_filter:
-			logger.info(f"Aplicando filtro default {direction} (marca {default_mark_hex} -> {default_class_id_for_filter}) em {iface}...")
-			if not self._run_command(['tc', 'filter', 'replace', 'dev', iface, 'parent', '1:', 'protocol', 'ip', 'prio', '20',
-									 'u32', 'match', 'mark', default_mark_hex, '0xffffffff', 'flowid', default_class_id_for_filter]):
-				logger.error(f"Falha ao adicionar filtro default {direction} (mark {default_mark_hex}) em {iface}.")
+		for tree in self._shaping_trees(iface, direction, wan):
+			for service in services:
+				if not isinstance(service, dict): logger.warning(f"Def serviço inválida: {service}"); continue
+				if 'mark' not in service: logger.warning(f"Serviço sem 'mark' ignorado: {service}"); continue
+
+				if direction == 'upload':
+					if 'upload' in service and isinstance(service['upload'], dict):
+						self._add_upload_class_and_filter(iface, service, add_filter=(classifier == 'u32'), tree=tree)
+				elif direction == 'download':
+					if 'download' in service and isinstance(service['download'], dict):
+						self._add_download_class_and_filter(iface, service, add_filter=(classifier == 'u32'), tree=tree)
+			
+			if classifier == 'fw':
+				self._apply_fw_filters(iface, direction, default_class_id_for_filter, tree)
+			elif default_class_id_for_filter:
+				tree_default_id = self._tree_classid(default_class_id_for_filter, tree)
+				logger.info(f"Aplicando filtro default {direction} (marca {default_mark_hex} -> {tree_default_id}) em {iface}...")
+				if not self._run_command(['tc', 'filter', 'replace', 'dev', iface, 'parent', f"{tree['major']}:", 'protocol', 'ip', 'prio', str(self.DEFAULT_FILTER_PRIO),
+										 'u32', 'match', 'mark', default_mark_hex, '0xffffffff', 'flowid', tree_default_id]):
+					logger.error(f"Falha ao adicionar filtro default {direction} (mark {default_mark_hex}) em {iface}.")
+				else:
+					logger.info(f"Filtro default {direction} (mark {default_mark_hex} -> {tree_default_id}) config OK.")
+
+	def _resolve_service_class(self, dev, service, direction, tree=None):
+		# Combina a configuracao default do servico com o override do dispositivo (iface p/ upload, IFB p/ download, WAN da subarvore no modo lan)
+		mark_hex = hex(service['mark']); base_cfg = service[direction]
+		final_cfg = base_cfg.copy()
+		final_class_priority = str(service.get('priority', 5))
+		final_filter_prio = str(base_cfg.get('filter_priority', 10))
+		dev_overrides = service.get('interfaces', {}).get((tree or {}).get('wan') or self._staging_ifbs.get(dev, dev))
+		if isinstance(dev_overrides, dict) and isinstance(dev_overrides.get(direction), dict):
+			override_cfg = dev_overrides[direction]; logger.debug("Override %s m:%s i:%s %s", direction, mark_hex, dev, override_cfg); final_cfg.update(override_cfg)
+			final_class_priority = str(override_cfg.get('priority', final_class_priority))
+			final_filter_prio = str(override_cfg.get('filter_priority', final_filter_prio))
+		if not all(k in final_cfg for k in ('class_id_suffix', 'rate', 'ceil')): logger.error(f"Cfg {direction} incompleta m:{mark_hex} i:{dev}"); return None
+		class_id_suffix = final_cfg['class_id_suffix']
+		if not isinstance(class_id_suffix, (str, int)) or not re.fullmatch(r'[0-9a-fA-F]{1,4}', str(class_id_suffix)): logger.error(f"class_id_suffix {direction} inválido m:{mark_hex} i:{dev}"); return None
+		srv_name = service.get('name', mark_hex); tree = tree or self.ROOT_TREE
+		return {'name': srv_name, 'mark_hex': mark_hex, 'class_id': f"{tree['major']}:{class_id_suffix}", 'parent': f"{tree['major']}:1", 'qdisc': f"{tree['major']}:",
+				'rate': self._tree_rate(final_cfg['rate'], tree), 'ceil': self._tree_rate(final_cfg['ceil'], tree),
+				'leaf': service.get('leaf') or (self._iface_cfg_for_dev(dev, direction, (tree or {}).get('wan')) or {}).get('default_leaf'),
+				'htb_args': self._htb_args(self._tree_rate(final_cfg['rate'], tree), self._tree_rate(final_cfg['ceil'], tree), tree, final_class_priority),
+				'priority': final_class_priority, 'filter_priority': final_filter_prio,
+				'class_context': f"servico '{srv_name}' ({final_cfg.get('source', 'N/A')})", 'filter_context': f"servico '{srv_name}' ({service.get('mark_source') or f'{self.SERVICE_PREFIX}{srv_name}_MARK'})"}
+
+	def _per_host_snat(self, iface, subnet):
+		# A subrede sai reescrita (masquerade/snat) pela interface: o endereco do host deixa de estar no pacote visto pelo tc
+		network = ipaddress.IPv4Network(subnet)
+		for rule in self.config.get('snat', []):
+			if rule['oifname'] and iface not in rule['oifname']: continue
+			if any(network.overlaps(ipaddress.IPv4Network(saddr)) for saddr in rule['saddr']): return True
+		return False
+
+	def _per_host_plan(self, dev, service, direction, srv, tree=None):
+		# Subclasses por host sob a classe do servico + cadeia de filtros da propria classe (o HTB volta a classificar ao chegar a uma classe interna)
+		per_host = service.get('per_host')
+		if not per_host or not srv: return None
+		if_cfg = self._iface_cfg_for_dev(dev, direction, (tree or {}).get('wan')) or {}
+		snat = self._per_host_snat(if_cfg.get('name'), per_host['subnet'])
+		# No IFB (ingress) o conntrack ainda nao desfez o NAT: o destino e o endereco WAN, nao ha host a distinguir.
+		# Na saida da interface LAN o destino ja e o host: o u32 pelo octeto serve mesmo com SNAT.
+		if snat and direction == 'download':
+			if not if_cfg.get('lan'): return None
+			snat = False
+		tree = tree or self.ROOT_TREE; network = ipaddress.IPv4Network(per_host['subnet'])
+		major, minor = srv['class_id'].split(':'); minor = int(minor, 16)
+		octets = [int(host) & 0xff for host in network.hosts()]; limits = per_host.get(direction, {})
+		rate = self._tree_rate(limits['rate'], tree) if limits.get('rate') else max(srv['rate'] // (len(octets) + 1), 8)
+		ceil = self._tree_rate(limits['ceil'], tree) if limits.get('ceil') else srv['ceil']
+		plan = {'mode': 'flow' if snat else 'u32', 'classes': {}, 'filters': [], 'hosts': len(octets), 'rate': rate, 'ceil': ceil, 'service': srv['name'], 'context': srv['filter_context']}
+		# Octeto 0 (endereco de rede, nunca um host): classe para o trafego do servico fora da subrede
+		for octet in [0] + octets:
+			classid = f"{major}:{(minor << 8) | octet:x}"; address = '' if octet == 0 else str(ipaddress.IPv4Address((int(network.network_address) & ~0xff) | octet))
+			context = f"servico '{srv['name']}' host {address or 'fora de ' + per_host['subnet']} ({per_host['source']})"
+			plan['classes'][classid] = {'parent': srv['class_id'], 'rate': rate, 'ceil': ceil, 'prio': srv['priority'], 'context': context, 'leaf': srv['leaf'], 'address': address,
+										'htb_args': self._htb_args(rate, ceil, tree, srv['priority'])}
+		prio = str(self.PER_HOST_FILTER_PRIO + minor); catch_all = f"{major}:{minor << 8:x}"; plan['prio'] = int(prio)
+		if snat:
+			# Upload com SNAT: o u32 so ve o endereco ja reescrito; o cls_flow le a origem original no conntrack e mapeia o octeto
+			# diretamente para a classe (baseclass + octeto), tambem com custo constante
+			plan['baseclass'] = catch_all
+			plan['filters'].append(('add', ['protocol', 'ip', 'prio', prio, 'flow', 'map', 'key', 'nfct-src', 'and', '0xff', 'baseclass', catch_all]))
+			return plan
+		ht = f"{self.PER_HOST_HT_BASE + minor:x}:"; offset = str(self.PER_HOST_KEY_OFFSET[direction])
+		plan.update(ht=ht, match=f"{int(network.network_address):08x}/{int(network.netmask):08x} at {offset}")
+		# A tabela sobrevive a remocao da cadeia (pertence ao qdisc): 'add' ignora a existente e os baldes tem handle fixo (replace idempotente)
+		plan['filters'].append(('add', ['protocol', 'ip', 'prio', prio, 'handle', ht, 'u32', 'divisor', '256']))
+		plan['filters'] += [('replace', ['protocol', 'ip', 'prio', prio, 'handle', f"{ht}{octet:x}:800", 'u32', 'ht', f"{ht}{octet:x}:", 'match', 'u32', '0', '0', 'flowid', f"{major}:{(minor << 8) | octet:x}"]) for octet in octets]
+		plan['filters'].append(('add', ['protocol', 'ip', 'prio', prio, 'u32', 'match', 'u32', hex(int(network.network_address)), hex(int(network.netmask)), 'at', offset, 'hashkey', 'mask', '0x000000ff', 'at', offset, 'link', ht]))
+		# Depois do link (sem balde correspondente o u32 continua na tabela raiz): trafego do servico fora da subrede
+		plan['filters'].append(('add', ['protocol', 'ip', 'prio', prio, 'u32', 'match', 'u32', '0', '0', 'flowid', catch_all]))
+		return plan
+
+	def _apply_per_host(self, dev, srv, plan, classes=True):
+		# Geracao em bloco: mesmo no modo exec, as centenas de classes/folhas/filtros seguem num unico 'tc -batch'
+		own_batch = self._batch is None
+		if own_batch: self._batch = []; self._batch_links = {}
+		if classes:
+			for classid, want in plan['classes'].items():
+				self._run_command(['tc', 'class', 'replace', 'dev', dev, 'parent', want['parent'], 'classid', classid] + want['htb_args'], context=want['context'])
+				if want['leaf']: self._run_command(self._leaf_qdisc_cmd(dev, classid, want['leaf']), context=f"folha {want['leaf']['kind']} ({want['leaf']['source']})")
+		for verb, args in plan['filters']:
+			if 'divisor' in args: self._run_command(['tc', 'filter', verb, 'dev', dev, 'parent', srv['class_id']] + args, check=False, failure_ok=True)
+			else: self._run_command(['tc', 'filter', verb, 'dev', dev, 'parent', srv['class_id']] + args, context=srv['filter_context'])
+		if own_batch: self._flush_batch(f"hosts {srv['name']} {dev}")
+		logger.info(f"Equidade por host em {srv['class_id']} ({dev}): {plan['hosts']} hosts (r:{plan['rate']}bit c:{plan['ceil']}bit), " + ("cls_flow pela origem no conntrack (SNAT)" if plan['mode'] == 'flow' else f"hash u32 {plan['ht']} pelo octeto ({plan['match']})") + ".")
+
+	def _reconcile_per_host(self, dev, classid, plan, live_chain):
+		# live_chain: saida de 'tc filter show' da cadeia da classe (None = classe nova, sem filtros). Devolve o numero de alteracoes.
+		nodes = self._parse_tc_filter_output(live_chain or '')
+		if plan and live_chain is not None:
+			if plan['mode'] == 'flow': chain_ok = 'nfct-src' in live_chain and f"baseclass {plan['baseclass']}" in live_chain
 			else:
-				logger.info(f"Filtro default {direction} (mark {default_mark_hex} -> {default_class_id_for_filter}) config OK.")
+				want = {(plan['prio'], self._classid_key(args[-1])) for _verb, args in plan['filters'] if args[-2] == 'flowid'}
+				have = {(f['pref'], self._classid_key(f['flowid'])) for f in nodes if f['flowid']}
+				chain_ok = want <= have and live_chain.count(' link ') == 1 and f"link {plan['ht']}" in live_chain and f"match {plan['match']}" in live_chain
+			if chain_ok: return 0
+		wanted = {self._classid_key(c) for c in (plan or {}).get('classes', {})}
+		# Os baldes ficam na tabela do qdisc mesmo sem a cadeia e prendem as classes: remover os que apontam para hosts que deixam de existir
+		for node in nodes:
+			if node['flowid'] and node['handle'].count(':') == 2 and int(node['handle'].split(':')[0], 16) >= self.PER_HOST_HT_BASE and self._classid_key(node['flowid']) not in wanted:
+				self._run_command(['tc', 'filter', 'del', 'dev', dev, 'parent', classid, 'protocol', 'ip', 'prio', str(node['pref']), 'handle', node['handle'], 'u32'], check=False, failure_ok=True)
+		if not plan and not (live_chain or '').strip(): return 0
+		if live_chain: self._run_command(['tc', 'filter', 'del', 'dev', dev, 'parent', classid], check=False, failure_ok=True)
+		if plan: self._apply_per_host(dev, {'class_id': classid, 'name': plan['service'], 'filter_context': plan['context']}, plan, classes=False)
+		logger.info(f"Cadeia por host de {classid} em {dev} " + ("reconstruida." if plan else "removida."))
+		return 1
 
-	def _add_upload_class_and_filter(self, iface, service):
+	def _add_upload_class_and_filter(self, iface, service, add_filter=True, tree=None):
 		try:
-			base_upload_cfg = service['upload']; mark_int = service['mark']; mark_hex = hex(mark_int)
-			# CORREÇÃO: Inicializar final_class_priority e final_filter_prio com os defaults do serviço
-			final_cfg = base_upload_cfg.copy()
-			final_class_priority = str(service.get('priority', 5))
-			final_filter_prio = str(base_upload_cfg.get('filter_priority', 10))
-
-			if 'interfaces' in service and iface in service['interfaces'] and isinstance(service['interfaces'][iface], dict) and 'upload' in service['interfaces'][iface] and isinstance(service['interfaces'][iface]['upload'], dict):
-				override_cfg = service['interfaces'][iface]['upload']; logger.debug(f"Override upload m:{mark_hex} i:{iface} {override_cfg}"); final_cfg.update(override_cfg)
-				# Atualizar se houver override específico
-				final_class_priority = str(override_cfg.get('priority', final_class_priority)) # Usa o já definido se não houver no override
-				final_filter_prio = str(override_cfg.get('filter_priority', final_filter_prio)) # Usa o já definido se não houver no override
-
-			if not all(k in final_cfg for k in ('class_id_suffix', 'rate', 'ceil')): logger.error(f"Cfg upload incompleta m:{mark_hex} i:{iface}"); return
-			class_id_suffix = final_cfg['class_id_suffix']
-			if not isinstance(class_id_suffix, (str, int)) or not str(class_id_suffix).isdigit(): logger.error(f"class_id_suffix upload inválido m:{mark_hex} i:{iface}"); return
-			class_id = f"1:{class_id_suffix}"
-			logger.info(f"Config classe UPLOAD {class_id} m:{mark_hex} i:{iface} (r:{final_cfg['rate']} c:{final_cfg['ceil']} p:{final_class_priority})")
-			if not self._run_command(['tc', 'class', 'replace', 'dev', iface, 'parent', '1:1', 'classid', class_id, 'htb', 'rate', final_cfg['rate'], 'ceil', final_cfg['ceil'], 'prio', final_class_priority]): logger.error(f"Falha classe upload {class_id}."); return
-			if not self._run_command(['tc', 'filter', 'replace', 'dev', iface, 'parent', '1:', 'protocol', 'ip', 'prio', final_filter_prio, 'u32', 'match', 'mark', mark_hex, '0xffffffff', 'flowid', class_id]): logger.error(f"Falha filtro upload m:{mark_hex}.")
+			srv = self._resolve_service_class(iface, service, 'upload', tree)
+			if not srv: return
+			mark_hex = srv['mark_hex']; class_id = srv['class_id']; final_filter_prio = srv['filter_priority']
+			logger.info(f"Config classe UPLOAD {class_id} m:{mark_hex} i:{iface} (r:{srv['rate']}bit c:{srv['ceil']}bit p:{srv['priority']})")
+			if not self._run_command(['tc', 'class', 'replace', 'dev', iface, 'parent', srv['parent'], 'classid', class_id] + srv['htb_args'], context=srv['class_context']): logger.error(f"Falha classe upload {class_id}."); return
+			per_host = self._per_host_plan(iface, service, 'upload', srv, tree)
+			if per_host: self._apply_per_host(iface, srv, per_host)
+			else: self._attach_leaf_qdisc(iface, class_id, srv['leaf'])
+			if not add_filter: return
+			if not self._run_command(['tc', 'filter', 'replace', 'dev', iface, 'parent', srv['qdisc'], 'protocol', 'ip', 'prio', final_filter_prio, 'u32', 'match', 'mark', mark_hex, '0xffffffff', 'flowid', class_id], context=srv['filter_context']): logger.error(f"Falha filtro upload m:{mark_hex}.")
 			else: logger.info(f"Filtro upload (m:{mark_hex} -> {class_id}, prio:{final_filter_prio}) OK.")
 		except KeyError as e: logger.error(f"Erro cfg serviço upload m:{service.get('mark', 'N/A')} i:{iface}: Chave {e}")
 		except Exception as e: logger.error(f"Erro inesperado upload m:{service.get('mark', 'N/A')} i:{iface}: {e}", exc_info=True)
 
-	def _add_download_class_and_filter(self, ifb_name, service):
+	def _add_download_class_and_filter(self, ifb_name, service, add_filter=True, tree=None):
 		try:
-			mark_int = service['mark']; mark_hex = hex(mark_int); base_download_cfg = service['download']
-			# CORREÇÃO: Inicializar final_class_priority e final_filter_prio com os defaults do serviço
-			final_cfg = base_download_cfg.copy()
-			final_class_priority = str(service.get('priority', 5))
-			final_filter_prio = str(base_download_cfg.get('filter_priority', 10)) # Default do serviço para download
-
-			if 'interfaces' in service and ifb_name in service['interfaces'] and isinstance(service['interfaces'][ifb_name], dict) and 'download' in service['interfaces'][ifb_name] and isinstance(service['interfaces'][ifb_name]['download'], dict):
-				override_cfg = service['interfaces'][ifb_name]['download']; logger.debug(f"Override download (connmark) m:{mark_hex} i IFB {ifb_name}: {override_cfg}"); final_cfg.update(override_cfg)
-				# Atualizar se houver override específico
-				final_class_priority = str(override_cfg.get('priority', final_class_priority))
-				final_filter_prio = str(override_cfg.get('filter_priority', final_filter_prio))
-
-			if not all(k in final_cfg for k in ('class_id_suffix', 'rate', 'ceil')): logger.error(f"Cfg download incompleta (connmark) m:{mark_hex} i:{ifb_name}"); return
-			class_id_suffix = final_cfg['class_id_suffix']
-			if not isinstance(class_id_suffix, (str, int)) or not str(class_id_suffix).isdigit(): logger.error(f"class_id_suffix download inválido (connmark) m:{mark_hex} i:{ifb_name}"); return
-			class_id = f"1:{class_id_suffix}"
-			logger.info(f"Config classe DOWNLOAD {class_id} (connmark m:{mark_hex}) i:{ifb_name} (r:{final_cfg['rate']} c:{final_cfg['ceil']} p:{final_class_priority})")
-			if not self._run_command(['tc', 'class', 'replace', 'dev', ifb_name, 'parent', '1:1', 'classid', class_id, 'htb', 'rate', final_cfg['rate'], 'ceil', final_cfg['ceil'], 'prio', final_class_priority]): logger.error(f"Falha classe download {class_id} (connmark)."); return
-			cmd_filter = ['tc', 'filter', 'replace', 'dev', ifb_name, 'parent', '1:', 'protocol', 'ip', 'prio', final_filter_prio, 'u32', 'match', 'mark', mark_hex, '0xffffffff', 'flowid', class_id]
-			if not self._run_command(cmd_filter): logger.error(f"Falha filtro download (match mark {mark_hex}) -> {class_id} i:{ifb_name}.")
+			srv = self._resolve_service_class(ifb_name, service, 'download', tree)
+			if not srv: return
+			mark_hex = srv['mark_hex']; class_id = srv['class_id']; final_filter_prio = srv['filter_priority']
+			logger.info(f"Config classe DOWNLOAD {class_id} (connmark m:{mark_hex}) i:{ifb_name} (r:{srv['rate']}bit c:{srv['ceil']}bit p:{srv['priority']})")
+			if not self._run_command(['tc', 'class', 'replace', 'dev', ifb_name, 'parent', srv['parent'], 'classid', class_id] + srv['htb_args'], context=srv['class_context']): logger.error(f"Falha classe download {class_id} (connmark)."); return
+			per_host = self._per_host_plan(ifb_name, service, 'download', srv, tree)
+			if per_host: self._apply_per_host(ifb_name, srv, per_host)
+			else: self._attach_leaf_qdisc(ifb_name, class_id, srv['leaf'])
+			if not add_filter: return
+			cmd_filter = ['tc', 'filter', 'replace', 'dev', ifb_name, 'parent', srv['qdisc'], 'protocol', 'ip', 'prio', final_filter_prio, 'u32', 'match', 'mark', mark_hex, '0xffffffff', 'flowid', class_id]
+			if not self._run_command(cmd_filter, context=srv['filter_context']): logger.error(f"Falha filtro download (match mark {mark_hex}) -> {class_id} i:{ifb_name}.")
 			else: logger.info(f"Filtro download (mark {mark_hex} -> {class_id}, prio: {final_filter_prio}) OK i:{ifb_name}.")
 		except KeyError as e: logger.error(f"Erro cfg serviço download (connmark) m:{service.get('mark','N/A')} i:{ifb_name}: Chave {e}")
 		except Exception as e: logger.error(f"Erro inesperado download (connmark) m:{service.get('mark','N/A')} i:{ifb_name}: {e}", exc_info=True)
 
+	def _capture_command(self, cmd):
+		# Leitura de estado (nunca entra em batch); devolve stdout ou None
+		cmd_str = ' '.join(shlex.quote(c) for c in cmd)
+		logger.debug("Lendo estado: %s", cmd_str)
+		try:
+			with self._span(cmd[0], 'cmd', cmd=cmd_str) as span: result = subprocess.run(cmd, capture_output=True, text=True, timeout=20); span['status'] = result.returncode
+		except Exception as e:
+			logger.error(f"Erro inesperado ao executar {cmd_str}: {e}"); return None
+		if result.returncode != 0: logger.debug("Comando %s falhou: %s", cmd_str, result.stderr.strip()); return None
+		return result.stdout
+
+	def _read_live_tc(self, dev):
+		live = {'root': None, 'ingress': False, 'children': [], 'leaves': {}, 'classes': {}, 'filters': [], 'ingress_filters': []}
+		qdisc_out = self._capture_command(['tc', '-j', 'qdisc', 'show', 'dev', dev])
+		if qdisc_out is None: return None
+		try: qdiscs = json.loads(qdisc_out or '[]')
+		except ValueError: logger.error(f"Saida JSON invalida de 'tc -j qdisc show dev {dev}'."); return None
+		for qd in qdiscs:
+			if qd.get('root'): live['root'] = qd
+			elif qd.get('kind') == 'ingress': live['ingress'] = True
+			elif qd.get('kind') == 'htb': live['children'].append(qd) # HTB por fila (topologia mq)
+			elif qd.get('parent') and qd.get('kind') != 'mq': live['leaves'][self._classid_key(qd['parent'])] = qd
+		# O JSON do iproute2 nao inclui os parametros HTB das classes nem a marca dos filtros u32: usar a saida de texto
+		for line in (self._capture_command(['tc', 'class', 'show', 'dev', dev]) or '').splitlines():
+			cls = self._parse_tc_class_line(line)
+			if cls: live['classes'][cls['classid']] = cls
+		for qd in ([live['root']] if live['root'] else []) + live['children']:
+			if qd.get('kind') != 'htb': continue
+			# Com 'parent' o tc omite o pai de cada filtro na saida
+			for flt in self._parse_tc_filter_output(self._capture_command(['tc', 'filter', 'show', 'dev', dev, 'parent', qd['handle']]) or ''):
+				flt['parent'] = flt['parent'] or qd['handle']; live['filters'].append(flt)
+		if live['ingress']: live['ingress_filters'] = self._parse_tc_filter_output(self._capture_command(['tc', 'filter', 'show', 'dev', dev, 'ingress']) or '')
+		return live
+
+	def _parse_tc_class_line(self, line):
+		tokens = line.split()
+		if len(tokens) < 3 or tokens[0] != 'class': return None
+		cls = {'kind': tokens[1], 'classid': tokens[2], 'parent': None, 'prio': 0}
+		for i, tok in enumerate(tokens[3:-1], 3):
+			if tok in ('parent', 'leaf', 'rate', 'ceil', 'burst', 'cburst', 'quantum'): cls[tok] = tokens[i + 1]
+			elif tok == 'prio' and tokens[i + 1].isdigit(): cls['prio'] = int(tokens[i + 1])
+		return cls
+
+	def _parse_tc_filter_output(self, output):
+		filters = []; current = None
+		for line in output.splitlines():
+			tokens = line.split()
+			if not tokens: continue
+			if tokens[0] == 'filter':
+				current = None
+				flt = {'kind': None, 'pref': None, 'parent': None, 'protocol': None, 'handle': None, 'flowid': None, 'mark': None, 'mark_mask': None, 'redirect': None}
+				for i, tok in enumerate(tokens[:-1]):
+					if tok in ('parent', 'protocol', 'fh'): flt['handle' if tok == 'fh' else tok] = tokens[i + 1]
+					elif tok == 'handle' and flt['kind'] == 'fw': flt['handle'] = tokens[i + 1]; flt['mark'] = int(tokens[i + 1], 16)
+					elif tok == 'pref': flt['pref'] = int(tokens[i + 1])
+					elif tok.lstrip('*') in ('flowid', 'classid'): flt['flowid'] = tokens[i + 1]
+					elif tok == 'chain' and i >= 1: flt['kind'] = tokens[i - 1]
+				# Linhas de cabecalho (sem handle de no, ex: 'fh 800:') nao representam regras
+				if flt['handle'] is None or (flt['kind'] == 'u32' and flt['handle'].endswith(':')): continue
+				filters.append(flt); current = flt
+			elif current is not None:
+				if tokens[0] == 'mark' and len(tokens) >= 3: current['mark'] = int(tokens[1], 16); current['mark_mask'] = int(tokens[2], 16)
+				m = re.search(r'Redirect to device (\S+?)\)', line)
+				if m: current['redirect'] = m.group(1)
+		return filters
+
+	def _desired_shaping(self, dev, bandwidth, default_class, direction, tree=None):
+		tree = tree or self.ROOT_TREE; major = tree['major']
+		default_id = self._tree_classid(default_class['id'], tree)
+		desired = {'default': default_id.split(':')[-1], 'classes': {}, 'filters': [], 'per_host': {}}
+		tree_bw = self._tree_rate(bandwidth, tree); default_rate = self._tree_rate(default_class['rate'], tree); default_ceil = self._tree_rate(default_class['ceil'], tree); default_prio = str(default_class.get('priority', 7))
+		desired['classes'][f"{major}:1"] = {'parent': None, 'rate': tree_bw, 'ceil': tree_bw, 'prio': '0', 'context': None, 'htb_args': self._htb_args(tree_bw, tree_bw, tree)}
+		desired['classes'][default_id] = {'parent': f"{major}:1", 'rate': default_rate, 'ceil': default_ceil, 'prio': default_prio, 'context': None,
+										  'leaf': (self._iface_cfg_for_dev(dev, direction, tree.get('wan')) or {}).get('default_leaf'), 'htb_args': self._htb_args(default_rate, default_ceil, tree, default_prio)}
+		services = self.config.get('services', [])
+		if not services: return desired
+		for service in services:
+			if not isinstance(service, dict) or 'mark' not in service or not isinstance(service.get(direction), dict): continue
+			srv = self._resolve_service_class(dev, service, direction, tree)
+			if not srv: continue
+			per_host = self._per_host_plan(dev, service, direction, srv, tree)
+			desired['classes'][srv['class_id']] = {'parent': srv['parent'], 'rate': srv['rate'], 'ceil': srv['ceil'], 'prio': srv['priority'], 'context': srv['class_context'], 'leaf': srv['leaf'], 'htb_args': srv['htb_args'], 'inner': bool(per_host)}
+			if per_host: desired['classes'].update(per_host['classes']); desired['per_host'][srv['class_id']] = per_host
+			desired['filters'].append({'kind': 'u32', 'prio': int(srv['filter_priority']), 'mark': service['mark'], 'flowid': srv['class_id'], 'context': srv['filter_context']})
+		desired['filters'].append({'kind': 'u32', 'prio': self.DEFAULT_FILTER_PRIO, 'mark': self.DEFAULT_MARK, 'flowid': default_id, 'context': None})
+		if (self._iface_cfg_for_dev(dev, direction, tree.get('wan')) or {}).get('classifier') == 'fw':
+			desired['filters'] = [dict(entry, kind='fw', prio=self.FW_FILTER_PRIO) for entry in self._mark_class_map(dev, direction, default_class['id'], tree)]
+		return desired
+
+	def _classid_key(self, classid):
+		# '1:30', '1:0030' e '0001:30' designam a mesma classe (hexadecimal)
+		try:
+			major, minor = classid.split(':')
+			return (int(major or '0', 16), int(minor or '0', 16))
+		except (ValueError, AttributeError): return None
+
+	def _same_classid(self, a, b):
+		key_a = self._classid_key(a)
+		return key_a is not None and key_a == self._classid_key(b)
+
+	def _same_rate(self, live_value, desired_value):
+		live_bps = self._parse_rate_bps(live_value); desired_bps = self._parse_rate_bps(desired_value)
+		# O kernel guarda bytes/s: comparar com essa granularidade
+		return live_bps is not None and desired_bps is not None and live_bps // 8 == desired_bps // 8
+
+	def _same_size(self, live_value, desired_bytes):
+		# O tc mostra o burst arredondado (ex: 26Kb) e o kernel guarda-o como tempo: tolerancia de 2%
+		live_bytes = self._parse_leaf_value(live_value, 'size') if live_value else None
+		return live_bytes is not None and abs(live_bytes - desired_bytes) <= max(16, desired_bytes // 50)
+
+	def _reconcile_shaping(self, dev, bandwidth, default_class, direction, wan=None):
+		logger.info(f"Reconciliando shaping HTB {direction} em {dev}" + (f" (WAN {wan})..." if wan else "..."))
+		if not self._link_exists(dev): logger.error(f"Interface {dev} não encontrada."); return False
+		if bandwidth is None or not default_class or not all(k in default_class for k in ('id', 'rate', 'ceil')): logger.error(f"Configuracao {direction} invalida para {dev}."); return False
+		live = self._read_live_tc(dev)
+		if live is None: logger.error(f"Nao foi possivel ler o estado TC de {dev}."); return False
+		trees = self._shaping_trees(dev, direction, wan); lan_tree = trees[0] if trees[0].get('wan') else None
+		desired_default = default_class['id'].split(':')[-1]
+		root = live['root']
+		if lan_tree: structure_ok = any(self._htb_qdisc_ok(qd, f"{lan_tree['major']}:", lan_tree['parent'], desired_default) for qd in live['children'])
+		elif trees[0]['parent'] == 'root': structure_ok = self._htb_qdisc_ok(root, '1:', None, desired_default)
+		else:
+			structure_ok = bool(root) and root.get('kind') == 'mq' and self._same_classid(root.get('handle'), '1:') and len(live['children']) == len(trees)
+			structure_ok = structure_ok and all(any(self._htb_qdisc_ok(qd, f"{tree['major']}:", tree['parent'], desired_default) for qd in live['children']) for tree in trees)
+		if not structure_ok:
+			# Alteracao estrutural (topologia, numero de filas ou classe default diferente): nao ha operacao in-place possivel
+			logger.info(f"Hierarquia em {dev} incompativel (root: {(root or {}).get('kind')} {(root or {}).get('handle')}, default: {(root or {}).get('options', {}).get('default')}, filas HTB: {len(live['children'])}). Reconstruindo {direction}.")
+			return self._build_shaping(dev, bandwidth, default_class, direction, wan)
+		changes = (self._reconcile_lan_branch(dev, live, lan_tree) if lan_tree else 0) + sum(self._reconcile_tree(dev, live, self._desired_shaping(dev, bandwidth, default_class, direction, tree), tree) for tree in trees)
+		logger.info(f"Reconciliacao {direction} em {dev}: {changes} alteracoes.")
+		return True
+
+	def _reconcile_lan_branch(self, dev, live, tree):
+		# Classe 1:N da WAN na raiz LAN e filtro de despacho da prio N (a subarvore N: e reconciliada a parte)
+		if_cfg = self._iface_cfg_for_dev(dev, 'download', tree['wan']); lan = if_cfg['lan']; rate = self._lan_branch_rate(if_cfg); changes = 0
+		have = next((cls for classid, cls in live['classes'].items() if self._same_classid(classid, tree['parent'])), None) or {}
+		htb_args = self._htb_args(rate, rate, tree); want_burst, want_cburst = (int(htb_args[htb_args.index(key) + 1][:-1]) for key in ('burst', 'cburst'))
+		if not self._same_rate(have.get('rate'), rate) or not self._same_rate(have.get('ceil'), rate) or not self._same_size(have.get('burst'), want_burst) or not self._same_size(have.get('cburst'), want_cburst):
+			logger.info(f"Classe {tree['parent']} da WAN {tree['wan']} em {dev}: r:{have.get('rate')}->{rate}bit")
+			self._run_command(['tc', 'class', 'change', 'dev', dev, 'parent', '1:', 'classid', tree['parent']] + htb_args); changes += 1
+		dispatch = [f for f in live['filters'] if f['pref'] == int(lan['major'], 16) and self._same_classid(f['parent'], '1:')]
+		# Kernel sem marca exportada no u32: so o flowid e comparado
+		if len(dispatch) != 1 or (dispatch[0]['mark'] is not None and (dispatch[0]['mark'], dispatch[0]['mark_mask']) != (lan['mark'], lan['mask'])) or not dispatch[0]['flowid'] or not self._same_classid(dispatch[0]['flowid'], tree['parent']):
+			logger.info(f"Filtro de despacho da WAN {tree['wan']} em {dev} ausente ou diferente; recriando.")
+			self._run_command(self._lan_dispatch_cmd('del', dev, if_cfg), check=False, failure_ok=True)
+			self._run_command(self._lan_dispatch_cmd('add', dev, if_cfg), context=f"{self.IFACE_PREFIX}{if_cfg.get('key')}_LAN_MARK"); changes += 1
+		return changes
+
+	def _same_leaf(self, live_qdisc, leaf):
+		if live_qdisc.get('kind') != leaf['kind']: return False
+		options = live_qdisc.get('options', {})
+		for keyword, _value, canonical in leaf['params']:
+			live_value = options.get(keyword)
+			# O kernel arredonda tempos (ex: 5ms -> 4999us): tolerancia de 1%
+			if not isinstance(live_value, (int, float)) or abs(live_value - canonical) > max(1, canonical // 100): return False
+		return True
+
+	def _htb_qdisc_ok(self, qd, handle, parent, default_minor):
+		if not qd or qd.get('kind') != 'htb' or not self._same_classid(qd.get('handle'), handle): return False
+		if parent is not None and not self._same_classid(qd.get('parent'), parent): return False
+		live_default = qd.get('options', {}).get('default')
+		return live_default is not None and self._same_classid(f"1:{live_default}", f"1:{default_minor}")
+
+	def _reconcile_tree(self, dev, live, desired, tree):
+		changes = 0; qdisc = f"{tree['major']}:"; major_key = int(tree['major'], 16)
+		# Com subclasses por host as escritas seguem num unico batch tambem no modo exec (as leituras sao do estado anterior)
+		own_batch = self._batch is None and bool(desired['per_host'])
+		if own_batch: self._batch = []; self._batch_links = {}
+		live_classes = {self._classid_key(classid): (classid, cls) for classid, cls in live['classes'].items() if cls['kind'] == 'htb' and self._classid_key(classid)[0] == major_key}
+		matched_classes = set(); fresh_classes = set()
+		for classid, want in desired['classes'].items():
+			live_id, have = live_classes.get(self._classid_key(classid), (None, None))
+			if have is None or not ((want['parent'] is None and have.get('parent') is None) or (want['parent'] is not None and have.get('parent') and self._same_classid(have['parent'], want['parent']))): fresh_classes.add(self._classid_key(classid))
+			parent_args = ['parent', want['parent'] or qdisc]
+			htb_args = want['htb_args']
+			if have is None:
+				self._run_command(['tc', 'class', 'add', 'dev', dev] + parent_args + ['classid', classid] + htb_args, context=want['context']); changes += 1; continue
+			matched_classes.add(self._classid_key(live_id))
+			same_parent = (want['parent'] is None and have.get('parent') is None) or (want['parent'] is not None and have.get('parent') and self._same_classid(have['parent'], want['parent']))
+			if not same_parent:
+				logger.info(f"Classe {classid} em {dev} mudou de pai; sera recriada.")
+				self._run_command(['tc', 'class', 'del', 'dev', dev, 'classid', live_id], check=False, failure_ok=True)
+				self._run_command(['tc', 'class', 'add', 'dev', dev] + parent_args + ['classid', classid] + htb_args, context=want['context']); changes += 1; continue
+			want_burst, want_cburst = (int(htb_args[htb_args.index(key) + 1][:-1]) for key in ('burst', 'cburst'))
+			if not self._same_rate(have.get('rate'), want['rate']) or not self._same_rate(have.get('ceil'), want['ceil']) or (want['parent'] and not want.get('inner') and have.get('prio', 0) != int(want['prio'])) or not self._same_size(have.get('burst'), want_burst) or not self._same_size(have.get('cburst'), want_cburst):
+				logger.info(f"Classe {classid} em {dev}: r:{have.get('rate')}->{want['rate']}bit c:{have.get('ceil')}->{want['ceil']}bit p:{have.get('prio')}->{want['prio']} b:{have.get('burst')}->{want_burst}b cb:{have.get('cburst')}->{want_cburst}b")
+				self._run_command(['tc', 'class', 'change', 'dev', dev] + parent_args + ['classid', classid] + htb_args, context=want['context']); changes += 1
+		# Filtros: emparelhar por tipo+prio+marca (u32 sem marca exportada pelo kernel: prio+flowid)
+		live_filters = [f for f in live['filters'] if f['kind'] in self.CLASSIFIERS and self._same_classid(f['parent'], qdisc)]
+		filters_by_pref = {}
+		for i, f in enumerate(live_filters): filters_by_pref.setdefault(f['pref'], []).append(i)
+		desired_kinds = {}
+		for want in desired['filters']: desired_kinds.setdefault(want['prio'], want['kind'])
+		matched_filters = set()
+		for pref, indexes in filters_by_pref.items():
+			if pref in desired_kinds and any(live_filters[i]['kind'] != desired_kinds[pref] for i in indexes):
+				# Uma prio so pode ter um tipo de classificador: remover antes de instalar o novo
+				logger.info(f"Prio {pref} em {dev} muda para {desired_kinds[pref]}; removendo filtros anteriores.")
+				self._run_command(['tc', 'filter', 'del', 'dev', dev, 'parent', qdisc, 'protocol', live_filters[indexes[0]]['protocol'] or 'ip', 'prio', str(pref)], check=False, failure_ok=True); changes += 1
+				matched_filters.update(indexes)
+		for want in desired['filters']:
+			candidates = [i for i in filters_by_pref.get(want['prio'], []) if i not in matched_filters and live_filters[i]['kind'] == want['kind']]
+			match_idx = next((i for i in candidates if live_filters[i]['mark'] == want['mark']), None)
+			if match_idx is None and want['kind'] == 'u32': match_idx = next((i for i in candidates if live_filters[i]['mark'] is None and live_filters[i]['flowid'] and self._same_classid(live_filters[i]['flowid'], want['flowid'])), None)
+			if want['kind'] == 'fw': filter_args = ['handle', hex(want['mark']), 'fw', 'flowid', want['flowid']]
+			else: filter_args = ['u32', 'match', 'mark', hex(want['mark']), '0xffffffff', 'flowid', want['flowid']]
+			if match_idx is None:
+				self._run_command(['tc', 'filter', 'add', 'dev', dev, 'parent', qdisc, 'protocol', 'ip', 'prio', str(want['prio'])] + filter_args, context=want['context']); changes += 1; continue
+			matched_filters.add(match_idx); have = live_filters[match_idx]
+			if not have['flowid'] or not self._same_classid(have['flowid'], want['flowid']):
+				handle_args = ['handle', have['handle']] if want['kind'] == 'u32' else []
+				self._run_command(['tc', 'filter', 'replace', 'dev', dev, 'parent', qdisc, 'protocol', 'ip', 'prio', str(want['prio'])] + handle_args + filter_args, context=want['context']); changes += 1
+		for pref, indexes in filters_by_pref.items():
+			if pref in desired_kinds or all(i in matched_filters for i in indexes): continue
+			# Nenhum filtro desejado nesta prio: remover a prio inteira (inclui a tabela u32) numa unica operacao
+			logger.info(f"Removendo prio de filtro obsoleta {pref} em {dev} ({len(indexes)} filtro(s)).")
+			self._run_command(['tc', 'filter', 'del', 'dev', dev, 'parent', qdisc, 'protocol', live_filters[indexes[0]]['protocol'] or 'ip', 'prio', str(pref)], check=False, failure_ok=True); changes += 1
+			matched_filters.update(indexes)
+		for i, have in enumerate(live_filters):
+			if i in matched_filters: continue
+			logger.info(f"Removendo filtro obsoleto em {dev} (prio {have['pref']} handle {have['handle']} -> {have['flowid']}).")
+			self._run_command(['tc', 'filter', 'del', 'dev', dev, 'parent', qdisc, 'protocol', have['protocol'] or 'ip', 'prio', str(have['pref']), 'handle', have['handle'], have['kind']], check=False, failure_ok=True); changes += 1
+		# Cadeias por host nas classes de servico; classes que deixam de ter hosts perdem a cadeia antes de as subclasses serem removidas
+		desired_chains = {self._classid_key(classid): (classid, plan) for classid, plan in desired['per_host'].items()}
+		live_parents = {self._classid_key(cls['parent']) for _live_id, cls in live_classes.values() if cls.get('parent')} - {(major_key, 1)}
+		for key in sorted(set(desired_chains) | live_parents):
+			classid, plan = desired_chains.get(key, (None, None)); live_id = live_classes.get(key, (None, None))[0]
+			live_chain = None if key in fresh_classes or live_id is None else self._capture_command(['tc', 'filter', 'show', 'dev', dev, 'parent', live_id])
+			changes += self._reconcile_per_host(dev, classid or live_id, plan, live_chain)
+		# Subclasses (minor maior que o do pai) antes das classes de servico
+		for key, (live_id, cls) in sorted(live_classes.items(), reverse=True):
+			if key in matched_classes: continue
+			logger.info(f"Removendo classe obsoleta {live_id} em {dev}.")
+			self._run_command(['tc', 'class', 'del', 'dev', dev, 'classid', live_id], check=False, failure_ok=True); changes += 1
+		# Qdiscs folha (no fim: uma classe so aceita folha depois de perder as subclasses): classes novas/recriadas perdem a folha; nas restantes comparar tipo e parametros
+		for classid, want in desired['classes'].items():
+			if want['parent'] is None or want.get('inner'): continue
+			key = self._classid_key(classid); have = None if key in fresh_classes else live['leaves'].get(key); leaf = want.get('leaf')
+			if leaf is None:
+				if have is None: continue
+				logger.info(f"Removendo qdisc folha {have.get('kind')} de {classid} em {dev} (volta ao pfifo default).")
+				self._run_command(['tc', 'qdisc', 'del', 'dev', dev, 'parent', classid], check=False, failure_ok=True); changes += 1
+			elif have is None or not self._same_leaf(have, leaf):
+				self._attach_leaf_qdisc(dev, classid, leaf); changes += 1
+		if own_batch: self._flush_batch(f"reconcile {dev}")
+		return changes
+
+	def _ingress_redirect_ok(self, iface, ifb_name):
+		live = self._read_live_tc(iface)
+		if not live or not live['ingress']: return False
+		return any(f['pref'] == 1 and f['redirect'] == ifb_name for f in live['ingress_filters'])
+
+	def _link_is_up(self, name):
+		try: return int(Path(f"{self.SYS_CLASS_NET}/{name}/flags").read_text().strip(), 16) & 0x1 == 0x1
+		except (OSError, ValueError): return False
+
+	def _reconcile_iface(self, iface_cfg):
+		iface = iface_cfg['name']; ifb_name = iface_cfg.get('ifb')
+		logger.info(f"Reconciliando TC para iface: {iface}" + (f" com IFB: {ifb_name}" if ifb_name else f" com download em {iface_cfg['lan']['dev']}" if iface_cfg.get('lan') else ""))
+		self._cmd_context = f"interface {iface} ({self.IFACE_PREFIX}{iface_cfg.get('key', iface.upper())}_*)"
+		if not self._link_exists(iface): logger.warning(f"Iface física {iface} não encontrada."); return True
+		if not self._link_is_up(iface) and not self._run_command(['ip', 'link', 'set', 'dev', iface, 'up'], check=False, failure_ok=True): logger.warning(f"Falha ao garantir que {iface} está UP.")
+		if 'total_upload_bw' in iface_cfg and 'default_upload_class' in iface_cfg:
+			if not self._reconcile_shaping(iface, iface_cfg['total_upload_bw'], iface_cfg.get('default_upload_class'), 'upload'): logger.error(f"Falha reconciliacao upload (HTB) para {iface}."); return False
+		if iface_cfg.get('lan') and 'total_download_bw' in iface_cfg and 'default_download_class' in iface_cfg:
+			if not self._reconcile_shaping(iface_cfg['lan']['dev'], iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), 'download', wan=iface): logger.error(f"Falha reconciliacao download (HTB) da WAN {iface} em {iface_cfg['lan']['dev']}."); return False
+		elif ifb_name and 'total_download_bw' in iface_cfg and 'default_download_class' in iface_cfg:
+			ifb_queues = self._ifb_queue_count(ifb_name)
+			ifb_is_new = not self._link_exists(ifb_name) or (ifb_queues > 1 and self._tx_queue_count(ifb_name) != ifb_queues)
+			active = self._ingress_redirect_target(iface) if self.staged else None
+			if active in (ifb_name, self._staging_ifb(ifb_name)) and (ifb_is_new or active != ifb_name):
+				# Modo staged: IFB a recriar (outro numero de filas) ou troca interrompida, sem tirar o trafego da arvore em uso
+				self.managed_ifbs[iface] = ifb_name
+				if not self._staged_ifb_swap(iface, ifb_name, iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), active): logger.error(f"Falha shaping download (HTB) para {ifb_name}."); return False
+				return True
+			if ifb_is_new or not self._ingress_redirect_ok(iface, ifb_name):
+				if not self._setup_ifb(iface, ifb_name): logger.error(f"Falha config IFB {ifb_name} p/ {iface}."); return True
+			elif not self._link_is_up(ifb_name): self._run_command(['ip', 'link', 'set', 'dev', ifb_name, 'up'])
+			self.managed_ifbs[iface] = ifb_name
+			if ifb_is_new:
+				# IFB acabada de criar: nao ha estado a reconciliar
+				if not self._apply_shaping(ifb_name, iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), 'download'): logger.error(f"Falha shaping download (HTB) para {ifb_name}."); return False
+			elif not self._reconcile_shaping(ifb_name, iface_cfg['total_download_bw'], iface_cfg.get('default_download_class'), 'download'): logger.error(f"Falha reconciliacao download (HTB) para {ifb_name}."); return False
+		return True
+
+	def _cleanup_iface(self, iface_cfg):
+		self._cleanup_tc(iface_cfg['name'])
+		if iface_cfg.get('ifb'): self._cleanup_ifb(iface_cfg['ifb'])
+		elif iface_cfg.get('lan'): self._cleanup_lan_branch(iface_cfg)
+
 	def _cleanup_tc(self, iface):
-		if Path(f"/sys/class/net/{iface}").exists():
+		if self._link_exists(iface):
 			logger.info(f"Limpando qdiscs root/ingress em {iface}")
 			self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'root'], check=False, failure_ok=True)
 			self._run_command(['tc', 'qdisc', 'del', 'dev', iface, 'ingress'], check=False, failure_ok=True)
-		else: logger.debug(f"Interface {iface} não encontrada para cleanup TC.")
+		else: logger.debug("Interface %s não encontrada para cleanup TC.", iface)
 
 	def _cleanup_ifb(self, ifb_name):
-		if Path(f"/sys/class/net/{ifb_name}").exists():
+		if self._link_exists(ifb_name):
 			logger.info(f"Removendo IFB {ifb_name}")
 			self._run_command(['tc', 'qdisc', 'del', 'dev', ifb_name, 'root'], check=False, failure_ok=True)
 			self._run_command(['tc', 'qdisc', 'del', 'dev', ifb_name, 'ingress'], check=False, failure_ok=True)
 			self._run_command(['ip', 'link', 'set', 'dev', ifb_name, 'down'], check=False, failure_ok=True)
-			if self._run_command(['ip', 'link', 'del', 'dev', ifb_name], check=False, failure_ok=True):
-				time.sleep(0.1)
-				if not Path(f"/sys/class/net/{ifb_name}").exists(): logger.info(f"IFB {ifb_name} removida com sucesso.")
+			if self._batch is not None: self._run_command(['ip', 'link', 'del', 'dev', ifb_name], check=False, failure_ok=True)
+			elif self._run_command(['ip', 'link', 'del', 'dev', ifb_name], check=False, failure_ok=True):
+				self._settle(f"ifb {ifb_name}")
+				if not Path(f"{self.SYS_CLASS_NET}/{ifb_name}").exists(): logger.info(f"IFB {ifb_name} removida com sucesso.")
 				else: logger.warning(f"Comando 'ip link del {ifb_name}' executado, mas a interface ainda existe.")
 			else: logger.warning(f"Comando 'ip link del {ifb_name}' falhou.")
-		else: logger.debug(f"IFB {ifb_name} não encontrada para remoção.")
+		else: logger.debug("IFB %s não encontrada para remoção.", ifb_name)
+
+	# --- Estatisticas (--stats) ---
+	def _managed_devices(self):
+		# (dispositivo, direcao, interface configurada): upload na interface fisica, download na IFB (ou na interface LAN, uma vez para todas as WANs)
+		devices = []
+		for if_cfg in self.config.get('interfaces', []):
+			devices.append((if_cfg['name'], 'upload', if_cfg['name']))
+			if if_cfg.get('ifb'): devices.append((if_cfg['ifb'], 'download', if_cfg['name']))
+			elif if_cfg.get('lan') and not any(dev == if_cfg['lan']['dev'] for dev, _direction, _iface in devices): devices.append((if_cfg['lan']['dev'], 'download', if_cfg['lan']['dev']))
+		return devices
+
+	def _stats_class_labels(self, dev, direction):
+		# classid -> etiquetas (servico, marca, papel) e taxas configuradas, pela mesma resolucao usada ao aplicar
+		labels = {}
+		for tree in self._shaping_trees(dev, direction):
+			if_cfg = self._iface_cfg_for_dev(dev, direction, tree.get('wan')) or {}
+			default_class = if_cfg.get(f'default_{direction}_class') or {}; bandwidth = if_cfg.get(f'total_{direction}_bw')
+			if tree.get('wan'):
+				rate = self._lan_branch_rate(if_cfg) if bandwidth else None
+				labels[self._classid_key(tree['parent'])] = {'service': '', 'mark': hex(if_cfg['lan']['mark']), 'role': 'wan', 'rate': rate, 'ceil': rate}
+			tree_bw = self._tree_rate(bandwidth, tree) if bandwidth else None
+			labels[self._classid_key(f"{tree['major']}:1")] = {'service': '', 'mark': '', 'role': 'root', 'rate': tree_bw, 'ceil': tree_bw}
+			if default_class.get('id'):
+				labels[self._classid_key(self._tree_classid(default_class['id'], tree))] = {'service': 'default', 'mark': hex(self.DEFAULT_MARK), 'role': 'default',
+																						   'rate': self._tree_rate(default_class.get('rate'), tree), 'ceil': self._tree_rate(default_class.get('ceil'), tree)}
+			for service in self.config.get('services', []):
+				if not isinstance(service, dict) or 'mark' not in service or not isinstance(service.get(direction), dict): continue
+				srv = self._resolve_service_class(dev, service, direction, tree)
+				if srv: labels.setdefault(self._classid_key(srv['class_id']), {'service': srv['name'], 'mark': srv['mark_hex'], 'role': 'service', 'rate': srv['rate'], 'ceil': srv['ceil']})
+				plan = self._per_host_plan(dev, service, direction, srv, tree)
+				for classid, host in (plan or {}).get('classes', {}).items():
+					labels.setdefault(self._classid_key(classid), {'service': srv['name'], 'mark': srv['mark_hex'], 'role': 'host' if host['address'] else 'host_other', 'rate': host['rate'], 'ceil': host['ceil']})
+			# Modo lan: cada classe fica etiquetada com a WAN dona da subarvore
+			for meta in labels.values():
+				if tree.get('wan'): meta.setdefault('interface', tree['wan'])
+		return labels
+
+	def collect_stats(self):
+		# Uma amostra dos contadores de classes e qdiscs de todas as interfaces/IFBs geridas, via dump rtnetlink (sem fork de tc)
+		if self._stats_rtnl is None: self._stats_rtnl = RtnlBackend()
+		rtnl = self._stats_rtnl
+		try:
+			devices = [(dev, direction, iface, rtnl.link_index(dev)) for dev, direction, iface in self._managed_devices()]
+			for dev, _direction, _iface, index in devices:
+				if index is None: logger.warning(f"Estatisticas: dispositivo {dev} nao encontrado.")
+			devices = [d for d in devices if d[3] is not None]
+			dump = rtnl.tc_stats([index for _dev, _direction, _iface, index in devices])
+		except (OSError, RtnlError) as e:
+			logger.error(f"Falha ao recolher estatisticas tc: {e}"); rtnl.close(); return None
+		sample = {'timestamp': time.time(), 'classes': [], 'qdiscs': []}
+		for dev, direction, iface, index in devices:
+			if dev not in self._stats_labels: self._stats_labels[dev] = self._stats_class_labels(dev, direction)
+			labels = self._stats_labels[dev]; base = {'interface': iface, 'device': dev, 'direction': direction}
+			for cls in dump[index]['classes']:
+				meta = labels.get(self._classid_key(cls['handle'])) or {'service': '', 'mark': '', 'role': 'queue' if cls['kind'] == 'mq' else 'unmanaged'}
+				entry = dict(base, classid=cls['handle'], parent=cls['parent'], kind=cls['kind'], **meta)
+				entry.update((k, v) for k, v in cls.items() if k not in ('ifindex', 'handle', 'parent', 'kind'))
+				sample['classes'].append(entry)
+			for qd in dump[index]['qdiscs']:
+				# Qdiscs folha herdam o servico da classe a que estao ligadas
+				meta = labels.get(self._classid_key(qd['parent'])) or {}
+				entry = dict(base, handle=qd['handle'], parent=qd['parent'], kind=qd['kind'], interface=meta.get('interface', iface), service=meta.get('service', ''), mark=meta.get('mark', ''))
+				entry.update((k, v) for k, v in qd.items() if k not in ('ifindex', 'handle', 'parent', 'kind'))
+				sample['qdiscs'].append(entry)
+		return sample
+
+	def _stats_rates(self, sample, previous):
+		# Taxas por segundo entre a amostra anterior e a atual; contador que recua (reset/recriacao) fica sem taxa
+		elapsed = sample['timestamp'] - (previous or {}).get('timestamp', sample['timestamp'])
+		if elapsed <= 0: return
+		sample['interval'] = elapsed
+		for section, id_key in (('classes', 'classid'), ('qdiscs', 'handle')):
+			old_entries = {(e.get('device'), e.get(id_key), e.get('kind')): e for e in previous.get(section, [])}
+			for entry in sample[section]:
+				old = old_entries.get((entry['device'], entry[id_key], entry['kind']))
+				if not old: continue
+				for counter in self.STATS_RATE_COUNTERS:
+					if counter in entry and isinstance(old.get(counter), int) and entry[counter] >= old[counter]:
+						entry[f'{counter}_rate'] = (entry[counter] - old[counter]) * (8 if counter == 'bytes' else 1) / elapsed
+
+	def _format_prometheus(self, sample):
+		def label_value(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		lines = []
+		for section, kind_name, label_keys in (('classes', 'class', ('interface', 'device', 'direction', 'service', 'mark', 'role', 'classid', 'parent', 'kind')),
+											   ('qdiscs', 'qdisc', ('interface', 'device', 'direction', 'service', 'mark', 'handle', 'parent', 'kind'))):
+			for field, suffix, metric_type, help_text in self.STATS_METRICS:
+				rows = [e for e in sample[section] if e.get(field) is not None]
+				if not rows: continue
+				name = f"{self.STATS_METRIC_PREFIX}_{kind_name}_{suffix}"
+				lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+				for e in rows:
+					value = e[field]
+					labels = ','.join(f'{k}="{label_value(e.get(k, ""))}"' for k in label_keys)
+					lines.append(f"{name}{{{labels}}} {value:.3f}" if isinstance(value, float) else f"{name}{{{labels}}} {value}")
+		lines += [f"# HELP {self.STATS_METRIC_PREFIX}_stats_timestamp_seconds Instante da amostra", f"# TYPE {self.STATS_METRIC_PREFIX}_stats_timestamp_seconds gauge",
+				  f"{self.STATS_METRIC_PREFIX}_stats_timestamp_seconds {sample['timestamp']:.3f}"]
+		return '\n'.join(lines) + '\n'
+
+	def _format_stats(self, sample, export_format):
+		if export_format == 'json': return json.dumps(sample, sort_keys=True) + '\n'
+		return self._format_prometheus(sample)
+
+	def _write_stats(self, text, output):
+		if output in (None, '-'): sys.stdout.write(text); sys.stdout.flush(); return True
+		# Escrita atomica: o textfile collector do node_exporter pode ler o ficheiro a qualquer momento
+		tmp_path = f"{output}.{os.getpid()}.tmp"
+		try: Path(tmp_path).write_text(text); os.replace(tmp_path, output); return True
+		except OSError as e: logger.error(f"Falha ao escrever estatisticas em {output}: {e}"); return False
+
+	def _load_stats_state(self, state_file):
+		return self._read_json(state_file)
+
+	def _save_stats_state(self, state_file, sample):
+		# So os contadores usados nas taxas: a proxima execucao (timer/cron) calcula as taxas a partir daqui
+		keep = ('device', 'classid', 'handle', 'kind') + self.STATS_RATE_COUNTERS
+		state = {'timestamp': sample['timestamp'], 'classes': [{k: e[k] for k in keep if k in e} for e in sample['classes']],
+				 'qdiscs': [{k: e[k] for k in keep if k in e} for e in sample['qdiscs']]}
+		self._write_stats(json.dumps(state), state_file)
+
+	def stats(self, export_format='prometheus', output='-', interval=0, state_file=None):
+		# interval 0: uma amostra (taxas face a amostra guardada em state_file); interval > 0: amostragem continua em memoria
+		if export_format not in self.STATS_FORMATS: raise ValueError(f"Formato de exportacao invalido: '{export_format}'")
+		if not self._parse_macros_from_foomuuri_conf(): logger.error("Falha ao ler configuração dos macros. Abortando."); return False
+		state_file = state_file or self.STATS_STATE_FILE
+		previous = None if interval else self._load_stats_state(state_file)
+		try:
+			while True:
+				started = time.monotonic(); sample = self.collect_stats()
+				if sample is not None:
+					if previous: self._stats_rates(sample, previous)
+					previous = sample
+					if not self._write_stats(self._format_stats(sample, export_format), output) and not interval: return False
+				if not interval:
+					if sample is None: return False
+					self._save_stats_state(state_file, sample); return True
+				time.sleep(max(interval - (time.monotonic() - started), 0))
+		except KeyboardInterrupt: return True
+		finally:
+			if self._stats_rtnl is not None: self._stats_rtnl.close()
 
-	def start(self):
-		logger.info("Iniciando configuração QoS (Macros Foomuuri)...")
+	# --- Cache do plano compilado ---
+	def _conf_hash(self):
+		# Conteudo de todos os ficheiros do conf (nome e tamanho delimitam cada um) e do proprio motor: um plano gerado por outra
+		# versao do script nunca e reutilizado
+		digest = hashlib.sha256()
+		for path in self._conf_files():
+			data = path.read_bytes(); digest.update(f"{path.name}\0{len(data)}\0".encode()); digest.update(data)
+		digest.update(Path(__file__).read_bytes())
+		return digest.hexdigest()
+
+	def _engine_hash(self):
+		return hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+	def _physical_devices(self):
+		names = [i['name'] for i in self.config.get('interfaces', []) if isinstance(i, dict) and 'name' in i]
+		return names + ([self.config['lan']['dev']] if self.config.get('lan') else [])
+
+	def _plan_environment(self, names):
+		# Estado das interfaces fisicas que o plano assume: existencia, MTU e filas de TX (decidem mq, burst e quantum)
+		return {name: [Path(f"{self.SYS_CLASS_NET}/{name}").exists(), self._link_mtu(name), self._tx_queue_count(name)] for name in names}
+
+	def _live_signature(self, devices):
+		# Impressao digital barata do estado tc: qdiscs e classes de cada dispositivo, num dump rtnetlink (sem fork de tc)
+		rtnl = RtnlBackend()
 		try:
-			if not self._parse_macros_from_foomuuri_conf():
-				logger.error("Falha ao ler configuração dos macros. Abortando.")
-				return False
-			self._full_cleanup_attempt()
-			if not self.setup_tc():
+			indexes = {dev: rtnl.link_index(dev) for dev in devices}
+			dump = rtnl.tc_stats([index for index in indexes.values() if index is not None])
+		except (OSError, RtnlError) as e: logger.debug("Falha ao ler o estado tc: %s", e); return None
+		finally: rtnl.close()
+		return {dev: None if index is None else sorted([f"qdisc {e['kind']} {e['handle']} {e['parent']}" for e in dump[index]['qdiscs']] +
+													  [f"class {e['kind']} {e['handle']} {e['parent']}" for e in dump[index]['classes']]) for dev, index in indexes.items()}
+
+	def _read_json(self, path):
+		try: return json.loads(Path(path).read_text())
+		except (OSError, ValueError): return None
+
+	def _write_json_atomic(self, path, data):
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		try: Path(path).parent.mkdir(parents=True, exist_ok=True); Path(tmp_path).write_text(json.dumps(data)); os.replace(tmp_path, path); return True
+		except OSError as e: logger.warning(f"Falha ao escrever {path}: {e}"); return False
+
+	def _live_plan_current(self, conf_hash):
+		# Restart com o conf inalterado: o plano registado como ativo serve se o ambiente e a estrutura tc nao mudaram
+		live = self._read_json(self.live_plan) if self.live_plan else None
+		if not isinstance(live, dict) or live.get('conf_hash') != conf_hash: return False
+		if live.get('environment') != self._plan_environment(list(live.get('environment') or {})): logger.info("Interfaces alteradas desde o ultimo start."); return False
+		if live.get('signature') != self._live_signature(list(live.get('signature') or {})): logger.info("Estado tc difere do plano ativo."); return False
+		return True
+
+	def _load_plan_cache(self, conf_hash):
+		cached = self._read_json(self.plan_cache) if self.plan_cache else None
+		if not isinstance(cached, dict) or cached.get('conf_hash') != conf_hash or not isinstance(cached.get('config'), dict): return None
+		return cached
+
+	def _save_plan_cache(self, conf_hash, environment, plans):
+		if self.plan_cache and self._write_json_atomic(self.plan_cache, {'conf_hash': conf_hash, 'environment': environment, 'config': self.config, 'plans': plans}):
+			logger.info(f"Plano compilado guardado em {self.plan_cache}.")
+
+	def _record_live_plan(self, conf_hash, environment):
+		if not self.live_plan: return
+		signature = self._live_signature([dev for dev, _direction, _iface in self._managed_devices()])
+		self._write_json_atomic(self.live_plan, {'conf_hash': conf_hash, 'environment': environment, 'signature': signature, 'applied_at': time.time()})
+
+	def _forget_live_plan(self):
+		if not self.live_plan: return
+		try: Path(self.live_plan).unlink()
+		except FileNotFoundError: pass
+		except OSError as e: logger.warning(f"Falha ao remover {self.live_plan}: {e}")
+
+	def start(self, reconcile=False):
+		logger.info("Iniciando configuração QoS (Macros Foomuuri)" + (" em modo reconcile..." if reconcile else "..."))
+		try:
+			with self._span('plan_cache', 'phase', action='load'):
+				conf_hash = self._conf_hash() if self._conf_files() else None
+				cached = self._load_plan_cache(conf_hash) if conf_hash else None
+			if conf_hash and not reconcile and self._live_plan_current(conf_hash):
+				logger.info("Configuração QoS inalterada e já ativa. Nada a fazer.")
+				# A configuracao continua a ser necessaria a quem usa o motor depois do start (ex.: --daemon)
+				if cached: self.config = cached['config']
+				else:
+					with self._span('parse', 'phase'): self._parse_macros_from_foomuuri_conf()
+				return True
+			if cached:
+				# Conf inalterado: a configuracao resolvida e validada vem do cache, sem parsing nem validacao
+				self.config = cached['config']; logger.info(f"Configuração resolvida lida do cache ({self.plan_cache}).")
+			else:
+				with self._span('parse', 'phase'): parsed = self._parse_macros_from_foomuuri_conf()
+				if not parsed:
+					logger.error("Falha ao ler configuração dos macros. Abortando.")
+					return False
+				with self._span('validate', 'phase'): valid = self._validate_hierarchy()
+				if not valid:
+					logger.error("Hierarquia HTB invalida. Nenhuma alteracao foi aplicada.")
+					return False
+			environment = self._plan_environment(self._physical_devices())
+			# Modo staged: os planos gravados dependem do estado encontrado (IFB de staging, trocas), logo nao sao reexecutados nem guardados
+			self._replay_plans = cached.get('plans') if cached and not self.staged and cached.get('environment') == environment and isinstance(cached.get('plans'), dict) else None
+			self._forget_live_plan(); self.iface_plans = {}
+			if not reconcile and not self.staged: self._full_cleanup_attempt()
+			if not self.setup_tc(reconcile=reconcile):
 				raise Exception("Falha na configuração do TC (Macros Foomuuri).")
+			if conf_hash:
+				with self._span('plan_cache', 'phase', action='save'):
+					if not cached or self._replay_plans is None or self.iface_plans: self._save_plan_cache(conf_hash, environment, {} if self.staged else dict(self._replay_plans or {}, **self.iface_plans))
+					self._record_live_plan(conf_hash, environment)
 			logger.info("Configuração QoS (Macros Foomuuri) APLICADA.")
 			return True
 		except FileNotFoundError:
@@ -477,26 +2872,341 @@ class QoSEngineMacroParserValidated:
 			return False
 		except Exception as e:
 			logger.error(f"ERRO FATAL durante a config QoS (Macros Foomuuri): {e}", exc_info=True)
+			if self.staged: logger.info("Modo staged: sem limpeza, as interfaces que falharam mantem a hierarquia anterior."); return False
 			logger.info("Tentando limpar config TC/IFB devido a erro no start..."); self.stop(); return False
 
 	def stop(self):
 		logger.info("Parando configuração QoS (Macros Foomuuri)...")
+		self._forget_live_plan()
 		self._full_cleanup_attempt()
 		logger.info("Limpeza QoS (Macros Foomuuri) via stop concluída."); return True
 
+	def write_trace(self, path):
+		# Trace completo em JSON e resumo no log: tempo por fase, por ferramenta e nas esperas fixas
+		try: self.trace.write(path)
+		except OSError as e: logger.error(f"Falha ao gravar o trace em {path}: {e}"); return False
+		summary = lambda totals: ', '.join(f"{name} {ms:.0f} ms" for name, ms in totals.items()) or '-'
+		logger.info(f"Trace gravado em {path} ({len(self.trace.events)} spans). Fases: {summary(self.trace.totals('phase'))}. Comandos: {summary(self.trace.totals('cmd'))}. Esperas: {summary(self.trace.totals('sleep'))}.")
+		return True
+
+	# --- Daemon (--daemon) ---
+	def _iface_devices(self, iface_cfg):
+		return [iface_cfg['name']] + ([self._download_target(iface_cfg)] if self._download_target(iface_cfg) else [])
+
+	def _ifaces_for_device(self, dev):
+		# A interface LAN (modo lan) pertence a todas as WANs
+		return [iface_cfg for iface_cfg in self._get_config_interfaces() if isinstance(iface_cfg, dict) and 'name' in iface_cfg and dev in self._iface_devices(iface_cfg)]
+
+	def _remember_iface_state(self, iface_cfg):
+		# Estrutura tc esperada do par interface/IFB depois da ultima aplicacao, comparada a cada evento de link
+		self._daemon_signatures[iface_cfg['name']] = self._live_signature(self._iface_devices(iface_cfg))
+
+	def _rebuild_iface(self, iface_cfg):
+		# Reconstrucao so deste par interface/IFB (limpeza + _setup_iface), sem tocar nas restantes interfaces; no modo staged sem limpeza,
+		# a hierarquia nova substitui a atual
+		if not self.staged:
+			self._begin_batch(); self._cleanup_iface(iface_cfg); self._flush_batch(f"limpeza {iface_cfg['name']}")
+		iface_ok = self._apply_iface(iface_cfg)
+		self.iface_results[iface_cfg['name']] = iface_ok
+		return iface_ok
+
+	def _daemon_reload_config(self):
+		# Conf alterado: parsing e validacao num motor novo; so um conf valido substitui o que esta em uso.
+		# Interfaces novas/alteradas sao reconstruidas, as removidas limpas e as restantes reconciliadas (so os servicos alterados).
+		candidate = QoSEngineMacroParserValidated(self.foomuuri_config_path, parse_cache=self.parse_cache)
+		candidate.conf_reader = self.conf_reader # ficheiros inalterados desde o ultimo parsing nao voltam a ser analisados
+		if not candidate._parse_macros_from_foomuuri_conf() or not candidate._validate_hierarchy():
+			logger.error("Conf alterado e invalido: mantida a configuracao QoS em uso."); return set(), set()
+		old_ifaces = {i['name']: i for i in self._get_config_interfaces() if isinstance(i, dict) and 'name' in i}
+		new_ifaces = {i['name']: i for i in candidate.config.get('interfaces', []) if isinstance(i, dict) and 'name' in i}
+		def normalized(value): return json.loads(json.dumps(value)) # a config vinda do cache tem listas no lugar de tuplos
+		old_ifaces = {name: normalized(cfg) for name, cfg in old_ifaces.items()}
+		services_changed = normalized(candidate.config.get('services')) != normalized(self.config.get('services'))
+		old_lan = normalized(self.config.get('lan')); new_lan = normalized(candidate.config.get('lan'))
+		self.config = candidate.config; self.macro_index = candidate.macro_index; self._load_modules()
+		if old_lan and old_lan != new_lan:
+			# Interface LAN ou mascara diferente: a raiz antiga sai inteira (as WANs em modo lan mudam de config e sao reconstruidas)
+			logger.info(f"Configuracao LAN alterada: limpando a raiz em {old_lan['dev']}.")
+			if self._link_exists(old_lan['dev']): self._run_command(['tc', 'qdisc', 'del', 'dev', old_lan['dev'], 'root'], check=False, failure_ok=True)
+		for name, iface_cfg in old_ifaces.items():
+			if name in new_ifaces:
+				# Interface mantida com outra IFB (ou passou ao modo lan) ou outra subarvore LAN (majors seguem a ordem das WANs): o que a config antiga criou fica orfao
+				new_cfg = normalized(new_ifaces[name]); self._begin_batch()
+				if iface_cfg.get('ifb') and iface_cfg['ifb'] != new_cfg.get('ifb'): logger.info(f"Interface {name} deixa a IFB {iface_cfg['ifb']}: removendo-a."); self._cleanup_ifb(iface_cfg['ifb'])
+				elif iface_cfg.get('lan') and old_lan == new_lan and iface_cfg['lan'] != new_cfg.get('lan'): self._cleanup_lan_branch(iface_cfg)
+				self._flush_batch(f"limpeza {name}"); continue
+			logger.info(f"Interface {name} removida do conf: limpando.")
+			self._begin_batch(); self._cleanup_tc(name)
+			if iface_cfg.get('ifb'): self._cleanup_ifb(iface_cfg['ifb'])
+			elif iface_cfg.get('lan') and old_lan == new_lan: self._cleanup_lan_branch(iface_cfg)
+			self._flush_batch(f"limpeza {name}"); self._daemon_signatures.pop(name, None); self.iface_results.pop(name, None)
+		rebuild = {name for name, iface_cfg in new_ifaces.items() if old_ifaces.get(name) != normalized(iface_cfg)}
+		reconcile = set(new_ifaces) - rebuild if services_changed else set()
+		logger.info(f"Conf recarregado: reconstruir {sorted(rebuild) or '-'}, reconciliar {sorted(reconcile) or '-'}.")
+		return rebuild, reconcile
+
+	def _daemon_process(self, pending, reload_conf):
+		rebuild, reconcile = self._daemon_reload_config() if reload_conf else (set(), set())
+		# Raiz LAN reposta antes da comparacao: se foi recriada, as subarvores das WANs faltam e estas sao reconstruidas
+		if (pending or rebuild or reconcile) and not self._setup_lan_root(): logger.error("Falha ao repor a raiz LAN.")
+		for name in sorted(pending - rebuild - reconcile):
+			iface_cfg = next(iter(self._ifaces_for_device(name)), None)
+			if iface_cfg is None: continue
+			if self._live_signature(self._iface_devices(iface_cfg)) == self._daemon_signatures.get(name): logger.debug("Evento de link em %s: estado tc intacto.", name); continue
+			logger.info(f"Estado tc de {name} perdido ou alterado (evento de link): reconstruindo."); rebuild.add(name)
+		changed = False
+		for iface_cfg in self._get_config_interfaces():
+			if not isinstance(iface_cfg, dict) or 'name' not in iface_cfg: continue
+			name = iface_cfg['name']
+			if name in rebuild: self._rebuild_iface(iface_cfg)
+			elif name in reconcile: self.iface_results[name] = self._apply_iface(iface_cfg, reconcile=True)
+			else: continue
+			# Falha: sem estado de referencia, o proximo evento volta a reconstruir
+			if self.iface_results.get(name): self._remember_iface_state(iface_cfg)
+			else: self._daemon_signatures.pop(name, None)
+			changed = True
+		if changed and self._conf_files(): self._record_live_plan(self._conf_hash(), self._plan_environment(self._physical_devices()))
+
+	def daemon(self, debounce=None):
+		# Processo residente: eventos rtnetlink de link e inotify no conf. Parado, fica bloqueado em select() sem timeout.
+		debounce = self.DAEMON_DEBOUNCE if debounce is None else debounce
+		if not self.start(): logger.error("Start inicial falhou; o daemon continua e volta a tentar no proximo evento.")
+		rtnl = RtnlBackend(); link_sock = rtnl.monitor_socket(RtnlBackend.RTMGRP_LINK)
+		watcher = ConfigWatcher([self.foomuuri_config_path])
+		wake_r, wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+		flags = {'stop': False, 'reload': False}
+		def on_signal(signum, _frame): flags['stop' if signum in (signal.SIGTERM, signal.SIGINT) else 'reload'] = True
+		for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP): signal.signal(signum, on_signal)
+		signal.set_wakeup_fd(wake_w)
+		self._daemon_signatures = {}
+		for iface_cfg in self._get_config_interfaces():
+			if isinstance(iface_cfg, dict) and 'name' in iface_cfg: self._remember_iface_state(iface_cfg)
+		logger.info(f"Daemon QoS ativo (debounce {debounce}s). A aguardar eventos de link e alteracoes a {self.foomuuri_config_path}.")
+		pending = set(); reload_conf = False; first_event = deadline = None
+		try:
+			while not flags['stop']:
+				timeout = None if first_event is None else max(deadline - time.monotonic(), 0)
+				if watcher.fileno() is None: timeout = ConfigWatcher.POLL_INTERVAL if timeout is None else min(timeout, ConfigWatcher.POLL_INTERVAL)
+				ready, _, _ = select.select([fd for fd in (link_sock, watcher.fileno(), wake_r) if fd is not None], [], [], timeout)
+				got_event = False
+				if link_sock in ready:
+					while True:
+						try: data = link_sock.recv(1 << 16)
+						except BlockingIOError: break
+						except OSError as e:
+							if e.errno != errno.ENOBUFS: raise
+							# Eventos perdidos (buffer cheio): verificar todas as interfaces
+							logger.warning("Eventos rtnetlink perdidos; verificando todas as interfaces.")
+							pending.update(i['name'] for i in self._get_config_interfaces() if isinstance(i, dict) and 'name' in i); got_event = True; continue
+						for dev, deleted in rtnl.link_events(data):
+							iface_cfgs = self._ifaces_for_device(dev)
+							if not iface_cfgs: continue
+							logger.debug("Evento de link: %s %s.", dev, 'removida' if deleted else 'nova/alterada')
+							pending.update(iface_cfg['name'] for iface_cfg in iface_cfgs); got_event = True
+				if (watcher.fileno() is None or watcher.fileno() in ready) and watcher.changed(): logger.info(f"{self.foomuuri_config_path} alterado."); reload_conf = True; got_event = True
+				if wake_r in ready:
+					try: os.read(wake_r, 512)
+					except BlockingIOError: pass
+					if flags['reload']: logger.info("SIGHUP: recarregando o conf."); flags['reload'] = False; reload_conf = True; got_event = True
+				now = time.monotonic()
+				if got_event:
+					first_event = first_event or now
+					deadline = min(now + debounce, first_event + self.DAEMON_MAX_DELAY)
+				if first_event is not None and now >= deadline:
+					batch, reload_batch = pending, reload_conf
+					pending = set(); reload_conf = False; first_event = deadline = None
+					try: self._daemon_process(batch, reload_batch)
+					except Exception as e: logger.error(f"Erro ao processar eventos: {e}", exc_info=True)
+		finally:
+			signal.set_wakeup_fd(-1); os.close(wake_r); os.close(wake_w)
+			link_sock.close(); watcher.close(); rtnl.close()
+		logger.info("Daemon QoS terminado (configuracao tc mantida).")
+		return True
+
+	# --- Autorate (--autorate) ---
+	def _autorate_targets(self, iface_cfg):
+		# Por direcao com autorate: dispositivo, hierarquias e classes filhas cujo rate/ceil configurado e limitado pelo novo total
+		targets = []
+		for direction, bounds in iface_cfg['autorate']['directions'].items():
+			dev = iface_cfg['name'] if direction == 'upload' else self._download_target(iface_cfg)
+			default_class = iface_cfg.get(f'default_{direction}_class')
+			if not dev or not default_class: continue
+			trees = self._shaping_trees(dev, direction, iface_cfg['name'] if direction == 'download' and iface_cfg.get('lan') else None); children = []
+			for tree in trees:
+				children.append((self._tree_classid(default_class['id'], tree), self._tree_rate(default_class['rate'], tree), self._tree_rate(default_class['ceil'], tree), str(default_class.get('priority', 7)), tree))
+				for service in self.config.get('services', []):
+					if not isinstance(service, dict) or 'mark' not in service or not isinstance(service.get(direction), dict): continue
+					srv = self._resolve_service_class(dev, service, direction, tree)
+					if srv: children.append((srv['class_id'], srv['rate'], srv['ceil'], srv['priority'], tree))
+			base = min(max(iface_cfg[f'total_{direction}_bw'], bounds['min']), bounds['max'])
+			targets.append({'direction': direction, 'dev': dev, 'trees': trees, 'children': children, 'min': bounds['min'], 'max': bounds['max'], 'base': base, 'bytes': None, 'time': None})
+		return targets
+
+	def _autorate_probe(self, state):
+		# Sonda ICMP propria ou comando externo (QOS_IF_<KEY>_AUTORATE_PROBE_CMD) que escreve a RTT em ms no stdout
+		if state['probe'] is not None: return state['probe'].rtt_ms()
+		cmd = state['iface']['autorate']['probe_cmd']
+		try:
+			result = subprocess.run(shlex.split(cmd), capture_output=True, text=True, timeout=self.AUTORATE_PROBE_TIMEOUT * 5)
+			return float(result.stdout.split()[0]) if result.returncode == 0 and result.stdout.split() else None
+		except (OSError, ValueError, subprocess.SubprocessError) as e: logger.debug("Sonda '%s' falhou: %s", cmd, e); return None
+
+	def _autorate_next_rate(self, target, rate, achieved, bloat, loaded):
+		if bloat and loaded: new_rate = achieved * self.AUTORATE_DECREASE # fila no modem/ISP: descer abaixo do debito real
+		elif bloat: return rate # atraso causado pela outra direcao ou pelo ISP
+		elif rate and achieved / rate >= self.AUTORATE_HIGH_LOAD: new_rate = rate * self.AUTORATE_INCREASE
+		elif rate < target['base']: new_rate = min(rate * self.AUTORATE_INCREASE, target['base']) # sem carga: regressar devagar a banda configurada
+		elif rate > target['base']: new_rate = max(rate * self.AUTORATE_DECREASE, target['base'])
+		else: return rate
+		return int(min(max(new_rate, target['min']), target['max']))
+
+	def _autorate_commands(self, target, new_rate, live_classes):
+		# Alteracao no lugar: 'tc class change' da raiz de cada hierarquia e dos filhos cujo ceil/rate excede o novo total
+		dev = target['dev']; cmds = []
+		for tree in target['trees']:
+			tree_rate = self._tree_rate(new_rate, tree)
+			cmds.append(['tc', 'class', 'change', 'dev', dev, 'parent', f"{tree['major']}:", 'classid', f"{tree['major']}:1"] + self._htb_args(tree_rate, tree_rate, tree))
+		for class_id, rate, ceil, prio, tree in target['children']:
+			new_ceil = min(ceil, self._tree_rate(new_rate, tree)); new_class_rate = min(rate, new_ceil)
+			live = live_classes.get(self._classid_key(class_id))
+			if live and self._same_rate(live.get('htb_ceil'), new_ceil) and self._same_rate(live.get('htb_rate'), new_class_rate): continue
+			cmds.append(['tc', 'class', 'change', 'dev', dev, 'parent', f"{tree['major']}:1", 'classid', class_id] + self._htb_args(new_class_rate, new_ceil, tree, prio))
+		return cmds
+
+	def _autorate_tick(self, state, rtnl):
+		iface_cfg = state['iface']; settings = iface_cfg['autorate']
+		rtt = self._autorate_probe(state)
+		if rtt is not None:
+			alpha = self.AUTORATE_BASELINE_ALPHA[0] if state['baseline'] is None or rtt < state['baseline'] else self.AUTORATE_BASELINE_ALPHA[1]
+			state['baseline'] = rtt if state['baseline'] is None else state['baseline'] + alpha * (rtt - state['baseline'])
+		# Sonda perdida sob congestionamento conta como atraso; varias perdidas seguidas = refletor em baixo (taxas mantidas)
+		state['lost'] = 0 if rtt is not None else state['lost'] + 1
+		if state['lost'] > self.AUTORATE_MAX_LOST: logger.debug("Autorate %s: sem resposta da sonda (%d seguidas).", iface_cfg['name'], state['lost']); return
+		bloat = state['baseline'] is not None and (rtt is None or (rtt - state['baseline']) * 1000 > settings['threshold_us'])
+		try:
+			indexes = {target['dev']: rtnl.link_index(target['dev']) for target in state['targets']}
+			dump = rtnl.tc_stats([index for index in indexes.values() if index is not None], qdiscs=False)
+		except (OSError, RtnlError) as e: logger.warning(f"Autorate {iface_cfg['name']}: falha ao ler classes: {e}"); rtnl.close(); return
+		now = time.monotonic(); measures = []
+		for target in state['targets']:
+			index = indexes.get(target['dev'])
+			live_classes = {self._classid_key(c['handle']): c for c in dump[index]['classes']} if index is not None else {}
+			roots = [live_classes.get(self._classid_key(f"{tree['major']}:1")) for tree in target['trees']]
+			if not all(root and 'htb_rate' in root for root in roots): logger.debug("Autorate %s: hierarquia HTB ausente.", target['dev']); target['bytes'] = None; continue
+			# Debito medido no contador da(s) classe(s) raiz; a taxa atual vem do kernel (sobrevive a reconstrucoes pelo daemon)
+			live_rate = sum(root['htb_rate'] for root in roots); sent_bytes = sum(root.get('bytes', 0) for root in roots)
+			previous_bytes, previous_time = target['bytes'], target['time']; target['bytes'], target['time'] = sent_bytes, now
+			if previous_bytes is None or sent_bytes < previous_bytes or now <= previous_time or not live_rate: continue
+			measures.append((target, live_rate, (sent_bytes - previous_bytes) * 8 / (now - previous_time), live_classes))
+		# So a RTT e medida: o atraso e atribuido as direcoes com carga; se nenhuma passa AUTORATE_LOW_LOAD (taxa muito acima
+		# da capacidade real), a direcao com maior carga relativa, desde que acima do seu minimo
+		loaded = [m[0] for m in measures if m[2] >= m[1] * self.AUTORATE_LOW_LOAD]
+		if bloat and not loaded and measures:
+			heaviest = max(measures, key=lambda m: m[2] / m[1])
+			if heaviest[2] >= heaviest[0]['min']: loaded = [heaviest[0]]
+		commands = []
+		for target, live_rate, achieved, live_classes in measures:
+			new_rate = self._autorate_next_rate(target, live_rate, achieved, bloat, target in loaded)
+			logger.debug("Autorate %s (%s): rtt %sms base %sms debito %.0fkbit taxa %.0fkbit -> %.0fkbit", target['dev'], target['direction'], rtt if rtt is None else round(rtt, 1), state['baseline'] if state['baseline'] is None else round(state['baseline'], 1), achieved / 1000, live_rate / 1000, new_rate / 1000)
+			if abs(new_rate - live_rate) < live_rate * self.AUTORATE_MIN_CHANGE: continue
+			log = logger.info if new_rate < live_rate and bloat else logger.debug
+			log(f"Autorate {target['dev']} ({target['direction']}): {live_rate // 1000}kbit -> {new_rate // 1000}kbit" + ((" (sonda perdida sob carga)" if rtt is None else f" (atraso {rtt - state['baseline']:.1f}ms sob carga)") if bloat else ""))
+			commands += self._autorate_commands(target, new_rate, live_classes)
+		if not commands: return
+		self._begin_batch()
+		for cmd in commands: self._run_command(cmd, check=False, context=f"autorate {iface_cfg['name']} ({settings['source']})")
+		self._flush_batch(f"autorate {iface_cfg['name']}")
+
+	def autorate(self):
+		# Ciclo de controlo residente; a hierarquia tem de ter sido aplicada (--start/--daemon). Termina com SIGTERM/SIGINT.
+		if not self._parse_macros_from_foomuuri_conf(): logger.error("Falha ao ler configuração dos macros. Abortando."); return False
+		ifaces = [i for i in self._get_config_interfaces() if isinstance(i, dict) and i.get('autorate')]
+		if not ifaces: logger.error(f"Nenhuma interface com {self.IFACE_PREFIX}<KEY>_AUTORATE_UPLOAD_MIN/_DOWNLOAD_MIN definido."); return False
+		rtnl = RtnlBackend(); states = []
+		stop = threading.Event()
+		for signum in (signal.SIGTERM, signal.SIGINT): signal.signal(signum, lambda _signum, _frame: stop.set())
+		try:
+			for iface_cfg in ifaces:
+				settings = iface_cfg['autorate']
+				direct = 0x10000 if iface_cfg.get('topology') != 'mq' else None # handle 1: do HTB de upload
+				try: probe = None if settings['probe_cmd'] else IcmpProbe(settings['reflector'], iface_cfg['name'], self.AUTORATE_PROBE_TIMEOUT, direct)
+				except OSError as e: logger.error(f"Autorate {iface_cfg['name']}: sonda ICMP para {settings['reflector']} indisponivel: {e}"); continue
+				states.append({'iface': iface_cfg, 'probe': probe, 'baseline': None, 'lost': 0, 'targets': self._autorate_targets(iface_cfg), 'next': 0.0})
+				logger.info(f"Autorate {iface_cfg['name']}: " + ', '.join(f"{t['direction']} {t['min'] // 1000}-{t['max'] // 1000}kbit" for t in states[-1]['targets']) +
+							f", sonda {settings['probe_cmd'] or settings['reflector']}, a cada {settings['interval_us'] / 1000:.0f}ms, limiar {settings['threshold_us'] / 1000:.1f}ms.")
+			if not states: return False
+			while not stop.is_set():
+				for state in states:
+					if time.monotonic() < state['next']: continue
+					state['next'] = time.monotonic() + state['iface']['autorate']['interval_us'] / 10**6
+					self._autorate_tick(state, rtnl)
+				stop.wait(max(min(state['next'] for state in states) - time.monotonic(), 0))
+		finally:
+			for state in states:
+				if state['probe'] is not None: state['probe'].close()
+			rtnl.close()
+		logger.info("Autorate terminado (taxas atuais mantidas).")
+		return True
+
 def main():
 	parser = argparse.ArgumentParser(description="Motor de QoS para Foomuuri (Lendo Macros do .conf)")
 	parser.add_argument('--start', action='store_true', help="Aplica a configuração QoS")
 	parser.add_argument('--stop', action='store_true', help="Remove a configuração QoS")
-	parser.add_argument('--config-file', default="/etc/foomuuri/foomuuri.conf", help="Caminho para o ficheiro foomuuri.conf")
+	parser.add_argument('--reconcile', action='store_true', help="Com --start: le a hierarquia TC atual e aplica apenas as diferencas (sem teardown)")
+	parser.add_argument('--staged', action='store_true', help="Com --start/--daemon: hierarquias refeitas sem teardown previo; o download e construido numa IFB de staging e trocado com um unico 'tc filter replace', com rollback para a arvore anterior em caso de falha")
+	parser.add_argument('--config-file', default="/etc/foomuuri", help="Diretorio cujos *.conf sao lidos por ordem alfabetica, como o foomuuri le /etc/foomuuri (default), ou um unico ficheiro (ex: /etc/foomuuri/foomuuri.conf)")
+	parser.add_argument('--jobs', type=int, default=1, help="Numero de interfaces aplicadas em paralelo (cada par interface/IFB e independente)")
+	parser.add_argument('--plan-cache', default=QoSEngineMacroParserValidated.PLAN_CACHE_FILE, help="Cache da configuracao resolvida e do plano de comandos, indexado pelo hash do conf")
+	parser.add_argument('--live-plan', default=QoSEngineMacroParserValidated.LIVE_PLAN_FILE, help="Registo do plano atualmente ativo (restart sem alteracoes termina de imediato)")
+	parser.add_argument('--parse-cache', default=QoSEngineMacroParserValidated.PARSE_CACHE_FILE, help="Cache do tokenizer por ficheiro de conf (mtime/sha256): so os ficheiros alterados voltam a ser analisados")
+	parser.add_argument('--no-plan-cache', action='store_true', help="Ignora o cache e o registo do plano ativo: parsing, validacao e aplicacao completos")
+	parser.add_argument('--daemon', action='store_true', help="Aplica a configuracao e fica residente: reconstroi a interface afetada em eventos de link e recarrega o conf quando muda")
+	parser.add_argument('--debounce', type=float, default=QoSEngineMacroParserValidated.DAEMON_DEBOUNCE, help="Com --daemon: segundos de espera para agrupar eventos seguidos")
+	parser.add_argument('--autorate', action='store_true', help="Ciclo de controlo: ajusta a taxa das classes raiz pela latencia sob carga (macros QOS_IF_<KEY>_AUTORATE_*)")
+	parser.add_argument('--stats', action='store_true', help="Exporta os contadores das classes/qdiscs geridas (um dump rtnetlink por amostra)")
+	parser.add_argument('--export', choices=QoSEngineMacroParserValidated.STATS_FORMATS, help="Formato de --stats (implica --stats; por omissao prometheus)")
+	parser.add_argument('--output', default='-', help="Com --stats: ficheiro de saida, escrito de forma atomica (por omissao stdout)")
+	parser.add_argument('--interval', type=float, default=0, help="Com --stats: segundos entre amostras (0 = uma unica amostra, taxas face a execucao anterior)")
+	parser.add_argument('--state-file', default=QoSEngineMacroParserValidated.STATS_STATE_FILE, help="Com --stats: amostra anterior usada para calcular as taxas")
+	parser.add_argument('--apply-mode', choices=QoSEngineMacroParserValidated.APPLY_MODES, default='exec', help="exec: um processo tc/ip por comando; batch: um 'tc -batch'/'ip -batch' por interface; netlink: rtnetlink nativo, sem fork de tc/ip")
+	parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), help="Nivel de log (por omissao INFO; WARNING com --stats). DEBUG mostra o parsing macro a macro e cada comando")
+	parser.add_argument('--trace', help="Grava no fim da execucao um trace JSON (formato Chrome trace event) com a duracao de cada fase, interface e comando e o seu codigo de saida")
+	parser.add_argument('--profile', help="Perfila a execucao com cProfile e grava as estatisticas neste ficheiro (ler com 'python3 -m pstats')")
 	args = parser.parse_args()
-	if not args.start and not args.stop: parser.print_help(); sys.exit(1)
+	if args.export: args.stats = True
+	if args.log_level: logger.setLevel(args.log_level)
+	if args.stats:
+		# Leitura apenas: nao exige root; stdout fica reservado para as metricas e o parsing nao enche o log a cada amostra
+		if args.interval < 0: parser.error("--interval deve ser >= 0")
+		for handler in logging.getLogger().handlers:
+			if type(handler) is logging.StreamHandler: handler.setStream(sys.stderr)
+		logger.setLevel(args.log_level or logging.WARNING)
+		engine = QoSEngineMacroParserValidated(foomuuri_config_path=args.config_file)
+		try: sys.exit(0 if engine.stats(export_format=args.export or 'prometheus', output=args.output, interval=args.interval, state_file=args.state_file) else 1)
+		except Exception as e: logger.error(f"Erro fatal stats: {e}", exc_info=True); sys.exit(1)
+	if not args.start and not args.stop and not args.daemon and not args.autorate: parser.print_help(); sys.exit(1)
 	if os.geteuid() != 0: logger.error("Executar como root."); print("failed - run as root", file=sys.stderr); sys.exit(1)
-	engine = QoSEngineMacroParserValidated(foomuuri_config_path=args.config_file) # Nome da classe e argumento corrigidos
+	if args.jobs < 1: parser.error("--jobs deve ser >= 1")
+	if args.debounce < 0: parser.error("--debounce deve ser >= 0")
+	engine = QoSEngineMacroParserValidated(foomuuri_config_path=args.config_file, apply_mode=args.apply_mode, jobs=args.jobs, # Nome da classe e argumento corrigidos
+										   plan_cache=None if args.no_plan_cache else args.plan_cache, live_plan=None if args.no_plan_cache else args.live_plan,
+										   trace=Tracer() if args.trace else None, parse_cache=None if args.no_plan_cache else args.parse_cache, staged=args.staged)
+	profiler = None
+	if args.profile: import cProfile; profiler = cProfile.Profile()
 	success = False
 	try:
-		if args.start: success = engine.start()
-		elif args.stop: success = engine.stop()
+		if profiler: profiler.enable()
+		try:
+			if args.autorate: success = engine.autorate()
+			elif args.daemon: success = engine.daemon(debounce=args.debounce)
+			elif args.start: success = engine.start(reconcile=args.reconcile)
+			elif args.stop: success = engine.stop()
+		finally:
+			if profiler:
+				profiler.disable()
+				try: profiler.dump_stats(args.profile); logger.info(f"Perfil cProfile gravado em {args.profile}.")
+				except OSError as e: logger.error(f"Falha ao gravar o perfil em {args.profile}: {e}")
+			if engine.trace: engine.write_trace(args.trace)
 		if success: print("success"); sys.exit(0)
 		else: print("failed"); sys.exit(1)
 	except Exception as e: logger.error(f"Erro fatal main: {e}", exc_info=True); print(f"failed - {e}", file=sys.stderr); sys.exit(1)
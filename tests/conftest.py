@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Fixtures partilhadas: o motor carregado como no benchmark (log so com avisos e erros, em stderr) e os stand-ins de tc/ip/modprobe
+# de bench/apply_time.py, que so gravam os comandos em <work>/commands, com um /sys/class/net falso (eth0..ethN-1)
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_bench():
+	spec = importlib.util.spec_from_file_location('qos_bench_apply_time', ROOT / 'bench' / 'apply_time.py')
+	module = importlib.util.module_from_spec(spec); spec.loader.exec_module(module)
+	return module
+
+
+@pytest.fixture(scope='session')
+def bench():
+	return load_bench()
+
+
+@pytest.fixture(scope='session')
+def engine_module(bench):
+	return bench.load_engine(str(ROOT / 'qos_engine_macro.py'))
+
+
+@pytest.fixture
+def stand_ins(bench, engine_module, tmp_path, monkeypatch):
+	# make(work, conf_text, interfaces, **opcoes do motor) -> motor pronto a correr contra os stand-ins, com o conf em <work>/foomuuri.conf
+	bin_dir = tmp_path / 'bin'; bin_dir.mkdir()
+	for tool in ('tc', 'ip', 'modprobe'): (bin_dir / tool).write_text(bench.STAND_IN); (bin_dir / tool).chmod(0o755)
+	monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+	def make(work, conf_text, interfaces, **options):
+		work.mkdir(parents=True, exist_ok=True); monkeypatch.setenv('QOS_BENCH_DIR', str(work))
+		sys_dir = bench.reset_sysfs(str(work), interfaces)
+		conf = work / 'foomuuri.conf'; conf.write_text(conf_text)
+		engine = engine_module.QoSEngineMacroParserValidated(str(conf), **dict({'apply_mode': 'exec', 'plan_cache': None, 'live_plan': None}, **options))
+		engine.SYS_CLASS_NET = sys_dir
+		return engine
+	return make
+
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Autorate sob carga, em tres network namespaces: router (eth0, com a hierarquia do motor) -> modem (fila lenta e funda na saida:
+# netem rate/delay, ou tbf com latency onde o netem nao existe) -> refletor. Com o router a enviar acima da taxa do modem, a taxa da
+# 1:1 tem de descer para a do modem, sem sair de AUTORATE_UPLOAD_MIN/MAX e so com 'tc class change' (sem reconstruir a hierarquia).
+# Precisa de root, 'ip netns', dos modulos do conf e de sch_netem ou sch_tbf; QOS_TEST_ENGINE troca o comando do motor
+import json
+import os
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+ENGINE = shlex.split(os.environ.get('QOS_TEST_ENGINE', f"{sys.executable} {ROOT / 'qos_engine_macro.py'}"))
+# Modulo -> comando que so funciona com ele, num netns descartavel com a veth probe0/probe1 (pela ordem: o filtro precisa do ingress)
+PROBES = (('sch_htb', ['tc', 'qdisc', 'replace', 'dev', 'probe0', 'root', 'htb']), ('sch_ingress', ['tc', 'qdisc', 'add', 'dev', 'probe0', 'ingress']),
+		  ('cls_u32', ['tc', 'filter', 'add', 'dev', 'probe0', 'parent', 'ffff:', 'protocol', 'all', 'prio', '1', 'u32', 'match', 'u32', '0', '0']),
+		  ('act_mirred', ['tc', 'actions', 'add', 'action', 'mirred', 'egress', 'redirect', 'dev', 'probe1']), ('act_ctinfo', ['tc', 'actions', 'add', 'action', 'ctinfo', 'cpmark']),
+		  ('ifb', ['ip', 'link', 'add', 'probe2', 'type', 'ifb']))
+# Gargalo no modem, pela ordem de preferencia
+BOTTLENECKS = (('netem', ['netem', 'rate', '5mbit', 'delay', '10ms', 'limit', '100']), ('tbf', ['tbf', 'rate', '5mbit', 'burst', '6k', 'latency', '150ms']))
+LINK_RATE = 5000000
+MIN_RATE, MAX_RATE = 2000000, 20000000
+OFFERED_MBIT, LOAD_SECONDS = 15, 12
+
+CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"20Mbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"20Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"20Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"20Mbit"
+	QOS_IF_ETH0_AUTORATE_UPLOAD_MIN		"2Mbit"
+	QOS_IF_ETH0_AUTORATE_UPLOAD_MAX		"20Mbit"
+	QOS_IF_ETH0_AUTORATE_REFLECTOR		"10.2.0.2"
+	QOS_IF_ETH0_AUTORATE_INTERVAL		"200ms"
+	QOS_IF_ETH0_AUTORATE_THRESHOLD		"15ms"
+	QOS_SERVICE_LIST			"ssh"
+	QOS_SRV_ssh_MARK			"0x01"
+	QOS_SRV_ssh_UPLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_UPLOAD_RATE_DEFAULT		"1Mbit"
+	QOS_SRV_ssh_UPLOAD_CEIL_DEFAULT		"20Mbit"
+	QOS_SRV_ssh_DOWNLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_DOWNLOAD_RATE_DEFAULT	"1Mbit"
+	QOS_SRV_ssh_DOWNLOAD_CEIL_DEFAULT	"20Mbit"
+}
+"""
+# UDP a taxa fixa para o refletor (porta discard), a partir do router
+BLAST = """import socket, sys, time
+mbit, seconds = float(sys.argv[1]), float(sys.argv[2])
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); payload = b'x' * 1200; interval = len(payload) * 8 / (mbit * 1e6)
+started = time.monotonic(); sent = 0
+while time.monotonic() - started < seconds:
+	try: sock.sendto(payload, ('10.2.0.2', 9))
+	except OSError: pass
+	sent += 1; delay = started + sent * interval - time.monotonic()
+	if delay > 0: time.sleep(delay)
+"""
+
+
+def run(cmd, check=True):
+	return subprocess.run(cmd, check=check, capture_output=True, text=True).stdout
+
+
+def in_ns(netns, *cmds):
+	for cmd in cmds: run(['ip', 'netns', 'exec', netns] + cmd.split())
+
+
+def missing_modules():
+	netns = f"qos-test-probe-{os.getpid()}"
+	run(['ip', 'netns', 'add', netns])
+	try:
+		run(['ip', '-n', netns, 'link', 'add', 'probe0', 'type', 'veth', 'peer', 'name', 'probe1'])
+		missing = [module for module, cmd in PROBES if subprocess.run(['ip', 'netns', 'exec', netns] + cmd, capture_output=True).returncode != 0]
+		bottleneck = next((kind for kind, args in BOTTLENECKS if subprocess.run(['ip', 'netns', 'exec', netns, 'tc', 'qdisc', 'replace', 'dev', 'probe1', 'root'] + args, capture_output=True).returncode == 0), None)
+		return missing + ([] if bottleneck else ['sch_netem/sch_tbf']), bottleneck
+	finally:
+		run(['ip', 'netns', 'del', netns], check=False)
+
+
+@pytest.fixture
+def link():
+	# router -> modem (gargalo na saida m0) -> refletor; devolve (nome do router, gargalo usado)
+	missing, bottleneck = missing_modules()
+	if missing: pytest.skip(f"kernel sem {', '.join(missing)}")
+	router, modem, far = (f"qos-test-ar-{name}-{os.getpid()}" for name in ('router', 'modem', 'far'))
+	for netns in (router, modem, far): run(['ip', 'netns', 'add', netns])
+	try:
+		run(['ip', '-n', router, 'link', 'add', 'eth0', 'type', 'veth', 'peer', 'name', 'p0', 'netns', modem])
+		run(['ip', '-n', modem, 'link', 'add', 'm0', 'type', 'veth', 'peer', 'name', 'f0', 'netns', far])
+		in_ns(router, 'ip link set lo up', 'ip addr add 10.1.0.1/24 dev eth0', 'ip link set eth0 up', 'ip route add 10.2.0.0/24 via 10.1.0.2')
+		in_ns(modem, 'ip link set lo up', 'ip addr add 10.1.0.2/24 dev p0', 'ip link set p0 up', 'ip addr add 10.2.0.1/24 dev m0', 'ip link set m0 up', 'sysctl -qw net.ipv4.ip_forward=1')
+		in_ns(far, 'ip link set lo up', 'ip addr add 10.2.0.2/24 dev f0', 'ip link set f0 up', 'ip route add default via 10.2.0.1')
+		run(['ip', 'netns', 'exec', modem, 'tc', 'qdisc', 'add', 'dev', 'm0', 'root'] + dict(BOTTLENECKS)[bottleneck])
+		yield router, bottleneck
+	finally:
+		for netns in (router, modem, far): run(['ip', 'netns', 'del', netns], check=False)
+
+
+def root_rates(engine, netns):
+	classes = [engine._parse_tc_class_line(line) for line in run(['ip', 'netns', 'exec', netns, 'tc', 'class', 'show', 'dev', 'eth0']).splitlines()]
+	root = next(cls for cls in classes if cls and cls['classid'] == '1:1')
+	return engine._parse_rate_bps(root['rate']), engine._parse_rate_bps(root['ceil'])
+
+
+def qdiscs(netns):
+	# Contador da fila direta (onde segue a sonda), nao e configuracao
+	return sorted(re.sub(r' direct_packets_stat \d+', '', line) for line in run(['ip', 'netns', 'exec', netns, 'tc', 'qdisc', 'show', 'dev', 'eth0']).splitlines())
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="precisa de root (ip netns)")
+def test_autorate_follows_the_bottleneck(engine_module, link, tmp_path):
+	router, bottleneck = link
+	engine = engine_module.QoSEngineMacroParserValidated('/nonexistent', plan_cache=None, live_plan=None)
+	conf = tmp_path / 'foomuuri.conf'; conf.write_text(CONF); trace = tmp_path / 'trace.json'
+	result = subprocess.run(['ip', 'netns', 'exec', router] + ENGINE + ['--start', '--no-plan-cache', '--config-file', str(conf)], capture_output=True, text=True)
+	assert result.returncode == 0, result.stdout + result.stderr
+	assert root_rates(engine, router) == (MAX_RATE, MAX_RATE)
+	tree = qdiscs(router)
+	# Exec: cada comando emitido fica no trace com a linha completa
+	autorate = subprocess.Popen(['ip', 'netns', 'exec', router] + ENGINE + ['--autorate', '--no-plan-cache', '--apply-mode', 'exec', '--config-file', str(conf), '--trace', str(trace)],
+								stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+	samples = []
+	try:
+		# Linha de base da RTT sem carga, depois o router envia ao triplo da taxa do modem
+		time.sleep(1.5)
+		blast = subprocess.Popen(['ip', 'netns', 'exec', router, sys.executable, '-c', BLAST, str(OFFERED_MBIT), str(LOAD_SECONDS)])
+		while blast.poll() is None: samples.append(root_rates(engine, router)); time.sleep(0.25)
+	finally:
+		autorate.send_signal(signal.SIGTERM); output = autorate.communicate(timeout=30)[0]
+	assert autorate.returncode == 0, output
+	rates = [rate for rate, _ceil in samples]
+	# A 1:1 desce ate a taxa do modem (a fila so esvazia abaixo dela) e nunca sai dos limites configurados
+	assert min(rates) <= LINK_RATE, f"{bottleneck}: {rates}"
+	assert all(MIN_RATE <= rate <= MAX_RATE and rate == ceil for rate, ceil in samples), f"{bottleneck}: {samples}"
+	# No fim da carga oscila em torno da taxa do modem (sobe 5% por ciclo ate a fila voltar a crescer)
+	tail = rates[-len(rates) // 4:]
+	assert LINK_RATE / 2 <= sum(tail) / len(tail) <= LINK_RATE * 1.5, f"{bottleneck}: {rates}"
+	# So alteracoes no lugar: nenhum outro comando, e os qdiscs sao os mesmos
+	commands = [event['args']['cmd'] for event in json.loads(trace.read_text())['traceEvents'] if event['cat'] == 'cmd']
+	assert commands and all(cmd.startswith('tc class change dev eth0 ') for cmd in commands), commands
+	assert qdiscs(router) == tree
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Modo batch: os erros de 'tc/ip -force -batch -' ("Command failed -:N", precedido das mensagens do kernel) sao atribuidos a linha N
+# do segmento certo; so uma falha fatal invalida o batch, e um batch abortado sem linha e repetido comando a comando
+import logging
+import subprocess
+
+import pytest
+
+
+class FakeRun:
+	# subprocess.run do motor: um resultado (returncode, stderr) por chamada, pela ordem, com o check do subprocess; os argumentos ficam gravados
+	def __init__(self, results):
+		self.results = list(results); self.calls = []
+
+	def __call__(self, cmd, input=None, check=False, **kwargs):
+		self.calls.append((cmd, input))
+		returncode, stderr = self.results.pop(0) if self.results else (0, '')
+		if check and returncode: raise subprocess.CalledProcessError(returncode, cmd, '', stderr)
+		return subprocess.CompletedProcess(cmd, returncode, '', stderr)
+
+
+@pytest.fixture
+def batch(engine_module, monkeypatch):
+	def make(*results):
+		run = FakeRun(results); monkeypatch.setattr(engine_module.subprocess, 'run', run)
+		engine = engine_module.QoSEngineMacroParserValidated('/nonexistent', apply_mode='batch', plan_cache=None, live_plan=None)
+		engine._begin_batch()
+		return engine, run
+	return make
+
+
+def queue(engine):
+	engine._run_command(['tc', 'qdisc', 'add', 'dev', 'eth0', 'root', 'handle', '1:', 'htb'])
+	engine._run_command(['tc', 'class', 'add', 'dev', 'eth0', 'parent', '1:', 'classid', '1:1', 'htb', 'rate', '1mbit'])
+	engine._run_command(['tc', 'class', 'replace', 'dev', 'eth0', 'parent', '1:1', 'classid', '1:10', 'htb', 'rate', '1kbit'], context="servico 'ssh'")
+	engine._run_command(['tc', 'qdisc', 'del', 'dev', 'eth0', 'ingress'], check=False, failure_ok=True)
+
+
+def errors(caplog):
+	return [record.getMessage() for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_clean_batch_is_one_process(batch):
+	engine, run = batch((0, ''))
+	queue(engine)
+	assert engine._flush_batch('eth0')
+	assert [cmd for cmd, _input in run.calls] == [['tc', '-force', '-batch', '-']]
+	assert run.calls[0][1].splitlines()[1] == "class add dev eth0 parent 1: classid 1:1 htb rate 1mbit"
+
+
+@pytest.mark.parametrize('stderr, ok, logged', [
+	# Linha 2 (classe raiz, sem contexto): fatal
+	("RTNETLINK answers: Invalid argument\nCommand failed -:2\n", False, ["Falha no comando tc class add dev eth0 parent 1: classid 1:1 htb rate 1mbit (batch tc 'eth0' linha 2): RTNETLINK answers: Invalid argument"]),
+	# Linha 3 (classe de servico): registada com o contexto, mas a interface continua valida
+	("RTNETLINK answers: No such file or directory\nCommand failed -:3\n", True, ["Falha no comando tc class replace dev eth0 parent 1:1 classid 1:10 htb rate 1kbit [servico 'ssh'] (batch tc 'eth0' linha 3): RTNETLINK answers: No such file or directory"]),
+	# Linha 4 marcada failure_ok, e 'File exists' num add: ignoradas
+	("RTNETLINK answers: Invalid argument\nCommand failed -:4\n", True, []),
+	("RTNETLINK answers: File exists\nCommand failed -:1\n", True, []),
+])
+def test_failed_line_maps_to_its_command(batch, caplog, stderr, ok, logged):
+	engine, run = batch((1, stderr))
+	queue(engine)
+	assert engine._flush_batch('eth0') is ok
+	assert errors(caplog) == logged and len(run.calls) == 1
+
+
+def test_lines_are_counted_per_segment(batch, caplog):
+	# tc, ip, tc: tres processos; a linha 1 do segundo segmento tc e o seu primeiro comando, nao o primeiro do batch
+	engine, run = batch((0, ''), (0, ''), (1, "Error: Specified class not found.\nCommand failed -:1\n"))
+	engine._run_command(['tc', 'qdisc', 'add', 'dev', 'ifb0', 'root', 'handle', '1:', 'htb'])
+	engine._run_command(['ip', 'link', 'set', 'dev', 'ifb0', 'up'])
+	engine._run_command(['tc', 'filter', 'add', 'dev', 'ifb0', 'parent', '1:', 'u32', 'match', 'u32', '0', '0', 'flowid', '1:30'])
+	assert not engine._flush_batch('ifb0')
+	assert [cmd[0] for cmd, _input in run.calls] == ['tc', 'ip', 'tc']
+	assert errors(caplog) == ["Falha no comando tc filter add dev ifb0 parent 1: u32 match u32 0 0 flowid 1:30 (batch tc 'ifb0' linha 1): Error: Specified class not found."]
+
+
+def test_line_outside_segment_is_replayed(batch, caplog):
+	# Sem uma linha do segmento a que atribuir a falha, os comandos voltam a correr sozinhos: aqui todos passam
+	engine, run = batch((1, "Command failed -:9\n"))
+	queue(engine)
+	assert engine._flush_batch('eth0')
+	assert errors(caplog) == ["Batch tc 'eth0' falhou na linha 9 (fora do plano): "] and len(run.calls) == 5
+
+
+def test_aborted_batch_is_replayed_command_by_command(batch, caplog):
+	# Erro de sintaxe: o tc sai com -1 (255) sem dizer a linha; cada comando volta a correr sozinho para localizar a falha
+	engine, run = batch((255, "Command line is not complete. Try option \"help\"\n"), (0, ''), (2, "Error: invalid rate\n"), (0, ''), (0, ''))
+	queue(engine)
+	assert not engine._flush_batch('eth0')
+	assert errors(caplog) == ["Falha no comando tc class add dev eth0 parent 1: classid 1:1 htb rate 1mbit: Error: invalid rate"]
+	assert run.calls[0][0] == ['tc', '-force', '-batch', '-'] and [cmd[:3] for cmd, _input in run.calls[1:]] == [['tc', 'qdisc', 'add'], ['tc', 'class', 'add'], ['tc', 'class', 'replace'], ['tc', 'qdisc', 'del']]
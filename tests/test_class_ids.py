@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Atribuicao dos minors das classes dos servicos (_allocate_class_ids): sufixos manuais primeiro, colisoes com a classe raiz, as classes
+# default e os blocos por host, os 'auto' com o mesmo minor nas duas direcoes, o limite MAX_MINOR e a expansao de QOS_TPL_*_MARKS
+import pytest
+
+TEMPLATE_CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"10Gbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"10Gbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"10Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"10Mbit"
+	QOS_SERVICE_LIST			"ssh"
+	QOS_SRV_ssh_MARK			"0x01"
+	QOS_SRV_ssh_UPLOAD_SUFFIX		"100"
+	QOS_SRV_ssh_UPLOAD_RATE_DEFAULT		"1Mbit"
+	QOS_SRV_ssh_UPLOAD_CEIL_DEFAULT		"5Mbit"
+	QOS_SRV_ssh_DOWNLOAD_SUFFIX		"5"
+	QOS_SRV_ssh_DOWNLOAD_RATE_DEFAULT	"1Mbit"
+	QOS_SRV_ssh_DOWNLOAD_CEIL_DEFAULT	"5Mbit"
+	QOS_TEMPLATE_LIST			"tenant"
+	QOS_TPL_tenant_MARKS			"0x1000-0x1002 0x2000"
+	QOS_TPL_tenant_UPLOAD_RATE_DEFAULT	"1kbit"
+	QOS_TPL_tenant_UPLOAD_CEIL_DEFAULT	"5Mbit"
+	QOS_TPL_tenant_DOWNLOAD_RATE_DEFAULT	"4kbit"
+	QOS_TPL_tenant_DOWNLOAD_CEIL_DEFAULT	"20Mbit"
+	QOS_SRV_tenant_1001_DOWNLOAD_CEIL_DEFAULT	"40Mbit"
+}
+"""
+
+
+@pytest.fixture
+def engine(engine_module):
+	engine = engine_module.QoSEngineMacroParserValidated('/nonexistent', plan_cache=None, live_plan=None)
+	engine.config['interfaces'] = [{'name': 'eth0', 'default_upload_class': {'id': '1:30'}, 'default_download_class': {'id': '1:30'}}]
+	return engine
+
+
+def service(name, upload=None, download=None, **extra):
+	srv = dict(name=name, **extra)
+	for direction, suffix in (('upload', upload), ('download', download)):
+		if suffix is not None: srv[direction] = {'class_id_suffix': suffix}
+	return srv
+
+
+def suffixes(services):
+	return {srv['name']: tuple(srv.get(d, {}).get('class_id_suffix') for d in ('upload', 'download')) for srv in services}
+
+
+def test_manual_suffixes_first_then_auto_in_both_directions(engine):
+	services = [service('a', 'auto', 'auto'), service('b', '100', '101'), service('c', 'auto', None)]
+	# 0x100 esta ocupado no upload e 0x101 no download: o primeiro minor livre nas duas direcoes e 0x102
+	assert suffixes(engine._allocate_class_ids(services, {})) == {'a': ('102', '102'), 'b': ('100', '101'), 'c': ('103', None)}
+
+
+@pytest.mark.parametrize('upload, download, kept', [
+	('1', '10', (None, '10')),    # classe raiz N:1
+	('30', '10', (None, '10')),   # classe default de eth0
+	('0', '0', None),             # qdisc: sem nenhuma direcao o servico e ignorado
+	('10000', '10', (None, '10')),  # acima de MAX_MINOR
+])
+def test_manual_suffix_collisions_drop_the_direction(engine, upload, download, kept):
+	result = suffixes(engine._allocate_class_ids([service('a', upload, download)], {}))
+	assert result == ({} if kept is None else {'a': kept})
+
+
+def test_manual_suffix_collision_between_services(engine):
+	services = [service('a', '20', '20'), service('b', '20', '21')]
+	assert suffixes(engine._allocate_class_ids(services, {})) == {'a': ('20', '20'), 'b': (None, '21')}
+
+
+def test_per_host_blocks(engine):
+	# O bloco 500-5ff fica reservado para as subclasses por host de 'a'; um servico por host nao pode ficar com um minor cujo bloco ja
+	# tem classes (0x1 e a raiz, 0x2 e livre; 0x30 e a default)
+	services = [service('a', '5', '5', per_host={}), service('b', '510', '6'), service('c', 'auto', 'auto', per_host={}), service('d', '300', '300'), service('e', 'auto', 'auto', per_host={})]
+	result = suffixes(engine._allocate_class_ids(services, {}))
+	assert result['a'] == ('5', '5') and result['b'] == (None, '6') and result['c'] == ('2', '2')
+	# 0x3 tem 0x300 no seu bloco, 0x4 e livre
+	assert result['e'] == ('4', '4')
+
+
+def test_auto_per_host_skips_defaults_and_manual_minors(engine):
+	services = [service('m', '2', '3')] + [service(f"p{i}", 'auto', 'auto', per_host={}) for i in range(3)]
+	assert [s for name, s in suffixes(engine._allocate_class_ids(services, {})).items() if name != 'm'] == [('4', '4'), ('5', '5'), ('6', '6')]
+
+
+def test_class_base_and_max_minor(engine, engine_module):
+	max_minor = engine_module.QoSEngineMacroParserValidated.MAX_MINOR
+	services = [service(f"t{i}", 'auto', 'auto', template='tenant') for i in range(3)] + [service('x', 'auto', 'auto')]
+	result = suffixes(engine._allocate_class_ids(services, {'tenant': max_minor - 1}))
+	# Dois minors livres a partir do CLASS_BASE: o terceiro servico do template fica sem classes; o sem template comeca em 0x100
+	assert result == {'t0': (f"{max_minor - 1:x}", f"{max_minor - 1:x}"), 't1': (f"{max_minor:x}", f"{max_minor:x}"), 'x': ('100', '100')}
+
+
+@pytest.mark.parametrize('value, marks', [
+	("0x10-0x12 0x20", [0x10, 0x11, 0x12, 0x20]),
+	("0x5", [0x5]),
+	("0x10-0x12 # comentario 0x30", [0x10, 0x11, 0x12]),
+	("0x12-0x10", None),
+	("10-12", None),
+	("0x10-zz", None),
+	("0x0-0xffff", None),
+])
+def test_template_mark_ranges(engine, value, marks):
+	assert engine._parse_mark_ranges(value, 'QOS_TPL_tenant_MARKS') == marks
+
+
+def test_template_marks_expand_to_services(stand_ins, tmp_path):
+	engine = stand_ins(tmp_path / 'work', TEMPLATE_CONF, 1)
+	assert engine._parse_macros_from_foomuuri_conf()
+	services = {srv['name']: srv for srv in engine.config['services']}
+	assert list(services) == ['ssh', 'tenant_1000', 'tenant_1001', 'tenant_1002', 'tenant_2000']
+	assert [services[f"tenant_{mark}"]['mark'] for mark in ('1000', '1001', '1002', '2000')] == [0x1000, 0x1001, 0x1002, 0x2000]
+	# ssh usa 0x100 no upload: os 'auto' comecam no primeiro minor livre nas duas direcoes
+	assert suffixes(services.values()) == {'ssh': ('100', '5'), 'tenant_1000': ('101', '101'), 'tenant_1001': ('102', '102'), 'tenant_1002': ('103', '103'), 'tenant_2000': ('104', '104')}
+	assert services['tenant_1001']['download']['ceil'] == 40000000 and services['tenant_1000']['download']['ceil'] == 20000000
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Equivalencia dos classificadores: para cada interface e direcao, a tabela marca -> flowid que a cadeia u32 produz de facto
+# (prio crescente, na mesma prio a ordem de insercao; a primeira regra que casa ganha) tem de ser igual a tabela handle -> flowid
+# que o classificador fw instala. Corre o motor contra os stand-ins de tc/ip/modprobe do benchmark (so gravam os comandos)
+import shlex
+
+INTERFACES = 2
+
+# Casos de risco: a mesma marca em duas prios (upload: a prio mais baixa ganha mesmo vindo depois na lista), empate na mesma prio
+# (download: ganha o primeiro servico da lista), um servico com a marca default 0xff (prio 10 antes do filtro default na prio 20)
+# e um servico depois do default (prio 25)
+SERVICES = (('first', '0x10', '100', {'UPLOAD_FILTER_PRIO_DEFAULT': '12'}),
+			('second', '0x10', '101', {'UPLOAD_FILTER_PRIO_DEFAULT': '5'}),
+			('bulk', '0xff', '102', {}),
+			('late', '0x20', '103', {'UPLOAD_FILTER_PRIO_DEFAULT': '25', 'DOWNLOAD_FILTER_PRIO_DEFAULT': '25'}),
+			('plain', '0x30', '104', {}))
+EXPECTED = {'upload': {0x10: '1:101', 0xff: '1:102', 0x20: '1:103', 0x30: '1:104'},
+			'download': {0x10: '1:100', 0xff: '1:102', 0x20: '1:103', 0x30: '1:104'}}
+
+
+def conf_text(classifier):
+	lines = ["macro {"]
+	for i in range(INTERFACES):
+		key = f"ETH{i}"
+		lines += [f'\tQOS_IF_{key}_NAME\t"eth{i}"', f'\tQOS_IF_{key}_IFB\t"ifb{i}"', f'\tQOS_IF_{key}_CLASSIFIER\t"{classifier}"',
+				  f'\tQOS_IF_{key}_TOTAL_UPLOAD_BW\t"100Mbit"', f'\tQOS_IF_{key}_TOTAL_DOWNLOAD_BW\t"100Mbit"']
+		for direction in ('UPLOAD', 'DOWNLOAD'):
+			lines += [f'\tQOS_IF_{key}_DEFAULT_{direction}_ID\t"1:30"', f'\tQOS_IF_{key}_DEFAULT_{direction}_RATE\t"1Mbit"', f'\tQOS_IF_{key}_DEFAULT_{direction}_CEIL\t"100Mbit"']
+	lines.append('\tQOS_SERVICE_LIST\t"' + ' '.join(name for name, _mark, _suffix, _extra in SERVICES) + '"')
+	for name, mark, suffix, extra in SERVICES:
+		prefix = f"\tQOS_SRV_{name}_"
+		lines += [f'{prefix}MARK\t"{mark}"', f'{prefix}PRIORITY\t"3"']
+		for direction in ('UPLOAD', 'DOWNLOAD'):
+			lines += [f'{prefix}{direction}_SUFFIX\t"{suffix}"', f'{prefix}{direction}_RATE_DEFAULT\t"1Mbit"', f'{prefix}{direction}_CEIL_DEFAULT\t"50Mbit"']
+		lines += [f'{prefix}{field}\t"{value}"' for field, value in extra.items()]
+	lines.append("}")
+	return '\n'.join(lines) + '\n'
+
+
+def recorded_filters(commands):
+	# Filtros de marca da raiz de cada dispositivo, pela ordem em que foram emitidos
+	filters = []
+	for line in commands.splitlines():
+		tokens = shlex.split(line)
+		if tokens[:2] != ['tc', 'filter'] or tokens[2] not in ('add', 'replace'): continue
+		args = dict(zip(tokens[3:], tokens[4:]))
+		if not args.get('parent', '').endswith(':'): continue
+		if 'fw' in tokens: filters.append({'dev': args['dev'], 'kind': 'fw', 'prio': int(args['prio']), 'mark': int(args['handle'], 16), 'flowid': args['flowid']})
+		elif 'mark' in tokens: filters.append({'dev': args['dev'], 'kind': 'u32', 'prio': int(args['prio']), 'mark': int(args['mark'], 16), 'flowid': args['flowid']})
+	return filters
+
+
+def effective_u32(filters):
+	# Sort estavel: na mesma prio fica a ordem de insercao (o replace sem handle acrescenta um no no fim da prio)
+	effective = {}
+	for entry in sorted((f for f in filters if f['kind'] == 'u32'), key=lambda f: f['prio']):
+		effective.setdefault(entry['dev'], {}).setdefault(entry['mark'], entry['flowid'])
+	return effective
+
+
+def installed_fw(filters):
+	# Mesmo handle repetido: o replace sobrepoe, fica o ultimo
+	installed = {}
+	for entry in (f for f in filters if f['kind'] == 'fw'): installed.setdefault(entry['dev'], {})[entry['mark']] = entry['flowid']
+	return installed
+
+
+def apply(stand_ins, work, classifier):
+	engine = stand_ins(work, conf_text(classifier), INTERFACES)
+	assert engine.start()
+	return recorded_filters((work / 'commands').read_text())
+
+
+def test_fw_matches_effective_u32(stand_ins, tmp_path):
+	u32 = apply(stand_ins, tmp_path / 'u32', 'u32'); fw = apply(stand_ins, tmp_path / 'fw', 'fw')
+	effective = effective_u32(u32); installed = installed_fw(fw)
+	devices = {f"eth{i}" for i in range(INTERFACES)} | {f"ifb{i}" for i in range(INTERFACES)}
+	assert set(effective) == devices and set(installed) == devices
+	for dev in sorted(devices):
+		direction = 'upload' if dev.startswith('eth') else 'download'
+		assert installed[dev] == effective[dev], dev
+		assert effective[dev] == EXPECTED[direction], dev
+	# fw: uma unica prio por dispositivo, sem filtros u32 de marca
+	assert {f['prio'] for f in fw} == {1} and not [f for f in fw if f['kind'] == 'u32']
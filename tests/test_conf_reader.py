@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Leitura do conf do foomuuri (FoomuuriConfReader): o tokenizer (blocos aninhados, aspas, ';', '\', avisos com a linha), um diretorio
+# lido como o foomuuri le /etc/foomuuri e a reutilizacao por ficheiro do resultado do parsing (stat, depois sha256 do conteudo)
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def reader(engine_module):
+	return engine_module.FoomuuriConfReader()
+
+
+def parse(reader, text):
+	return reader.parse(text.splitlines())
+
+
+def test_nested_block_does_not_close_macro(reader):
+	result = parse(reader, 'macro {\n\tA "1"\n\tsub {\n\t\tB "2"\n\t}\n\tC "3"\n}\nD "4"\n')
+	# B e de um bloco aninhado e D esta fora de qualquer bloco: so os macros do topo de 'macro' sao guardados
+	assert result == {'macros': [['A', '1', 2], ['C', '3', 6]], 'snat': [], 'warnings': []}
+
+
+@pytest.mark.parametrize('line, value', [
+	('A "x # y"  # comentario', 'x # y'),
+	("A 'a#b'", 'a#b'),
+	('A "{ ; }"', '{ ; }'),
+	('A ssh http  # sem aspas, todas as palavras', 'ssh http'),
+	('A x; y', 'x ; y'),
+	('A "a"; "b"', 'a ; b'),
+])
+def test_values(reader, line, value):
+	assert parse(reader, f"macro {{\n\t{line}\n}}\n")['macros'] == [['A', value, 2]]
+
+
+def test_line_continuation_keeps_first_line(reader):
+	result = parse(reader, 'macro {\n\tA one \\\n\t\ttwo \\\n\t\tthree\n\tB "x"\n}\n')
+	assert result['macros'] == [['A', 'one two three', 2], ['B', 'x', 5]] and not result['warnings']
+
+
+def test_brace_on_content_line(reader):
+	assert parse(reader, 'macro { A "1"; B "2" }\nmacro {\n\tC "3" }\n')['macros'] == [['A', '1 ; B 2', 1], ['C', '3', 3]]
+
+
+def test_unterminated_quote(reader):
+	result = parse(reader, 'macro {\n\tA "abc\n\tB "2"\n}\n')
+	assert result['macros'] == [['A', 'abc', 2], ['B', '2', 3]] and result['warnings'] == [[2, "aspas sem fecho"]]
+
+
+def test_stray_and_unclosed_braces(reader):
+	assert parse(reader, 'macro {\n\tA "1"\n}\n}\nmacro {\n\tB "2"\n}\n') == {'macros': [['A', '1', 2], ['B', '2', 6]], 'snat': [], 'warnings': [[4, "'}' sem bloco aberto"]]}
+	assert parse(reader, 'macro {\n\tA "1"\nzone {\n')['warnings'] == [[3, "bloco 'zone' sem fecho no fim do ficheiro"]]
+
+
+def test_snat_rules(reader):
+	result = parse(reader, 'snat {\n\tsaddr 10.0.0.0/8 oifname eth0 masquerade; saddr 192.168.0.0/16\n\t\toifname eth1\n}\n')
+	assert result['snat'] == [[['saddr', '10.0.0.0/8', 'oifname', 'eth0', 'masquerade'], 2], [['saddr', '192.168.0.0/16'], 2], [['oifname', 'eth1'], 3]]
+
+
+def test_directory_last_definition_wins(reader, tmp_path):
+	(tmp_path / '10-base.conf').write_text('macro {\n\tQOS_A "1"\n\tQOS_B "1"\n}\n')
+	(tmp_path / '20-override.conf').write_text('# tenants\nmacro {\n\tQOS_A "2"\n}\nsnat {\n\tsaddr 10.0.0.0/8 oifname eth0\n}\n')
+	(tmp_path / '.hidden.conf').write_text('macro {\n\tQOS_A "3"\n}\n')
+	(tmp_path / '30-notes.txt').write_text('macro {\n\tQOS_A "4"\n}\n')
+	index, snat = reader.load(tmp_path)
+	assert index == {'QOS_A': {'value': '2', 'file': str(tmp_path / '20-override.conf'), 'line': 3}, 'QOS_B': {'value': '1', 'file': str(tmp_path / '10-base.conf'), 'line': 3}}
+	assert snat == [{'tokens': ['saddr', '10.0.0.0/8', 'oifname', 'eth0'], 'file': str(tmp_path / '20-override.conf'), 'line': 6}]
+	assert reader.stats == {'parsed': 2, 'reused': 0}
+
+
+def age(path, seconds):
+	# mtime no passado (fora de MTIME_GRACE_NS): um stat igual basta para reutilizar o ficheiro
+	mtime = time.time_ns() - seconds * 10**9; os.utime(path, ns=(mtime, mtime))
+
+
+def test_file_entry_reuses_unchanged_file(reader, tmp_path, monkeypatch):
+	conf = tmp_path / 'qos.conf'; conf.write_text('macro {\n\tQOS_A "1"\n}\n'); age(conf, 3600)
+	first = reader._file_entry(conf); reader.dirty = False
+	monkeypatch.setattr(reader, 'parse', lambda lines: pytest.fail("ficheiro inalterado analisado de novo"))
+	monkeypatch.setattr(type(conf), 'read_bytes', lambda path: pytest.fail("ficheiro inalterado lido de novo"))
+	assert reader._file_entry(conf) is first and reader.stats == {'parsed': 1, 'reused': 1} and not reader.dirty
+
+
+def test_file_entry_rehashes_on_mtime_change(reader, tmp_path, monkeypatch):
+	conf = tmp_path / 'qos.conf'; conf.write_text('macro {\n\tQOS_A "1"\n}\n'); age(conf, 3600)
+	first = reader._file_entry(conf)
+	# So o mtime mudou (ex. touch): o conteudo e comparado pelo sha256 e o resultado anterior mantem-se, sem novo parsing
+	age(conf, 1800); parse_calls = []
+	monkeypatch.setattr(reader, 'parse', lambda lines: parse_calls.append(lines))
+	entry = reader._file_entry(conf)
+	assert entry is first and entry['stat'][0] == conf.stat().st_mtime_ns and not parse_calls and reader.stats == {'parsed': 1, 'reused': 1}
+	monkeypatch.undo()
+	conf.write_text('macro {\n\tQOS_A "2"\n}\n'); age(conf, 60)
+	assert reader._file_entry(conf)['macros'] == [['QOS_A', '2', 2]] and reader.stats == {'parsed': 2, 'reused': 1}
+
+
+def test_file_entry_rehashes_recent_mtime(reader, tmp_path, monkeypatch):
+	# Um mtime dentro de MTIME_GRACE_NS da ultima verificacao pode esconder uma escrita no mesmo tick: o ficheiro volta a ser lido
+	conf = tmp_path / 'qos.conf'; conf.write_text('macro {\n\tQOS_A "1"\n}\n')
+	reader._file_entry(conf); reads = []
+	read_bytes = type(conf).read_bytes
+	monkeypatch.setattr(type(conf), 'read_bytes', lambda path: reads.append(path) or read_bytes(path))
+	reader._file_entry(conf)
+	assert reads == [conf] and reader.stats == {'parsed': 1, 'reused': 1}
+
+
+def test_default_config_is_the_foomuuri_directory(engine_module):
+	# Como o foomuuri: todos os *.conf de /etc/foomuuri, nao so o foomuuri.conf
+	assert str(engine_module.QoSEngineMacroParserValidated(plan_cache=None, live_plan=None).foomuuri_config_path) == '/etc/foomuuri'
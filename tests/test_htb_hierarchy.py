@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Parametros HTB (burst, cburst, quantum, r2q), validacao da hierarquia antes de qualquer qdisc (soma das taxas e ceil face a banda
+# total, com override por interface) e o ID hexadecimal da classe default. O conf e lido pelo motor; o start corre contra os stand-ins
+import pytest
+
+BASE = {'QOS_IF_ETH0_NAME': 'eth0', 'QOS_IF_ETH0_IFB': 'ifb0', 'QOS_IF_ETH0_TOTAL_UPLOAD_BW': '10Mbit', 'QOS_IF_ETH0_TOTAL_DOWNLOAD_BW': '20Mbit',
+		'QOS_SERVICE_LIST': 'ssh web'}
+for _direction in ('UPLOAD', 'DOWNLOAD'):
+	BASE.update({f'QOS_IF_ETH0_DEFAULT_{_direction}_ID': '1:30', f'QOS_IF_ETH0_DEFAULT_{_direction}_RATE': '1Mbit', f'QOS_IF_ETH0_DEFAULT_{_direction}_CEIL': '5Mbit'})
+	for _name, _mark, _suffix in (('ssh', '0x01', '10'), ('web', '0x02', '20')):
+		BASE.update({f'QOS_SRV_{_name}_MARK': _mark, f'QOS_SRV_{_name}_PRIORITY': '1', f'QOS_SRV_{_name}_{_direction}_SUFFIX': _suffix,
+					 f'QOS_SRV_{_name}_{_direction}_RATE_DEFAULT': '2Mbit', f'QOS_SRV_{_name}_{_direction}_CEIL_DEFAULT': '8Mbit'})
+# Arvore sem filas: MTU da Ethernet com cabecalho (1514) e r2q 10
+ROOT = {'major': '1', 'parent': 'root', 'queues': 1}
+
+
+def conf_text(**macros):
+	return "macro {\n" + ''.join(f'\t{name}\t"{value}"\n' for name, value in dict(BASE, **macros).items()) + "}\n"
+
+
+def parsed(stand_ins, tmp_path, **macros):
+	engine = stand_ins(tmp_path / 'work', conf_text(**macros), 1)
+	assert engine._parse_macros_from_foomuuri_conf()
+	return engine
+
+
+@pytest.mark.parametrize('rate, ceil, tree, prio, expected', [
+	# burst/cburst: o que a taxa envia num tick de 1 ms, mais um pacote; quantum: rate / 8 / r2q, entre o MTU e 200000
+	(8000000, 16000000, ROOT, None, ['htb', 'rate', '8000000bit', 'ceil', '16000000bit', 'burst', '2514b', 'cburst', '3514b', 'quantum', '100000']),
+	(8000, 1000000, ROOT, 3, ['htb', 'rate', '8000bit', 'ceil', '1000000bit', 'prio', '3', 'burst', '1515b', 'cburst', '1639b', 'quantum', '1514']),
+	(10000000000, 10000000000, ROOT, None, ['htb', 'rate', '10000000000bit', 'ceil', '10000000000bit', 'burst', '1251514b', 'cburst', '1251514b', 'quantum', '200000']),
+	(1000000, 1000000, dict(ROOT, mtu=9014, r2q=1), None, ['htb', 'rate', '1000000bit', 'ceil', '1000000bit', 'burst', '9139b', 'cburst', '9139b', 'quantum', '125000']),
+])
+def test_htb_args(engine_module, rate, ceil, tree, prio, expected):
+	engine = engine_module.QoSEngineMacroParserValidated('/nonexistent', plan_cache=None, live_plan=None)
+	assert engine._htb_args(rate, ceil, tree, prio) == expected
+
+
+@pytest.mark.parametrize('macros, queues, expected', [
+	# r2q: a classe folha mais lenta (1Mbit, a default) ainda tem quantum >= MTU; com filas, a taxa de cada uma e dividida
+	({}, 1, 1000000 // 8 // 1514),
+	({}, 2, 1000000 // 2 // 8 // 1514),
+	({'QOS_SRV_ssh_UPLOAD_RATE_DEFAULT': '8kbit'}, 1, 1),
+])
+def test_htb_r2q(stand_ins, tmp_path, macros, queues, expected):
+	assert parsed(stand_ins, tmp_path, **macros)._htb_r2q('eth0', 'upload', queues, 1514) == expected
+
+
+@pytest.mark.parametrize('macros, valid', [
+	({}, True),
+	# Soma das taxas garantidas (1 + 2 + 8 Mbit) acima da banda total 1:1 do upload (10Mbit)
+	({'QOS_SRV_web_UPLOAD_RATE_DEFAULT': '8Mbit'}, False),
+	# Ceil de uma classe acima da banda total
+	({'QOS_SRV_ssh_UPLOAD_CEIL_DEFAULT': '11Mbit'}, False),
+	({'QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL': '25Mbit'}, False),
+	# Rate acima do ceil
+	({'QOS_SRV_ssh_DOWNLOAD_RATE_DEFAULT': '9Mbit'}, False),
+	# Override por interface (rate e ceil, um so nao conta): ultrapassa so no upload de eth0, ou corrige um default que nao cabe em eth0
+	({'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_RATE': '8Mbit', 'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_CEIL': '8Mbit'}, False),
+	({'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_RATE': '2Mbit', 'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_CEIL': '12Mbit'}, False),
+	({'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_RATE': '8Mbit'}, True),
+	({'QOS_SRV_web_UPLOAD_CEIL_DEFAULT': '15Mbit', 'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_RATE': '2Mbit', 'QOS_SRV_web_OVERRIDE_ETH0_UPLOAD_CEIL': '10Mbit'}, True),
+	({'QOS_SRV_web_DOWNLOAD_RATE_DEFAULT': '20Mbit', 'QOS_SRV_web_DOWNLOAD_CEIL_DEFAULT': '20Mbit', 'QOS_SRV_web_OVERRIDE_IFB0_DOWNLOAD_RATE': '4Mbit',
+	  'QOS_SRV_web_OVERRIDE_IFB0_DOWNLOAD_CEIL': '20Mbit'}, True),
+])
+def test_validate_hierarchy(stand_ins, tmp_path, macros, valid):
+	assert parsed(stand_ins, tmp_path, **macros)._validate_hierarchy() is valid
+
+
+def test_hex_default_minor(stand_ins, tmp_path):
+	engine = stand_ins(tmp_path / 'work', conf_text(QOS_IF_ETH0_DEFAULT_UPLOAD_ID='1:3a'), 1)
+	assert engine.start()
+	commands = (tmp_path / 'work' / 'commands').read_text().splitlines()
+	assert "tc qdisc add dev eth0 root handle 1: htb default 3a r2q 82" in commands
+	assert [command for command in commands if command.startswith("tc class add dev eth0 parent 1:1 classid 1:3a htb ")]
+
+
+@pytest.mark.parametrize('default_id', ['1:xyz', '1:12345', '1:', '1:3a:0'])
+def test_invalid_default_id_rejected_at_load(stand_ins, tmp_path, default_id):
+	engine = stand_ins(tmp_path / 'work', conf_text(QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID=default_id), 1)
+	engine._parse_macros_from_foomuuri_conf()
+	assert not engine.config.get('interfaces')
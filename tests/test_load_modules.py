@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Modulos do kernel carregados antes da aplicacao (_load_modules): so os das funcionalidades configuradas, lidos dos 'modprobe' que
+# chegam aos stand-ins
+import pytest
+
+CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_CLASSIFIER			"%(classifier)s"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"10Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"10Mbit"
+	QOS_SERVICE_LIST			"web"
+	QOS_SRV_web_MARK			"0x02"
+	QOS_SRV_web_UPLOAD_SUFFIX		"20"
+	QOS_SRV_web_UPLOAD_RATE_DEFAULT		"2Mbit"
+	QOS_SRV_web_UPLOAD_CEIL_DEFAULT		"8Mbit"
+	QOS_SRV_web_DOWNLOAD_SUFFIX		"20"
+	QOS_SRV_web_DOWNLOAD_RATE_DEFAULT	"2Mbit"
+	QOS_SRV_web_DOWNLOAD_CEIL_DEFAULT	"8Mbit"
+%(extra)s}
+%(snat)s"""
+PER_HOST = '\tQOS_SRV_web_PER_HOST_SUBNET\t"192.168.100.0/29"\n'
+SNAT = "snat {\n\tsaddr 192.168.100.0/24 oifname eth0 masquerade\n}\n"
+IFB = ['ifb', 'sch_ingress', 'act_mirred', 'sch_htb', 'act_ctinfo']
+
+
+@pytest.mark.parametrize('classifier, extra, snat, expected', [
+	('u32', '', '', IFB + ['cls_u32']),
+	# O redirect para a IFB e um filtro u32 tambem com o classificador fw
+	('fw', '', '', IFB + ['cls_u32', 'cls_fw']),
+	('u32', PER_HOST, '', IFB + ['cls_u32']),
+	# Por host com SNAT no upload: os hosts sao distinguidos pelo cls_flow
+	('u32', PER_HOST, SNAT, IFB + ['cls_u32', 'cls_flow']),
+	('u32', '\tQOS_IF_ETH0_TOPOLOGY\t"mq"\n\tQOS_IF_ETH0_DEFAULT_LEAF_QDISC\t"fq_codel"\n', '', IFB + ['cls_u32', 'sch_mq', 'sch_fq_codel']),
+])
+def test_modules_for_configured_features(stand_ins, tmp_path, classifier, extra, snat, expected):
+	engine = stand_ins(tmp_path / 'work', CONF % {'classifier': classifier, 'extra': extra, 'snat': snat}, 1)
+	assert engine._parse_macros_from_foomuuri_conf()
+	engine._load_modules()
+	assert [line.split()[1] for line in (tmp_path / 'work' / 'commands').read_text().splitlines() if line.startswith('modprobe ')] == expected
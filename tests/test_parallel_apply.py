@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# Aplicacao paralela (--jobs): cada worker devolve as suas IFBs geridas e os planos gravados, juntados pela thread principal a medida que terminam; o resultado
+# tem de ser o mesmo da aplicacao em serie. Corre contra os stand-ins de tc/ip/modprobe do benchmark
+INTERFACES = 3
+
+
+def test_parallel_results_match_serial(bench, engine_module, stand_ins, tmp_path, monkeypatch):
+	conf_text, _macros = bench.synthetic_conf(INTERFACES, 6, 'u32')
+	serial = stand_ins(tmp_path / 'serial', conf_text, INTERFACES)
+	assert serial.start()
+	parallel = stand_ins(tmp_path / 'parallel', conf_text, INTERFACES, jobs=INTERFACES)
+	seen = []
+	setup_iface = engine_module.QoSEngineMacroParserValidated._setup_iface
+	def spy(self, iface_cfg):
+		# Cada worker escreve nos seus dicionarios; a sua interface so chega aos do motor principal na juncao do seu resultado
+		ok = setup_iface(self, iface_cfg); name = iface_cfg['name']
+		seen.append((self is not parallel, self.managed_ifbs is not parallel.managed_ifbs, self.iface_plans is not parallel.iface_plans, name in self.managed_ifbs and name not in parallel.managed_ifbs))
+		return ok
+	monkeypatch.setattr(engine_module.QoSEngineMacroParserValidated, '_setup_iface', spy)
+	assert parallel.start()
+	assert len(seen) == INTERFACES and all(worker and own_ifbs and own_plans and private for worker, own_ifbs, own_plans, private in seen)
+	expected = {f"eth{i}": f"ifb{i}" for i in range(INTERFACES)}
+	assert serial.managed_ifbs == parallel.managed_ifbs == expected
+	assert serial.iface_results == parallel.iface_results == {name: True for name in expected}
+	assert set(parallel.iface_plans) == set(expected) and parallel.iface_plans == serial.iface_plans
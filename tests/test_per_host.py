@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Equidade por host (_per_host_plan): subclasses pelo ultimo octeto sob a classe do servico e a cadeia de filtros da propria classe,
+# hash u32 pelo octeto, cls_flow pela origem no conntrack no upload com SNAT, sem plano no download pelo IFB com SNAT
+import pytest
+
+CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"10Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"10Mbit"
+	QOS_SERVICE_LIST			"web"
+	QOS_SRV_web_MARK			"0x02"
+	QOS_SRV_web_UPLOAD_SUFFIX		"20"
+	QOS_SRV_web_UPLOAD_RATE_DEFAULT		"7Mbit"
+	QOS_SRV_web_UPLOAD_CEIL_DEFAULT		"50Mbit"
+	QOS_SRV_web_DOWNLOAD_SUFFIX		"20"
+	QOS_SRV_web_DOWNLOAD_RATE_DEFAULT	"7Mbit"
+	QOS_SRV_web_DOWNLOAD_CEIL_DEFAULT	"50Mbit"
+	QOS_SRV_web_PER_HOST_SUBNET		"192.168.100.0/29"
+%s}
+%s"""
+SNAT = "snat {\n\tsaddr 192.168.100.0/24 oifname eth0 masquerade\n}\n"
+LAN = '\tQOS_DOWNLOAD_MODE\t"lan"\n\tQOS_LAN_IFACE\t"eth1"\n\tQOS_LAN_WAN_MARK_MASK\t"0xff00"\n\tQOS_IF_ETH0_LAN_MARK\t"0x100"\n'
+HOSTS = range(1, 7)
+
+
+@pytest.fixture
+def plan(stand_ins, tmp_path):
+	# plan(dev, direction, extra, snat) -> plano por host do servico web, com a arvore que o setup usaria
+	def make(dev, direction, extra='', snat=''):
+		engine = stand_ins(tmp_path / 'work', CONF % (extra, snat), 2)
+		assert engine._parse_macros_from_foomuuri_conf() and engine._validate_hierarchy()
+		if_cfg = engine.config['interfaces'][0]; service = engine.config['services'][0]
+		tree = engine._lan_tree(if_cfg) if dev == 'eth1' else None
+		return engine._per_host_plan(dev, service, direction, engine._resolve_service_class(dev, service, direction, tree), tree)
+	return make
+
+
+@pytest.mark.parametrize('dev, direction, offset', [('eth0', 'upload', '12'), ('ifb0', 'download', '16')])
+def test_u32_hash_on_last_octet(plan, dev, direction, offset):
+	hosts = plan(dev, direction)
+	# Octeto 0: trafego do servico fora da subrede; a taxa do servico e dividida por hosts + 1
+	assert (hosts['mode'], hosts['hosts'], hosts['rate'], hosts['ceil'], hosts['prio'], hosts['ht']) == ('u32', 6, 1000000, 50000000, 132, '920:')
+	assert list(hosts['classes']) == ['1:2000'] + [f"1:200{octet}" for octet in HOSTS]
+	assert hosts['classes']['1:2003']['parent'] == '1:20' and hosts['classes']['1:2003']['address'] == '192.168.100.3' and hosts['classes']['1:2000']['address'] == ''
+	table, *buckets, link, catch_all = hosts['filters']
+	assert table == ('add', ['protocol', 'ip', 'prio', '132', 'handle', '920:', 'u32', 'divisor', '256'])
+	assert buckets[0] == ('replace', ['protocol', 'ip', 'prio', '132', 'handle', '920:1:800', 'u32', 'ht', '920:1:', 'match', 'u32', '0', '0', 'flowid', '1:2001']) and len(buckets) == 6
+	assert link == ('add', ['protocol', 'ip', 'prio', '132', 'u32', 'match', 'u32', '0xc0a86400', '0xfffffff8', 'at', offset, 'hashkey', 'mask', '0x000000ff', 'at', offset, 'link', '920:'])
+	assert catch_all == ('add', ['protocol', 'ip', 'prio', '132', 'u32', 'match', 'u32', '0', '0', 'flowid', '1:2000'])
+
+
+def test_upload_with_snat_uses_conntrack_source(plan):
+	hosts = plan('eth0', 'upload', snat=SNAT)
+	assert (hosts['mode'], hosts['baseclass'], len(hosts['classes'])) == ('flow', '1:2000', 7) and 'ht' not in hosts
+	assert hosts['filters'] == [('add', ['protocol', 'ip', 'prio', '132', 'flow', 'map', 'key', 'nfct-src', 'and', '0xff', 'baseclass', '1:2000'])]
+
+
+def test_download_with_snat_on_ifb_has_no_plan(plan):
+	# No IFB o destino ainda e o endereco WAN: nao ha host a distinguir
+	assert plan('ifb0', 'download', snat=SNAT) is None
+
+
+def test_lan_egress_download_with_snat(plan):
+	# Na saida da LAN o destino ja e o host: u32 pelo octeto mesmo com SNAT, na subarvore 2: da WAN
+	hosts = plan('eth1', 'download', extra=LAN, snat=SNAT)
+	assert hosts['mode'] == 'u32' and list(hosts['classes'])[1] == '2:2001' and hosts['classes']['2:2001']['parent'] == '2:20'
+	assert hosts['filters'][-1] == ('add', ['protocol', 'ip', 'prio', '132', 'u32', 'match', 'u32', '0', '0', 'flowid', '2:2000'])
+
+
+def test_explicit_host_limits(plan):
+	hosts = plan('eth0', 'upload', extra='\tQOS_SRV_web_PER_HOST_UPLOAD_RATE\t"500Kbit"\n\tQOS_SRV_web_PER_HOST_UPLOAD_CEIL\t"5Mbit"\n')
+	assert (hosts['rate'], hosts['ceil']) == (500000, 5000000) and hosts['classes']['1:2001']['rate'] == 500000
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Cache do plano compilado (--plan-cache) e registo do plano ativo (--live-plan): cada start corre num motor novo, como um novo
+# processo. Conf inalterado e ja ativo nao toca no tc; conf inalterado com o registo perdido reexecuta os planos gravados; conf ou
+# ambiente alterados voltam ao parsing e ao setup completos
+import pytest
+
+CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"10Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"10Mbit"
+	QOS_SERVICE_LIST			"ssh"
+	QOS_SRV_ssh_MARK			"0x01"
+	QOS_SRV_ssh_UPLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_UPLOAD_RATE_DEFAULT		"%s"
+	QOS_SRV_ssh_UPLOAD_CEIL_DEFAULT		"5Mbit"
+	QOS_SRV_ssh_DOWNLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_DOWNLOAD_RATE_DEFAULT	"1Mbit"
+	QOS_SRV_ssh_DOWNLOAD_CEIL_DEFAULT	"5Mbit"
+}
+"""
+
+
+@pytest.fixture
+def restart(stand_ins, tmp_path, monkeypatch):
+	# restart(rate, signature) -> (ok, motor, comandos, fases chamadas); a assinatura do estado tc e fixa (sem dump rtnetlink)
+	work = tmp_path / 'work'
+	def run(rate='1Mbit', signature='tree'):
+		engine = stand_ins(work, CONF % rate, 1, plan_cache=str(tmp_path / 'plan.json'), live_plan=str(tmp_path / 'live.json'))
+		monkeypatch.setattr(engine, '_live_signature', lambda devices: {dev: signature for dev in devices})
+		calls = []
+		for name in ('_parse_macros_from_foomuuri_conf', '_setup_iface', '_replay_iface_plan'):
+			method = getattr(engine, name)
+			monkeypatch.setattr(engine, name, lambda *args, name=name, method=method: calls.append(name) or method(*args))
+		ok = engine.start()
+		return ok, engine, [line for line in (work / 'commands').read_text().splitlines() if not line.startswith('modprobe ')], calls
+	return run
+
+
+def test_unchanged_and_live_is_a_no_op(restart, tmp_path):
+	ok, first, commands, calls = restart()
+	assert ok and commands and calls == ['_parse_macros_from_foomuuri_conf', '_setup_iface']
+	assert (tmp_path / 'plan.json').exists() and (tmp_path / 'live.json').exists()
+	ok, engine, commands, calls = restart()
+	# Nenhum comando e nenhum parsing: a configuracao vem do cache para quem usa o motor depois do start (--daemon)
+	assert ok and commands == [] and calls == [] and engine.config == first.config
+
+
+def test_lost_live_record_replays_the_cached_plan(restart, tmp_path):
+	_ok, _engine, built, _calls = restart()
+	(tmp_path / 'live.json').unlink()
+	ok, _engine, commands, calls = restart()
+	# Sem parsing nem validacao; os comandos reexecutados sao os do setup gravado
+	assert ok and calls == ['_replay_iface_plan'] and commands == built
+	assert (tmp_path / 'live.json').exists()
+
+
+def test_changed_tc_state_replays_the_cached_plan(restart):
+	restart()
+	ok, _engine, commands, calls = restart(signature='changed')
+	assert ok and calls == ['_replay_iface_plan'] and commands
+
+
+def test_changed_conf_is_a_miss(restart, tmp_path):
+	_ok, _engine, built, _calls = restart()
+	cached = (tmp_path / 'plan.json').read_text()
+	ok, _engine, commands, calls = restart(rate='2Mbit')
+	assert ok and calls == ['_parse_macros_from_foomuuri_conf', '_setup_iface'] and commands != built
+	assert (tmp_path / 'plan.json').read_text() != cached
+	# O plano novo passa a ser o ativo
+	assert restart(rate='2Mbit')[3] == []
+
+
+def test_changed_environment_rebuilds_from_the_cached_config(restart, engine_module, monkeypatch):
+	restart()
+	# MTU diferente muda os bursts: a configuracao resolvida serve, os comandos gravados nao
+	monkeypatch.setattr(engine_module.QoSEngineMacroParserValidated, '_link_mtu', lambda self, name: 9000)
+	ok, _engine, commands, calls = restart()
+	assert ok and calls == ['_setup_iface'] and commands
+
+
+def test_stop_forgets_the_live_plan(restart, tmp_path):
+	_ok, engine, _commands, _calls = restart()
+	engine.stop()
+	assert not (tmp_path / 'live.json').exists() and (tmp_path / 'plan.json').exists()
+	assert restart()[3] == ['_replay_iface_plan']
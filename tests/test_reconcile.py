@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Reconcile (--reconcile): leitura do estado em uso a partir do texto do tc e diferenca para a hierarquia desejada. Um estado igual ao
+# desejado nao gera comandos; cada diferenca gera so a operacao in-place que a corrige (change/replace/del), sem reconstruir a arvore
+import pytest
+
+CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"10Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"10Mbit"
+	QOS_SERVICE_LIST			"ssh web"
+	QOS_SRV_ssh_MARK			"0x01"
+	QOS_SRV_ssh_UPLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_UPLOAD_RATE_DEFAULT		"1Mbit"
+	QOS_SRV_ssh_UPLOAD_CEIL_DEFAULT		"5Mbit"
+	QOS_SRV_web_MARK			"0x02"
+	QOS_SRV_web_UPLOAD_SUFFIX		"20"
+	QOS_SRV_web_UPLOAD_RATE_DEFAULT		"2Mbit"
+	QOS_SRV_web_UPLOAD_CEIL_DEFAULT		"8Mbit"
+}
+"""
+CLASS_LINE = "class htb 1:10 parent 1:1 leaf 8012: prio 1 rate 1Mbit ceil 5Mbit burst 1639b cburst 2139b"
+FILTERS = """filter parent 1: protocol ip pref 10 u32 chain 0
+filter parent 1: protocol ip pref 10 u32 chain 0 fh 800: ht divisor 1
+filter parent 1: protocol ip pref 10 u32 chain 0 fh 800::800 order 2048 key ht 800 bkt 0 flowid 1:10 not_in_hw
+  mark 0x1 0xffffffff (rule hit 0 success 0)
+filter parent 1: protocol ip pref 5 fw chain 0
+filter parent 1: protocol ip pref 5 fw chain 0 handle 0x2 classid 1:20
+"""
+INGRESS = """filter parent ffff: protocol all pref 1 u32 chain 0
+filter parent ffff: protocol all pref 1 u32 chain 0 fh 800::800 order 2048 key ht 800 bkt 0 terminal flowid not_in_hw
+  match 00000000/00000000 at 0
+	action order 1: ctinfo zone 0 pipe
+	action order 2: mirred (Egress Redirect to device ifb0) stolen
+"""
+TREE = {'major': '1', 'parent': 'root', 'queues': 1}
+
+
+@pytest.fixture
+def engine(stand_ins, tmp_path):
+	engine = stand_ins(tmp_path / 'work', CONF, 1)
+	assert engine._parse_macros_from_foomuuri_conf()
+	return engine
+
+
+def desired(engine):
+	if_cfg = engine.config['interfaces'][0]
+	return engine._desired_shaping('eth0', if_cfg['total_upload_bw'], if_cfg['default_upload_class'], 'upload')
+
+
+def live_from(want):
+	# Estado em uso igual ao desejado, na forma devolvida por _read_live_tc
+	live = {'root': None, 'ingress': False, 'children': [], 'leaves': {}, 'classes': {}, 'filters': [], 'ingress_filters': []}
+	for classid, cls in want['classes'].items():
+		args = cls['htb_args']
+		live['classes'][classid] = {'kind': 'htb', 'classid': classid, 'parent': cls['parent'], 'prio': int(cls['prio']), 'rate': f"{cls['rate']}bit", 'ceil': f"{cls['ceil']}bit",
+									'burst': args[args.index('burst') + 1], 'cburst': args[args.index('cburst') + 1]}
+	for n, flt in enumerate(want['filters']):
+		live['filters'].append({'kind': flt['kind'], 'pref': flt['prio'], 'parent': '1:', 'protocol': 'ip', 'handle': f"800::{0x800 + n:x}", 'flowid': flt['flowid'], 'mark': flt['mark'],
+								'mark_mask': 0xffffffff, 'redirect': None})
+	return live
+
+
+def reconcile(engine, live, want, monkeypatch):
+	commands = []
+	monkeypatch.setattr(engine, '_run_command', lambda cmd, **kwargs: commands.append(' '.join(cmd)) or True)
+	changes = engine._reconcile_tree('eth0', live, want, TREE)
+	assert changes == len(commands)
+	return commands
+
+
+def test_parse_class_line(engine):
+	assert engine._parse_tc_class_line(CLASS_LINE) == {'kind': 'htb', 'classid': '1:10', 'parent': '1:1', 'leaf': '8012:', 'prio': 1, 'rate': '1Mbit', 'ceil': '5Mbit', 'burst': '1639b', 'cburst': '2139b'}
+	assert engine._parse_tc_class_line("qdisc htb 1: root") is None
+
+
+def test_parse_filter_output(engine):
+	# Linhas de cabecalho (sem handle de no) nao sao regras; a marca vem da linha seguinte no u32 e do handle no fw
+	u32, fw = engine._parse_tc_filter_output(FILTERS)
+	assert (u32['kind'], u32['pref'], u32['handle'], u32['flowid'], u32['mark'], u32['mark_mask']) == ('u32', 10, '800::800', '1:10', 0x1, 0xffffffff)
+	assert (fw['kind'], fw['pref'], fw['handle'], fw['flowid'], fw['mark']) == ('fw', 5, '0x2', '1:20', 0x2)
+	[redirect] = engine._parse_tc_filter_output(INGRESS)
+	assert redirect['pref'] == 1 and redirect['redirect'] == 'ifb0'
+
+
+def test_same_state_makes_no_changes(engine, monkeypatch):
+	want = desired(engine)
+	assert reconcile(engine, live_from(want), want, monkeypatch) == []
+
+
+def test_rounded_live_values_are_equal(engine, monkeypatch):
+	# O tc mostra taxas em unidades e bursts arredondados: dentro da granularidade do kernel nao e uma alteracao
+	want = desired(engine); live = live_from(want)
+	live['classes']['1:10'].update(rate='1Mbit', ceil='5Mbit', burst='1639b')
+	assert reconcile(engine, live, want, monkeypatch) == []
+
+
+def test_changed_class_is_changed_in_place(engine, monkeypatch):
+	want = desired(engine); live = live_from(want)
+	live['classes']['1:20'].update(rate='3Mbit', prio=4)
+	assert reconcile(engine, live, want, monkeypatch) == ["tc class change dev eth0 parent 1:1 classid 1:20 " + ' '.join(want['classes']['1:20']['htb_args'])]
+
+
+def test_missing_and_obsolete_objects(engine, monkeypatch):
+	want = desired(engine); live = live_from(want)
+	# Classe do servico ssh em falta (com o seu filtro), uma classe e uma prio de filtros que ja nao estao no conf
+	del live['classes']['1:10']; live['filters'] = [f for f in live['filters'] if f['flowid'] != '1:10']
+	live['classes']['1:40'] = dict(live['classes']['1:20'], classid='1:40')
+	live['filters'].append({'kind': 'u32', 'pref': 12, 'parent': '1:', 'protocol': 'ip', 'handle': '801::800', 'flowid': '1:40', 'mark': 0x4, 'mark_mask': 0xffffffff, 'redirect': None})
+	assert reconcile(engine, live, want, monkeypatch) == [
+		"tc class add dev eth0 parent 1:1 classid 1:10 " + ' '.join(want['classes']['1:10']['htb_args']),
+		"tc filter add dev eth0 parent 1: protocol ip prio 10 u32 match mark 0x1 0xffffffff flowid 1:10",
+		"tc filter del dev eth0 parent 1: protocol ip prio 12",
+		"tc class del dev eth0 classid 1:40"]
+
+
+def test_filter_pointing_elsewhere_is_replaced_by_handle(engine, monkeypatch):
+	want = desired(engine); live = live_from(want)
+	web = next(f for f in live['filters'] if f['mark'] == 0x2); web['flowid'] = '1:30'
+	assert reconcile(engine, live, want, monkeypatch) == [f"tc filter replace dev eth0 parent 1: protocol ip prio 10 handle {web['handle']} u32 match mark 0x2 0xffffffff flowid 1:20"]
+
+
+def test_classifier_change_removes_the_old_prio(engine, monkeypatch):
+	# u32 -> fw: os filtros u32 da mesma prio sao removidos de uma vez antes de instalar os fw
+	want = desired(engine); live = live_from(want)
+	engine.config['interfaces'][0]['classifier'] = 'fw'; fw_want = desired(engine)
+	for flt in live['filters']: flt['pref'] = fw_want['filters'][0]['prio']
+	commands = reconcile(engine, live, fw_want, monkeypatch)
+	assert commands[0] == f"tc filter del dev eth0 parent 1: protocol ip prio {fw_want['filters'][0]['prio']}"
+	assert commands[1:] == [f"tc filter add dev eth0 parent 1: protocol ip prio {f['prio']} handle {hex(f['mark'])} fw flowid {f['flowid']}" for f in fw_want['filters']]
+
+
+@pytest.mark.parametrize('default, wanted, ok', [('0x30', '30', True), ('30', '30', True), ('0x30', '3a', False), (None, '30', False)])
+def test_structure_check_compares_default_class(engine, default, wanted, ok):
+	# Classe default diferente nao tem operacao in-place: o reconcile reconstroi a hierarquia
+	qdisc = {'kind': 'htb', 'handle': '1:', 'root': True, 'options': {} if default is None else {'default': default}}
+	assert engine._htb_qdisc_ok(qdisc, '1:', None, wanted) is ok
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Modo staged (--staged) contra os stand-ins de tc/ip/modprobe do benchmark: a troca de IFB em duplo buffer, a arvore anterior mantida
+# quando a hierarquia nova falha, e a IFB de staging (<ifb>-stg) so limpa pelo stop quando sobrou de uma troca interrompida.
+# O filtro de redirect do ingress e lido com 'tc filter show', que os stand-ins nao simulam: o teste fixa a IFB em uso
+STAGING = 'ifb0-stg'
+
+
+def redirect(iface, ifb):
+	return f"tc filter replace dev {iface} parent ffff: protocol all prio 1 handle 800::800 u32 match u32 0 0 action ctinfo cpmark action mirred egress redirect dev {ifb}"
+
+
+def staged_engine(bench, stand_ins, work):
+	conf_text, _macros = bench.synthetic_conf(1, 2, 'u32')
+	engine = stand_ins(work, conf_text, 1, staged=True)
+	(work / 'sys' / 'ifb0' / 'queues' / 'tx-0').mkdir(parents=True)
+	engine._ingress_redirect_target = lambda iface: 'ifb0'
+	return engine
+
+
+def test_staged_swap_moves_traffic_through_staging_ifb(bench, stand_ins, tmp_path):
+	engine = staged_engine(bench, stand_ins, tmp_path / 'work')
+	assert engine.start()
+	commands = (tmp_path / 'work' / 'commands').read_text().splitlines()
+	to_staging, back = commands.index(redirect('eth0', STAGING)), commands.index(redirect('eth0', 'ifb0'))
+	# A IFB definitiva so e refeita depois de o trafego estar na de staging, ja completa; a de staging sai no fim
+	assert commands.index(f"ip link add {STAGING} type ifb") < commands.index(f"tc filter replace dev {STAGING} parent 1: protocol ip prio 20 u32 match mark 0xff 0xffffffff flowid 1:30") < to_staging
+	assert all(not command.startswith('tc ') or ' dev ifb0 ' not in command for command in commands[:to_staging])
+	assert to_staging < commands.index("tc qdisc add dev ifb0 root handle 1: htb default 30 r2q 1") < back
+	assert commands[-1] == f"ip link del dev {STAGING}" and not engine._staging_ifbs
+
+
+def test_staged_failure_keeps_previous_tree(bench, stand_ins, tmp_path, monkeypatch):
+	engine = staged_engine(bench, stand_ins, tmp_path / 'work')
+	apply_shaping = engine._apply_shaping
+	monkeypatch.setattr(engine, '_apply_shaping', lambda dev, *args: dev != STAGING and apply_shaping(dev, *args))
+	assert not engine.start()
+	commands = (tmp_path / 'work' / 'commands').read_text().splitlines()
+	# Sem troca: o ingress continua a enviar para ifb0, intacta, e a IFB de staging incompleta e removida
+	assert not [command for command in commands if ' redirect ' in command]
+	assert not [command for command in commands if command.startswith('tc ') and ' dev ifb0 ' in command]
+	assert commands[-1] == f"ip link del dev {STAGING}" and engine.iface_results == {'eth0': False}
+
+
+def test_rollback_without_snapshot_fails(bench, stand_ins, tmp_path):
+	engine = staged_engine(bench, stand_ins, tmp_path / 'work')
+	assert not engine._rollback_shaping('eth0', None, None)
+	assert not (tmp_path / 'work' / 'commands').read_text()
+
+
+def test_stop_cleans_staging_ifb_only_when_left_over(bench, stand_ins, tmp_path):
+	conf_text, _macros = bench.synthetic_conf(1, 2, 'u32')
+	engine = stand_ins(tmp_path / 'work', conf_text, 1); commands = tmp_path / 'work' / 'commands'
+	assert engine.start() and engine.stop()
+	assert STAGING not in commands.read_text()
+	(tmp_path / 'work' / 'sys' / STAGING).mkdir(); commands.write_text('')
+	assert engine.stop()
+	assert f"ip link del dev {STAGING}" in commands.read_text().splitlines() and not (tmp_path / 'work' / 'sys' / STAGING).exists()
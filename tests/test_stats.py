@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Estatisticas (--stats): etiquetas de cada classe pela resolucao usada ao aplicar, amostra a partir do dump rtnetlink (aqui um dump
+# fixo), taxas entre duas amostras e a exposicao no formato de texto do Prometheus
+import pytest
+
+CONF = """macro {
+	QOS_IF_ETH0_NAME			"eth0"
+	QOS_IF_ETH0_IFB				"ifb0"
+	QOS_IF_ETH0_TOTAL_UPLOAD_BW		"100Mbit"
+	QOS_IF_ETH0_TOTAL_DOWNLOAD_BW		"200Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_RATE		"1Mbit"
+	QOS_IF_ETH0_DEFAULT_UPLOAD_CEIL		"10Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_ID		"1:30"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_RATE	"1Mbit"
+	QOS_IF_ETH0_DEFAULT_DOWNLOAD_CEIL	"10Mbit"
+	QOS_SERVICE_LIST			"ssh"
+	QOS_SRV_ssh_MARK			"0x01"
+	QOS_SRV_ssh_UPLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_UPLOAD_RATE_DEFAULT		"1Mbit"
+	QOS_SRV_ssh_UPLOAD_CEIL_DEFAULT		"5Mbit"
+	QOS_SRV_ssh_DOWNLOAD_SUFFIX		"10"
+	QOS_SRV_ssh_DOWNLOAD_RATE_DEFAULT	"3Mbit"
+	QOS_SRV_ssh_DOWNLOAD_CEIL_DEFAULT	"8Mbit"
+	QOS_SRV_ssh_PER_HOST_SUBNET		"192.168.1.0/30"
+}
+"""
+
+
+class FakeRtnl:
+	# Dump rtnetlink fixo: eth0 (ifindex 2) com a raiz, a default, a classe ssh e a folha desta; ifb0 ausente
+	def link_index(self, dev):
+		return {'eth0': 2}.get(dev)
+
+	def tc_stats(self, indexes):
+		classes = [{'ifindex': 2, 'handle': '1:1', 'parent': 'root', 'kind': 'htb', 'bytes': 5000, 'packets': 50},
+				   {'ifindex': 2, 'handle': '1:30', 'parent': '1:1', 'kind': 'htb', 'bytes': 1000, 'packets': 10, 'drops': 0},
+				   {'ifindex': 2, 'handle': '1:10', 'parent': '1:1', 'kind': 'htb', 'bytes': 4000, 'packets': 40, 'drops': 2},
+				   {'ifindex': 2, 'handle': '1:99', 'parent': '1:1', 'kind': 'htb', 'bytes': 0}]
+		qdiscs = [{'ifindex': 2, 'handle': '8001:', 'parent': '1:10', 'kind': 'fq_codel', 'bytes': 4000, 'backlog': 0}]
+		return {index: {'classes': classes, 'qdiscs': qdiscs} for index in indexes}
+
+	def close(self):
+		pass
+
+
+@pytest.fixture
+def engine(stand_ins, tmp_path):
+	engine = stand_ins(tmp_path / 'work', CONF, 1)
+	assert engine._parse_macros_from_foomuuri_conf()
+	return engine
+
+
+def test_class_labels(engine):
+	upload = engine._stats_class_labels('eth0', 'upload')
+	classes = {key: meta for key, meta in upload.items() if not meta['role'].startswith('host')}
+	assert classes == {(1, 1): {'service': '', 'mark': '', 'role': 'root', 'rate': 100000000, 'ceil': 100000000},
+					   (1, 0x30): {'service': 'default', 'mark': hex(engine.DEFAULT_MARK), 'role': 'default', 'rate': 1000000, 'ceil': 10000000},
+					   (1, 0x10): {'service': 'ssh', 'mark': '0x1', 'role': 'service', 'rate': 1000000, 'ceil': 5000000}}
+	# Equidade por host: uma subclasse por host (.1, .2) e a dos restantes (octeto 0), com a taxa da classe do servico dividida
+	download = engine._stats_class_labels('ifb0', 'download')
+	for labels, service_rate in ((upload, 1000000), (download, 3000000)):
+		assert {key: meta['role'] for key, meta in labels.items() if meta['role'].startswith('host')} == {(1, 0x1000): 'host_other', (1, 0x1001): 'host', (1, 0x1002): 'host'}
+		assert labels[(1, 0x10)]['rate'] == service_rate and labels[(1, 0x1001)]['rate'] == service_rate // 3 and labels[(1, 0x1001)]['service'] == 'ssh'
+
+
+def test_collect_stats_labels_the_dump(engine):
+	engine._stats_rtnl = FakeRtnl()
+	sample = engine.collect_stats()
+	classes = {e['classid']: e for e in sample['classes']}
+	assert {e['device'] for e in sample['classes']} == {'eth0'}
+	assert (classes['1:10']['service'], classes['1:10']['role'], classes['1:10']['direction'], classes['1:10']['drops']) == ('ssh', 'service', 'upload', 2)
+	assert classes['1:99']['role'] == 'unmanaged' and classes['1:1']['role'] == 'root'
+	# A folha herda o servico da classe a que esta ligada
+	[leaf] = sample['qdiscs']
+	assert (leaf['service'], leaf['mark'], leaf['interface']) == ('ssh', '0x1', 'eth0')
+
+
+def entry(classid, **counters):
+	return dict({'device': 'eth0', 'classid': classid, 'kind': 'htb'}, **counters)
+
+
+def test_rates_between_samples(engine):
+	previous = {'timestamp': 100.0, 'classes': [entry('1:10', bytes=1000, packets=10, drops=5), entry('1:20', bytes=9000)], 'qdiscs': []}
+	sample = {'timestamp': 102.0, 'classes': [entry('1:10', bytes=3000, packets=30, drops=5), entry('1:20', bytes=100), entry('1:30', bytes=50)], 'qdiscs': []}
+	engine._stats_rates(sample, previous)
+	first, reset, new = sample['classes']
+	assert sample['interval'] == 2.0
+	assert (first['bytes_rate'], first['packets_rate'], first['drops_rate']) == (8000.0, 10.0, 0.0)
+	# Contador que recuou (classe recriada) e classe nova: sem taxa
+	assert 'bytes_rate' not in reset and 'bytes_rate' not in new
+
+
+def test_rates_need_time_to_pass(engine):
+	sample = {'timestamp': 100.0, 'classes': [entry('1:10', bytes=3000)], 'qdiscs': []}
+	engine._stats_rates(sample, {'timestamp': 100.0, 'classes': [entry('1:10', bytes=1000)], 'qdiscs': []})
+	assert 'interval' not in sample and 'bytes_rate' not in sample['classes'][0]
+
+
+def test_prometheus_format(engine):
+	sample = {'timestamp': 1700000000.5, 'qdiscs': [],
+			  'classes': [dict(entry('1:10', bytes=4000, bytes_rate=8000.0), interface='eth0', direction='upload', service='a"b\\c', mark='0x1', role='service', parent='1:1'),
+						  dict(entry('1:30', bytes=10), interface='eth0', direction='upload', service='default', mark='0xff', role='default', parent='1:1')]}
+	lines = engine._format_prometheus(sample).splitlines()
+	assert lines[:4] == ["# HELP foomuuri_qos_class_bytes_total Bytes enviados", "# TYPE foomuuri_qos_class_bytes_total counter",
+						 'foomuuri_qos_class_bytes_total{interface="eth0",device="eth0",direction="upload",service="a\\"b\\\\c",mark="0x1",role="service",classid="1:10",parent="1:1",kind="htb"} 4000',
+						 'foomuuri_qos_class_bytes_total{interface="eth0",device="eth0",direction="upload",service="default",mark="0xff",role="default",classid="1:30",parent="1:1",kind="htb"} 10']
+	# Metricas sem valor em nenhuma entrada nao aparecem; a taxa so existe onde ha duas amostras
+	assert [line for line in lines if line.startswith('foomuuri_qos_class_bits_per_second')] == [
+		'foomuuri_qos_class_bits_per_second{interface="eth0",device="eth0",direction="upload",service="a\\"b\\\\c",mark="0x1",role="service",classid="1:10",parent="1:1",kind="htb"} 8000.000']
+	assert not [line for line in lines if 'drops_total' in line] and not [line for line in lines if 'qdisc' in line]
+	assert lines[-1] == "foomuuri_qos_stats_timestamp_seconds 1700000000.500"